@@ -0,0 +1,8 @@
+#!/usr/bin/env sh
+
+# Transmission script-torrent-done hook. Tells plexpost which torrent finished so it is processed immediately.
+# The timeout keeps Transmission from piling up blocked scripts while plexpost is not running.
+FIFO=${PLEXPOST_FIFO:-/downloads/.plexpost.fifo}
+
+[ -p "$FIFO" ] && timeout 5 sh -c "echo '$TR_TORRENT_HASH' > '$FIFO'"
+exit 0
@@ -1,41 +1,145 @@
+import datetime
+import signal
 import sys
+import threading
 
 import hiyapyco
-import transmissionrpc
-from apscheduler.schedulers.blocking import BlockingScheduler
 
-from plexpost import post_processor, movies_flow, htpc_switch, sftp_factory, default_flow, show_flow
+from plexpost import post_processor, movies_flow, htpc_switch, sftp_factory, default_flow, show_flow, torrent_poller, \
+    sftp_destination, transfer, transfer_journal, transfer_queue, metrics, bandwidth, snapshot
+
+# The scheduler, the asyncio pipeline, fan-out and the local library are imported once they are configured, paramiko
+# and requests on their first call, so only what the configuration needs is loaded before the first poll
 
 
 def main():
     confs = [sys.argv[1], sys.argv[2]]
     conf = hiyapyco.load(confs, method=hiyapyco.METHOD_MERGE, mergelists=False, failonmissingfiles=False)
+    start_metrics(conf.get('metrics', {}))
     transmission = create_transmission(conf['transmission'])
-    sftp = sftp_factory.SFTPFactory(conf['sftp'])
     switch = create_htpc_switch(conf['home_assistant'])
-    scheduler = BlockingScheduler()
+    journal = transfer_journal.TransferJournal(conf['journal']['path'])
+    queue = transfer_queue.TransferQueue(conf.get('transfer_queue', {}))
+    destination, transfers = create_destination(conf, journal, queue)
+    plugins = []
     if 'default_flow' in conf:
-        create_schedule(scheduler, transmission, switch, sftp, default_flow.DefaultPostProcessor(conf['default_flow']))
+        plugins.append(default_flow.DefaultPostProcessor(conf['default_flow']))
     if 'movies_flow' in conf:
-        create_schedule(scheduler, transmission, switch, sftp, movies_flow.MoviePostProcessor(conf['movies_flow']))
+        plugins.append(movies_flow.MoviePostProcessor(conf['movies_flow']))
     if 'tv_flow' in conf:
-        create_schedule(scheduler, transmission, switch, sftp, show_flow.ShowPostProcessor(conf['tv_flow']))
+        plugins.append(show_flow.ShowPostProcessor(conf['tv_flow']))
+    processors = [create_processor(transmission, conf['transmission'], switch, destination, transfers, p)
+                  for p in plugins]
+    poller = torrent_poller.TorrentPoller(create_torrent_source(transmission, conf['transmission']), processors,
+                                          conf['transmission'].get('stream_files', False))
+    snapshot_path = (conf.get('snapshot') or {}).get('path')
+    restore(snapshot.load(snapshot_path), poller, transfers)
+    if len(poller.pending) > 0 and len(processors) > 0:
+        print('Resuming ' + str(len(poller.pending)) + ' torrent(s) with unfinished transfers')
+        # The htpc boots while the first poll runs
+        threading.Thread(target=processors[0].wake_htpc, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    trigger = conf.get('trigger', {})
+    pipeline_conf = conf.get('pipeline', {})
+    try:
+        if pipeline_conf.get('engine', 'scheduler') == 'asyncio':
+            # The slots are the uploads running at once over every torrent in the pipeline
+            transfers.workers = pipeline_conf.get('transfer_slots', 2)
+            run_pipeline(poller, trigger, pipeline_conf)
+        else:
+            run_scheduler(poller, trigger)
+    finally:
+        snapshot.save(snapshot_path, {'poller': poller.snapshot(), 'transfers': transfers.snapshot()})
+
+
+def stop(signum, frame):
+    # docker stop sends SIGTERM, leaving through SystemExit lets the snapshot be written
+    raise SystemExit(0)
+
+
+def restore(state, poller, transfers):
+    poller.restore(state.get('poller', {}))
+    transfers.restore(state.get('transfers', {}))
+
+
+def run_scheduler(poller, trigger):
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    if 'fifo' in trigger:
+        start_done_listener(trigger['fifo'], poller.run_torrents)
+    scheduler = BlockingScheduler()
+    # The first poll runs right away rather than one interval after start up
+    scheduler.add_job(poller.run, 'interval', seconds=poll_seconds(poller, trigger),
+                      next_run_time=datetime.datetime.now())
     try:
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
         pass
 
 
-def create_schedule(scheduler, transmission, htpc_switch, sftp, plugin):
-    proc = post_processor.PostProcessor(transmission, htpc_switch, sftp, plugin)
-    scheduler.add_job(proc.run, 'interval', minutes=1)
+def run_pipeline(poller, trigger, conf):
+    import asyncio
+    from plexpost import pipeline
+    engine = pipeline.Pipeline(poller, poll_seconds(poller, trigger), conf.get('queue_size', 16))
+    if 'fifo' in trigger:
+        start_done_listener(trigger['fifo'], engine.signal)
+    try:
+        asyncio.get_event_loop().run_until_complete(engine.run())
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+def poll_seconds(poller, trigger):
+    return torrent_poller.poll_interval(poller.source, trigger.get('poll_minutes', 1) * 60)
+
+
+def start_done_listener(path, callback):
+    from plexpost import done_listener
+    done_listener.DoneListener(path, callback).start()
+
+
+def start_metrics(conf):
+    if conf.get('trace_path'):
+        metrics.registry.open_trace(conf['trace_path'])
+    if conf.get('enabled', False):
+        metrics.MetricsServer((conf.get('host', '127.0.0.1'), conf.get('port', 9310)), metrics.registry).start()
+
+
+def create_destination(conf, journal, queue):
+    if conf.get('destination', 'sftp') == 'local':
+        from plexpost import local_destination
+        local = local_destination.LocalDestination(conf['local'])
+        return local, transfer.TransferPool(local, local.transfer_workers, journal, queue)
+    sftp = sftp_destination.SFTPDestination(sftp_factory.SFTPFactory(conf['sftp']))
+    shaper = bandwidth.Shaper(conf.get('bandwidth') or {})
+    mirrors = conf.get('sftp_mirrors') or []
+    if len(mirrors) > 0:
+        from plexpost import fanout
+        # Mirrors inherit every sftp setting they do not override
+        targets = [sftp] + [sftp_destination.SFTPDestination(sftp_factory.SFTPFactory(dict(conf['sftp'], **m)))
+                            for m in mirrors]
+        return sftp, fanout.FanoutTransferPool(targets, sftp.transfer_workers, journal, queue, shaper)
+    return sftp, transfer.TransferPool(sftp, sftp.transfer_workers, journal, queue, shaper)
+
+
+def create_processor(transmission, transmission_conf, htpc_switch, destination, transfers, plugin):
+    return post_processor.PostProcessor(transmission, htpc_switch, destination, plugin, transfers,
+                                        transmission_conf.get('delete_data', False))
 
 
 def create_htpc_switch(conf):
-    return htpc_switch.HTPCSwitch(conf['url'], conf['token'], conf['htpc_switch'])
+    return htpc_switch.HTPCSwitch(conf['url'], conf['token'], conf['htpc_switch'], conf.get('timeout', 5),
+                                  conf.get('state_ttl', 60))
+
+
+def create_torrent_source(transmission, conf):
+    if conf.get('incremental', False):
+        return torrent_poller.IncrementalTorrentSource(transmission, conf.get('full_sync_ticks', 60),
+                                                       conf.get('delta_poll_seconds', 30))
+    return torrent_poller.FullTorrentSource(transmission)
 
 
 def create_transmission(conf):
+    import transmissionrpc
     return transmissionrpc.Client(conf['url'], conf['port'], conf['username'], conf['password'])
 
 
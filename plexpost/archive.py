@@ -0,0 +1,379 @@
+import errno
+import functools
+import io
+import os
+import re
+import stat
+import struct
+import zipfile
+
+RAR4_SIGNATURE = b'Rar!\x1a\x07\x00'
+RAR5_SIGNATURE = b'Rar!\x1a\x07\x01\x00'
+NEW_VOLUME = re.compile(r'^(.*\.part)(\d+)\.rar$', re.IGNORECASE)
+OLD_VOLUME = re.compile(r'^(.*)\.([r-z])(\d\d)$', re.IGNORECASE)
+READ_AHEAD = 64 * 1024
+
+
+class ArchiveError(IOError):
+    pass
+
+
+class Entry:
+    def __init__(self, name, size, stored, encrypted=False):
+        self.name = name.replace('\\', '/')
+        self.size = size
+        self.stored = stored
+        self.encrypted = encrypted
+        self.segments = []  # (volume, offset, length) of the stored bytes
+        self.zip_path = None
+
+    @property
+    def streamable(self):
+        # Stored entries are copied out of the volumes as they are, a zip can also be inflated on the fly
+        return not self.encrypted and (self.stored or self.zip_path is not None)
+
+
+def is_first_volume(filename):
+    lower = filename.lower()
+    if lower.endswith('.zip'):
+        return True
+    new = NEW_VOLUME.match(filename)
+    if new is not None:
+        return int(new.group(2)) == 1
+    return lower.endswith('.rar')
+
+
+def volume_set(filename):
+    # A name shared by every volume of a set, None for files that are no archive volume
+    new = NEW_VOLUME.match(filename)
+    if new is not None:
+        return new.group(1)
+    old = OLD_VOLUME.match(filename)
+    if old is not None:
+        return old.group(1) + '.rar'
+    if filename.lower().endswith(('.rar', '.zip')):
+        return filename[:-4] + filename[-4:].lower()
+    return None
+
+
+def is_volume_of(first, filename):
+    return volume_set(filename) is not None and volume_set(filename) == volume_set(first)
+
+
+def volumes(path):
+    found = [path]
+    new = NEW_VOLUME.match(path)
+    if new is not None:
+        number = int(new.group(2)) + 1
+        while True:
+            candidate = new.group(1) + str(number).zfill(len(new.group(2))) + '.rar'
+            if not os.path.exists(candidate):
+                return found
+            found.append(candidate)
+            number += 1
+    # Old style sets continue with .r00 to .r99, then .s00 and so on
+    for letter in 'rstuvwxyz':
+        for number in range(100):
+            candidate = path[:-4] + '.' + letter + str(number).zfill(2)
+            if not os.path.exists(candidate):
+                return found
+            found.append(candidate)
+    return found
+
+
+def read_vint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ArchiveError('truncated RAR header')
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if byte & 0x80 == 0:
+            return value, pos
+        shift += 7
+
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ArchiveError('truncated RAR volume')
+    return data
+
+
+def rar4_headers(f, volume, entries):
+    while True:
+        start = f.tell()
+        base = f.read(7)
+        if len(base) < 7:
+            return
+        _, kind, flags, size = struct.unpack('<HBHH', base)
+        if size < 7:
+            raise ArchiveError('corrupt RAR header in ' + volume)
+        header = base + read_exactly(f, size - 7)
+        data_size = struct.unpack('<I', header[7:11])[0] if kind == 0x74 or flags & 0x8000 else 0
+        if kind == 0x7b:
+            return  # End of archive
+        if kind == 0x74:
+            unpacked = struct.unpack('<I', header[11:15])[0]
+            method = header[25]
+            name_size = struct.unpack('<H', header[26:28])[0]
+            name_start = 32
+            if flags & 0x100:
+                high_packed, high_unpacked = struct.unpack('<II', header[32:40])
+                data_size += high_packed << 32
+                unpacked += high_unpacked << 32
+                name_start = 40
+            # Unicode names follow the legacy name after a NUL byte
+            name = header[name_start:name_start + name_size].split(b'\0')[0].decode('utf-8', 'replace')
+            if flags & 0xe0 != 0xe0:
+                add_segment(entries, name, unpacked, method == 0x30, flags & 0x04 != 0, flags & 0x01 != 0,
+                            (volume, start + size, data_size))
+        f.seek(start + size + data_size)
+
+
+def rar5_headers(f, volume, entries):
+    while True:
+        start = f.tell()
+        prefix = f.read(7)
+        if len(prefix) < 5:
+            return
+        size, body = read_vint(prefix, 4)
+        f.seek(start + body)
+        header = read_exactly(f, size)
+        kind, pos = read_vint(header, 0)
+        flags, pos = read_vint(header, pos)
+        extra_size = data_size = 0
+        if flags & 0x01:
+            extra_size, pos = read_vint(header, pos)
+        if flags & 0x02:
+            data_size, pos = read_vint(header, pos)
+        if kind == 4:
+            raise ArchiveError(volume + ' has encrypted headers')
+        if kind == 5:
+            return  # End of archive
+        if kind == 2:
+            file_flags, pos = read_vint(header, pos)
+            unpacked, pos = read_vint(header, pos)
+            _, pos = read_vint(header, pos)  # Attributes
+            if file_flags & 0x02:
+                pos += 4  # mtime
+            if file_flags & 0x04:
+                pos += 4  # CRC32
+            compression, pos = read_vint(header, pos)
+            _, pos = read_vint(header, pos)  # Host OS
+            name_size, pos = read_vint(header, pos)
+            name = header[pos:pos + name_size].decode('utf-8', 'replace')
+            if not file_flags & 0x01:
+                encrypted = rar5_encrypted(header[size - extra_size:]) if extra_size > 0 else False
+                add_segment(entries, name, unpacked, (compression >> 7) & 0x07 == 0, encrypted, flags & 0x08 != 0,
+                            (volume, start + body + size, data_size))
+        f.seek(start + body + size + data_size)
+
+
+def rar5_encrypted(extra):
+    pos = 0
+    while pos < len(extra):
+        size, body = read_vint(extra, pos)
+        kind, _ = read_vint(extra, body)
+        if kind == 0x01:
+            return True
+        pos = body + size
+    return False
+
+
+def add_segment(entries, name, size, stored, encrypted, continued, segment):
+    # A file split over volumes has a header in each of them, the continuations only add their bytes
+    if continued and len(entries) > 0 and entries[-1].name == name.replace('\\', '/'):
+        entries[-1].segments.append(segment)
+        return
+    entry = Entry(name, size, stored, encrypted)
+    entry.segments.append(segment)
+    entries.append(entry)
+
+
+def rar_index(path):
+    entries = []
+    for volume in volumes(path):
+        with open(volume, 'rb') as f:
+            signature = f.read(8)
+            if signature == RAR5_SIGNATURE:
+                rar5_headers(f, volume, entries)
+            elif signature[:7] == RAR4_SIGNATURE:
+                f.seek(7)
+                rar4_headers(f, volume, entries)
+            else:
+                raise ArchiveError(volume + ' is not a RAR volume')
+    for e in entries:
+        if e.stored and sum(length for _, _, length in e.segments) != e.size:
+            raise ArchiveError(e.name + ' is missing volumes')
+    return entries
+
+
+def zip_index(path):
+    entries = []
+    try:
+        with zipfile.ZipFile(path) as z, open(path, 'rb') as f:
+            for info in z.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                entry = Entry(info.filename, info.file_size, info.compress_type == zipfile.ZIP_STORED,
+                              info.flag_bits & 0x01 != 0)
+                entry.zip_path = path
+                if entry.stored:
+                    # The data follows the local header, whose name and extra field may differ from the index
+                    f.seek(info.header_offset + 26)
+                    name_size, extra_size = struct.unpack('<HH', read_exactly(f, 4))
+                    entry.segments.append((path, info.header_offset + 30 + name_size + extra_size, info.file_size))
+                entries.append(entry)
+    except zipfile.BadZipfile as e:
+        raise ArchiveError(path + ': ' + str(e))
+    return entries
+
+
+@functools.lru_cache(maxsize=64)
+def cached_index(path, mtime):
+    return rar_index(path) if not path.lower().endswith('.zip') else zip_index(path)
+
+
+def index(path):
+    # Mapping, planning and uploading all look up the same entries, the index is only read once
+    return cached_index(path, os.stat(path).st_mtime)
+
+
+def find_entry(path, name):
+    for e in index(path):
+        if e.name == name:
+            return e
+    raise FileNotFoundError(errno.ENOENT, 'No such archive entry', path + ':' + name)
+
+
+class SegmentReader(io.RawIOBase):
+    def __init__(self, segments):
+        io.RawIOBase.__init__(self)
+        self.segments = segments
+        self.position = 0
+        self.file = None
+        self.volume = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('only absolute seeks are supported')
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buf):
+        start = 0
+        for volume, offset, length in self.segments:
+            if self.position < start + length:
+                if volume != self.volume:
+                    self.close_volume()
+                    self.file = open(volume, 'rb', buffering=0)
+                    self.volume = volume
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(self.file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                count = min(len(buf), start + length - self.position)
+                self.file.seek(offset + self.position - start)
+                read = self.file.readinto(memoryview(buf)[:count])
+                if not read:
+                    raise ArchiveError(volume + ' is shorter than its index says')
+                self.position += read
+                return read
+            start += length
+        return 0
+
+    def close_volume(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.volume = None
+
+    def close(self):
+        self.close_volume()
+        io.RawIOBase.close(self)
+
+
+class ZipReader(io.RawIOBase):
+    def __init__(self, path, name):
+        io.RawIOBase.__init__(self)
+        self.zip = zipfile.ZipFile(path)
+        self.name = name
+        self.stream = self.zip.open(name)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Deflated data can only be skipped by inflating it, resuming reads up to the offset again
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('only absolute seeks are supported')
+        if offset < self.position:
+            self.stream.close()
+            self.stream = self.zip.open(self.name)
+            self.position = 0
+        while self.position < offset:
+            skipped = len(self.stream.read(min(READ_AHEAD, offset - self.position)))
+            if skipped == 0:
+                break
+            self.position += skipped
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buf):
+        data = self.stream.read(len(buf))
+        buf[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        self.stream.close()
+        self.zip.close()
+        io.RawIOBase.close(self)
+
+
+def open_entry(path, name):
+    entry = find_entry(path, name)
+    if not entry.streamable:
+        raise ArchiveError(name + ' in ' + path + ' is compressed or encrypted and cannot be streamed')
+    if entry.stored:
+        return SegmentReader(entry.segments)
+    return ZipReader(entry.zip_path, name)
+
+
+def open_source(path, entry=None):
+    # Uploads read either a plain file or an entry of an archive, never an extracted copy of it
+    if entry is not None:
+        return open_entry(path, entry)
+    src = open(path, 'rb', buffering=0)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return src
+
+
+def source_stat(path, entry=None):
+    src_stat = os.stat(path)
+    if entry is None:
+        return src_stat
+    # An entry looks like a regular file with the archive's times and the entry's size
+    size = find_entry(path, entry).size
+    return os.stat_result((stat.S_IFREG | 0o644, src_stat.st_ino, src_stat.st_dev, 1, src_stat.st_uid,
+                           src_stat.st_gid, size, int(src_stat.st_atime), int(src_stat.st_mtime),
+                           int(src_stat.st_ctime)),
+                          {'st_atime': src_stat.st_atime, 'st_mtime': src_stat.st_mtime,
+                           'st_ctime': src_stat.st_ctime})
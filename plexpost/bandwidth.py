@@ -0,0 +1,123 @@
+import datetime
+import os
+import threading
+import time
+
+import yaml
+
+# How often the clock and the schedule file are checked for a different limit
+REFRESH_SECONDS = 1
+
+
+def parse_time(value):
+    # YAML 1.1 reads an unquoted 20:30 as the sexagesimal number 1230, i.e. minutes since midnight
+    if isinstance(value, int):
+        return datetime.time(value // 60 % 24, value % 60)
+    hours, minutes = str(value).split(':')
+    return datetime.time(int(hours), int(minutes))
+
+
+class Window:
+    def __init__(self, conf):
+        self.start = parse_time(conf['start'])
+        self.end = parse_time(conf['end'])
+        self.global_limit = conf.get('global_limit')
+        self.per_connection_limit = conf.get('per_connection_limit')
+
+    def contains(self, now):
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end  # The window spans midnight
+
+
+class TokenBucket:
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.monotonic()
+            if self.rate is None:
+                self.tokens = 0.0
+                self.last = now
+                return
+            # At most a second's worth of tokens piles up, anything more would let bursts exceed the limit
+            self.tokens = min(float(self.rate), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Going into debt lets a block larger than the bucket through, later callers pay it off
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Shaper:
+    def __init__(self, conf):
+        self.lock = threading.Lock()
+        self.schedule_file = conf.get('schedule_file') or None
+        self.schedule_mtime = None
+        self.global_bucket = TokenBucket()
+        self.per_connection_limit = None
+        self.checked = None
+        self.current = None
+        self.set_schedule(conf)
+
+    def set_schedule(self, conf):
+        windows = [Window(w) for w in conf.get('windows') or []]
+        with self.lock:
+            self.global_limit = conf.get('global_limit')
+            self.default_per_connection_limit = conf.get('per_connection_limit')
+            self.windows = windows
+            self.checked = None  # Apply the new schedule on the next block
+
+    def limits(self, now=None):
+        now = datetime.datetime.now().time() if now is None else now
+        with self.lock:
+            for w in self.windows:
+                if w.contains(now):
+                    return w.global_limit, w.per_connection_limit
+            return self.global_limit, self.default_per_connection_limit
+
+    def reload(self):
+        # The schedule file can be edited while we run, e.g. to lift the limit for a night
+        if self.schedule_file is None:
+            return
+        try:
+            mtime = os.stat(self.schedule_file).st_mtime
+            if mtime == self.schedule_mtime:
+                return
+            with open(self.schedule_file) as f:
+                self.set_schedule(yaml.safe_load(f) or {})
+            self.schedule_mtime = mtime
+            print('Loaded bandwidth schedule from ' + self.schedule_file)
+        except (OSError, ValueError, KeyError, yaml.YAMLError) as e:
+            if self.schedule_mtime != 'failed':  # Checked every second, so only say it once
+                print('Could not load bandwidth schedule ' + self.schedule_file + ': ' + str(e))
+            self.schedule_mtime = 'failed'
+
+    def refresh(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.checked is not None and now - self.checked < REFRESH_SECONDS:
+                return
+            self.checked = now
+        self.reload()
+        limits = self.limits()
+        if limits != self.current:
+            print('Bandwidth limit set to ' + str(limits[0]) + ' B/s overall, ' + str(limits[1]) +
+                  ' B/s per connection')
+            self.current = limits
+        self.global_bucket.rate, self.per_connection_limit = limits
+
+    def connection_throttle(self):
+        bucket = TokenBucket()
+
+        def throttle(count):
+            self.refresh()
+            bucket.rate = self.per_connection_limit
+            bucket.consume(count)
+            self.global_bucket.consume(count)
+        return throttle
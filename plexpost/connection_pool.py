@@ -0,0 +1,76 @@
+import socket
+import threading
+
+from plexpost import metrics, lazy
+
+paramiko = lazy.Module('paramiko')
+
+
+class ConnectionPool:
+    def __init__(self, sftp_factory):
+        self.sftp_factory = sftp_factory
+        self.keepalive_seconds = sftp_factory.keepalive_seconds
+        self.health_check_timeout = sftp_factory.health_check_timeout
+        self.transport = None
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while len(self.idle) > 0:
+                sftp = self.idle.pop()
+                if self.is_healthy(sftp):
+                    return sftp
+                self.close_channel(sftp)
+                # A dead transport means the remote went away (e.g. the HTPC slept), so start over. Otherwise only
+                # this channel broke, and the others may still be uploading over the transport
+                if self.transport is not None and not self.transport.is_active():
+                    self.reset()
+            return self.sftp_factory.open_sftp(self.connected_transport())
+
+    def release(self, sftp, healthy=True):
+        with self.lock:
+            if healthy and self.transport is not None and sftp.get_channel().get_transport() is self.transport:
+                self.idle.append(sftp)
+            else:
+                sftp.close()
+
+    def connected_transport(self):
+        if self.transport is None or not self.transport.is_active():
+            self.reset()
+            with metrics.timed('connect'):
+                transport = self.sftp_factory.await_connection()
+            transport.set_keepalive(self.keepalive_seconds)
+            self.transport = transport
+        return self.transport
+
+    def is_healthy(self, sftp):
+        channel = sftp.get_channel()
+        if channel.closed or not channel.get_transport().is_active():
+            return False
+        channel.settimeout(self.health_check_timeout)
+        try:
+            sftp.stat('.')
+            return True
+        except (paramiko.SSHException, EOFError, socket.error):
+            return False
+        finally:
+            channel.settimeout(None)
+
+    def close_channel(self, sftp):
+        try:
+            sftp.close()
+        except (paramiko.SSHException, EOFError, socket.error):
+            pass  # The transport is already gone, which is usually why we are closing
+
+    def reset(self):
+        for sftp in self.idle:
+            self.close_channel(sftp)
+        self.idle = []
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def close(self):
+        with self.lock:
+            self.reset()
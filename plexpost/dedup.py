@@ -0,0 +1,82 @@
+import hashlib
+import posixpath
+import shlex
+
+from plexpost import archive, lazy
+
+paramiko = lazy.Module('paramiko')
+
+NONE = 'none'
+STAT = 'stat'
+CHECKSUM = 'checksum'
+
+
+def local_sha256(path, block_size, entry=None, until=None):
+    # None when until is done first, a partial hash is worth nothing
+    digest = hashlib.sha256()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with archive.open_source(path, entry) as f:
+        while True:
+            if until is not None and until.done():
+                return None
+            read = f.readinto(buf)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+def remote_sha256(transport, path):
+    # None when the remote cannot tell, e.g. an SFTP-only account refusing to run commands
+    try:
+        channel = transport.open_session()
+    except paramiko.SSHException:
+        return None
+    try:
+        channel.exec_command('sha256sum -- ' + shlex.quote(path))
+        channel.shutdown_write()
+        output = channel.makefile('rb').read().decode()
+        if channel.recv_exit_status() != 0:
+            return None
+    except paramiko.SSHException:
+        return None
+    finally:
+        channel.close()
+    return output.split(' ', 1)[0].strip()
+
+
+class Deduplicator:
+    def __init__(self, mode, remote_dir, block_size):
+        self.mode = mode
+        self.remote_dir = remote_dir
+        self.block_size = block_size
+
+    def prepare(self, planned, until=None):
+        # Hash ahead only while something else, such as the remote booting, is keeping us waiting
+        if self.mode != CHECKSUM or until is None:
+            return
+        for p in planned:
+            p.sha256 = local_sha256(p.src_file, self.block_size, p.entry, until)
+            if p.sha256 is None:
+                return
+
+    def is_identical(self, sftp, planned, remote_stat):
+        src_stat = planned.stat
+        if self.mode == NONE or remote_stat is None or remote_stat.st_size != src_stat.st_size:
+            return False
+        if self.mode == STAT:
+            return remote_stat.st_mtime == int(src_stat.st_mtime)
+        # Only files that already match in size are worth reading and hashing
+        remote_path = posixpath.join(self.remote_dir, planned.rule['dest'])
+        remote_hash = remote_sha256(sftp.get_channel().get_transport(), remote_path)
+        if remote_hash is None:
+            return False
+        if planned.sha256 is None:
+            planned.sha256 = local_sha256(planned.src_file, self.block_size, planned.entry)
+        return remote_hash == planned.sha256
+
+    def uploaded(self, sftp, planned):
+        if self.mode == STAT:
+            # Carry the source mtime over so the next size/mtime comparison is meaningful
+            sftp.utime(planned.rule['dest'], (int(planned.stat.st_atime), int(planned.stat.st_mtime)))
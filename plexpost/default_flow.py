@@ -1,7 +1,11 @@
+from plexpost import flow_index
+
+
 class DefaultPostProcessor:
     def __init__(self, conf):
         self.download_dir_tag = conf['download_dir_tag']
         self.type = 'uncategorised download'
+        self.match = flow_index.EXACT
 
     def map_files(self, download):
         mappings = []
@@ -0,0 +1,274 @@
+import hashlib
+import shlex
+import struct
+import time
+import zlib
+
+from plexpost import archive, lazy
+
+paramiko = lazy.Module('paramiko')
+
+ADLER = 65521
+READ_SIZE = 4 * 1024 * 1024
+LITERAL_CHUNK = 1024 * 1024
+SEND_CHUNK = 256 * 1024
+# The source is judged window by window: a delta is given up once more than half of a window had to be sent anyway,
+# or once a window is scanned slower than min_rate, as the byte by byte search through changed data is
+WINDOW_BYTES = 32 * 1024 * 1024
+MIN_WINDOW_BLOCKS = 8
+# Larger files get larger blocks, so the remote signature and the index stay at about this many entries
+MAX_BLOCKS = 16384
+SIGNATURE = struct.Struct('>II16s')
+
+# Runs on the remote's own python3 (3.6+): prints the block signatures of a file, or rebuilds it from a delta
+HELPER = r'''
+import hashlib, os, struct, sys, zlib
+def sig(path, block):
+    out = sys.stdout.buffer
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                return
+            out.write(struct.pack('>II16s', zlib.adler32(data), len(data),
+                                  hashlib.blake2b(data, digest_size=16).digest()))
+def read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise IOError('truncated delta')
+    return data
+def patch(path):
+    inp = sys.stdin.buffer
+    part = path + '.plexpost'
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as old, open(part, 'wb') as new:
+            while True:
+                op = read(inp, 1)
+                if op == b'E':
+                    break
+                if op == b'C':
+                    offset, length = struct.unpack('>QQ', read(inp, 16))
+                    old.seek(offset)
+                    source = old
+                elif op == b'L':
+                    length = struct.unpack('>Q', read(inp, 8))[0]
+                    source = inp
+                else:
+                    raise IOError('bad delta op')
+                while length > 0:
+                    data = read(source, min(length, 1 << 20))
+                    digest.update(data)
+                    new.write(data)
+                    length -= len(data)
+        if read(inp, 32) != digest.digest():
+            raise IOError('rebuilt file does not match the source')
+        os.replace(part, path)
+    except Exception:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+if sys.argv[1] == 'sig':
+    sig(sys.argv[3], int(sys.argv[2]))
+else:
+    patch(sys.argv[2])
+'''
+
+
+class DeltaError(Exception):
+    pass
+
+
+def block_size_for(size, minimum):
+    block = minimum
+    while size > block * MAX_BLOCKS:
+        block *= 2
+    return block
+
+
+def helper_command(*args):
+    return 'python3 -c ' + ' '.join(shlex.quote(a) for a in (HELPER,) + args)
+
+
+def signature(transport, path, block_size):
+    # Maps the weak checksum of every full block of the remote file to its strong checksums and offsets
+    channel = transport.open_session()
+    try:
+        channel.exec_command(helper_command('sig', str(block_size), path))
+        channel.shutdown_write()
+        output = channel.makefile('rb').read()
+        error = channel.makefile_stderr('rb').read().decode('utf-8', 'replace')
+        if channel.recv_exit_status() != 0:
+            raise DeltaError('could not read remote block checksums: ' + (error.strip().splitlines() or ['?'])[-1])
+    finally:
+        channel.close()
+    index = {}
+    for n, (weak, length, strong) in enumerate(SIGNATURE.iter_unpack(output)):
+        if length == block_size:
+            index.setdefault(weak, []).append((strong, n * block_size))
+    return index
+
+
+class OpWriter:
+    def __init__(self, channel, throttle=None):
+        self.channel = channel
+        self.throttle = throttle
+        self.pending = bytearray()
+        self.copy = None
+        self.sent = 0
+
+    def copy_block(self, offset, length):
+        # Runs of blocks that follow each other on the remote go as a single copy
+        if self.copy is not None and self.copy[0] + self.copy[1] == offset:
+            self.copy = (self.copy[0], self.copy[1] + length)
+            return
+        self.flush_copy()
+        self.copy = (offset, length)
+
+    def flush_copy(self):
+        if self.copy is not None:
+            self.write(b'C' + struct.pack('>QQ', *self.copy))
+            self.copy = None
+
+    def literal(self, data):
+        self.flush_copy()
+        if self.throttle is not None:
+            self.throttle(len(data))
+        self.write(b'L' + struct.pack('>Q', len(data)) + data)
+
+    def end(self, digest):
+        self.flush_copy()
+        self.write(b'E' + digest)
+        self.flush()
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= SEND_CHUNK:
+            self.flush()
+
+    def flush(self):
+        self.channel.sendall(bytes(self.pending))
+        self.sent += len(self.pending)
+        self.pending = bytearray()
+
+
+class Encoder:
+    def __init__(self, src, index, block_size, writer, min_rate=None):
+        self.src = src
+        self.index = index
+        self.block_size = block_size
+        self.writer = writer
+        self.min_rate = min_rate
+        self.window = max(WINDOW_BYTES, MIN_WINDOW_BLOCKS * block_size)
+        self.window_start = time.monotonic()
+        self.window_literal = 0
+        self.window_matched = 0
+        self.digest = hashlib.sha256()
+        self.buf = bytearray()
+        self.pos = 0  # Start of the window being matched
+        self.lit = 0  # Start of the literal bytes not sent yet
+        self.eof = False
+        self.literal_bytes = 0
+        self.matched_bytes = 0
+
+    def fill(self, need):
+        # Only bytes from the unsent literal on are kept, so the buffer stays a few MiB whatever the file size
+        while len(self.buf) < need and not self.eof:
+            if self.lit > 0:
+                del self.buf[:self.lit]
+                self.pos -= self.lit
+                need -= self.lit
+                self.lit = 0
+            data = self.src.read(READ_SIZE)
+            if data:
+                self.buf += data
+            else:
+                self.eof = True
+        return len(self.buf) >= need
+
+    def match(self, weak):
+        candidates = self.index.get(weak)
+        if candidates is None:
+            return None
+        strong = hashlib.blake2b(self.buf[self.pos:self.pos + self.block_size], digest_size=16).digest()
+        for s, offset in candidates:
+            if s == strong:
+                return offset
+        return None
+
+    def send_literal(self, end):
+        if end > self.lit:
+            data = bytes(self.buf[self.lit:end])
+            self.digest.update(data)
+            self.writer.literal(data)
+            self.literal_bytes += len(data)
+            self.window_literal += len(data)
+            self.lit = end
+        self.check_window()
+
+    def check_window(self):
+        scanned = self.window_literal + self.window_matched
+        if self.min_rate is not None and scanned < self.window:
+            if (time.monotonic() - self.window_start) * self.min_rate > self.window:
+                raise DeltaError('scanning for changed blocks is slower than ' + str(self.min_rate) + ' bytes/s')
+        if scanned >= self.window:
+            if self.window_literal * 2 > scanned:
+                raise DeltaError('most of the file changed')
+            self.window_start = time.monotonic()
+            self.window_literal = 0
+            self.window_matched = 0
+
+    def run(self):
+        block = self.block_size
+        weak = None
+        while self.fill(self.pos + block):
+            if weak is None:
+                weak = zlib.adler32(self.buf[self.pos:self.pos + block])
+            offset = self.match(weak)
+            if offset is not None:
+                self.send_literal(self.pos)
+                self.digest.update(self.buf[self.pos:self.pos + block])
+                self.writer.copy_block(offset, block)
+                self.matched_bytes += block
+                self.window_matched += block
+                self.pos += block
+                self.lit = self.pos
+                weak = None
+                self.check_window()
+                continue
+            if self.pos + block >= len(self.buf) and not self.fill(self.pos + block + 1):
+                break
+            # Roll the window one byte: drop the first byte, take in the next one
+            out = self.buf[self.pos]
+            a = ((weak & 0xffff) - out + self.buf[self.pos + block]) % ADLER
+            b = ((weak >> 16) - block * out + a - 1) % ADLER
+            weak = (b << 16) | a
+            self.pos += 1
+            if self.pos - self.lit >= LITERAL_CHUNK:
+                self.send_literal(self.pos)
+        while self.fill(len(self.buf) + 1):
+            self.send_literal(len(self.buf))
+        self.send_literal(len(self.buf))
+        return self.digest.digest()
+
+
+def transfer(transport, path, src_file, entry, block_size, throttle=None, min_rate=None):
+    # Rebuilds the remote file at path from its own blocks and whatever differs in the source, returns bytes sent
+    try:
+        index = signature(transport, path, block_size)
+        channel = transport.open_session()
+    except paramiko.SSHException as e:
+        raise DeltaError('remote refused to run the helper: ' + str(e))  # e.g. an SFTP-only account
+    try:
+        channel.exec_command(helper_command('patch', path))
+        writer = OpWriter(channel, throttle)
+        with archive.open_source(src_file, entry) as src:
+            digest = Encoder(src, index, block_size, writer, min_rate).run()
+        writer.end(digest)
+        channel.shutdown_write()
+        error = channel.makefile_stderr('rb').read().decode('utf-8', 'replace')
+        if channel.recv_exit_status() != 0:
+            raise DeltaError('remote could not rebuild the file: ' + (error.strip().splitlines() or ['?'])[-1])
+    finally:
+        channel.close()  # Closing early makes the helper drop its partial file
+    return writer.sent
@@ -0,0 +1,62 @@
+import abc
+
+
+class Session(abc.ABC):
+    # One open channel to a destination, every path is relative to the destination's root
+    @abc.abstractmethod
+    def stat(self, path):
+        pass  # None when there is nothing at path
+
+    @abc.abstractmethod
+    def makedirs(self, path):
+        pass
+
+    @abc.abstractmethod
+    def open(self, path, mode='rb'):
+        pass
+
+    @abc.abstractmethod
+    def rename(self, src, dest):
+        pass  # Replaces dest when it already exists
+
+    @abc.abstractmethod
+    def free_space(self):
+        pass  # None when the destination cannot tell
+
+    def is_identical(self, planned, dest_stat):
+        return False
+
+    @abc.abstractmethod
+    def send(self, planned, offset, throttle=None, checkpoint=None):
+        pass  # Returns the bytes that had to be written
+
+    def completed(self, planned):
+        pass
+
+
+class Destination(abc.ABC):
+    # Where TransferPool places files, SFTP and local destinations both hand out sessions
+    name = None
+    location = None  # Unique per destination, keys whatever is cached about its directories
+    transfer_workers = 1
+    free_space_reserve = 0
+
+    @abc.abstractmethod
+    def acquire(self):
+        pass
+
+    def release(self, session, healthy=True):
+        pass
+
+    @abc.abstractmethod
+    def is_reachable(self, timeout=1):
+        pass
+
+    def prepare(self, planned, until=None):
+        pass
+
+    def space_needed(self, planned, remaining):
+        return remaining
+
+    def close(self):
+        pass
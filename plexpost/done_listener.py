@@ -0,0 +1,44 @@
+import os
+import stat
+import threading
+
+
+def parse_torrent_ids(line):
+    return [i for i in line.replace(',', ' ').split() if len(i) > 0]
+
+
+def ensure_fifo(path):
+    if os.path.exists(path):
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            raise ValueError(path + ' exists and is not a fifo')
+    else:
+        os.mkfifo(path)
+
+
+class DoneListener:
+    def __init__(self, fifo_path, on_done):
+        self.fifo_path = fifo_path
+        self.on_done = on_done
+
+    def start(self):
+        ensure_fifo(self.fifo_path)
+        thread = threading.Thread(target=self.listen, name='done-listener', daemon=True)
+        thread.start()
+        return thread
+
+    def listen(self):
+        # Holding the write end open as well means the read never sees EOF between done-script signals
+        fd = os.open(self.fifo_path, os.O_RDWR)
+        with os.fdopen(fd, 'r') as fifo:
+            for line in fifo:
+                self.handle(line)
+
+    def handle(self, line):
+        ids = parse_torrent_ids(line)
+        if len(ids) == 0:
+            return
+        print('Torrent(s) finished: ' + ', '.join(ids))
+        try:
+            self.on_done(ids)
+        except Exception as e:
+            print('Failed to process finished torrent(s): ' + str(e))
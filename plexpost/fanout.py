@@ -0,0 +1,135 @@
+from plexpost import transfer, sftp_destination
+
+
+class FanoutChannel:
+    def __init__(self, channels):
+        self.channels = channels  # One per target, None for targets that are unreachable this run
+
+    @property
+    def healthy(self):
+        return all(c is None or c.healthy for c in self.channels)
+
+    @healthy.setter
+    def healthy(self, healthy):
+        for c in self.channels:
+            if c is not None:
+                c.healthy = healthy
+
+
+class FanoutTransferPool(transfer.TransferPool):
+    def __init__(self, targets, workers, journal=None, queue=None, shaper=None):
+        # Every target is an SFTPDestination, they all read the same source blocks
+        names = [t.name for t in targets]
+        duplicates = sorted(set(n for n in names if names.count(n) > 1))
+        if len(duplicates) > 0:
+            # Journal entries and reachability are kept per name, so two targets must never share one
+            raise ValueError('Every sftp target needs a unique name, ' + ', '.join(duplicates) + ' is used twice')
+        transfer.TransferPool.__init__(self, targets[0], workers, journal, queue, shaper)
+        self.targets = targets
+        self.unreachable = {}
+
+    def journal_key(self, target, dest):
+        # The first target keeps the plain destination so its journal entries survive adding mirrors
+        return dest if target is self.targets[0] else target.name + ':' + dest
+
+    def forget(self, dests):
+        self.journal.forget([self.journal_key(t, d) for t in self.targets for d in dests])
+
+    def is_transferred(self, rule):
+        return all(self.is_recorded(self.journal_key(t, rule['dest']), rule) for t in self.targets)
+
+    def free_space(self):
+        # Every target has to fit the whole batch, so the fullest one decides
+        spaces = []
+        for t in self.targets:
+            if t.name in self.unreachable:
+                continue
+            session = t.acquire()
+            healthy = False
+            try:
+                spaces.append(session.free_space())
+                healthy = True
+            finally:
+                t.release(session, healthy)
+        known = [s for s in spaces if s is not None]
+        return min(known) if len(known) > 0 else None
+
+    def remaining_bytes(self, planned):
+        return max(self.remaining_bytes_for(self.journal_key(t, planned.rule['dest']), planned) for t in self.targets)
+
+    def warm_up(self):
+        # An unreachable mirror only fails its own copies, the reachable targets still get theirs
+        self.unreachable = {}
+        for t in self.targets:
+            try:
+                t.release(t.acquire())
+            except Exception as e:
+                print(t.name + ' is unreachable: ' + str(e))
+                self.unreachable[t.name] = e
+        if len(self.unreachable) == len(self.targets):
+            raise self.unreachable[self.targets[0].name]
+
+    def acquire_channel(self):
+        return FanoutChannel([None if t.name in self.unreachable else
+                              transfer.PooledChannel(t.acquire(), self.throttle())
+                              for t in self.targets])
+
+    def release_channel(self, channel):
+        for t, c in zip(self.targets, channel.channels):
+            if c is not None:
+                t.release(c.session, c.healthy)
+
+    def send(self, channel, planned):
+        errors = []
+        copies = []
+        for t, c in zip(self.targets, channel.channels):
+            if c is None:
+                errors.append(t.name + ': ' + str(self.unreachable[t.name]))
+                continue
+            key = self.journal_key(t, planned.rule['dest'])
+            try:
+                offset = self.prepare_upload(c.session, planned, key, t)
+            except Exception as e:
+                c.healthy = False
+                errors.append(t.name + ': ' + str(e))
+                continue
+            if offset is not None:
+                copies.append((t, c, key, sftp_destination.RemoteCopy(c.session.sftp, planned.rule['dest'], offset,
+                                                                      self.checkpointer(key, offset), c.throttle)))
+        if len(copies) > 0:
+            factory = self.destination.factory
+            sftp_destination.write_fanout(planned.src_file, [copy for _, _, _, copy in copies], factory.block_size,
+                                          factory.request_size, factory.pipeline_depth, planned.entry)
+        sent = 0
+        for t, c, key, copy in copies:
+            if copy.error is None:
+                try:
+                    self.complete_upload(c.session, planned, key)
+                    sent += planned.stat.st_size - copy.offset
+                    continue
+                except Exception as e:
+                    copy.error = e
+            c.healthy = False
+            errors.append(t.name + ': ' + str(copy.error))
+        if len(errors) > 0:
+            # Targets that got their copy are journaled, so a retry only sends to the ones that failed
+            raise transfer.TransferError('; '.join(errors))
+        return sent
+
+    def verify(self, planned):
+        mismatched = []
+        for t in self.targets:
+            if t.name in self.unreachable:
+                mismatched.extend(t.name + ': ' + p.rule['filename'] for p in planned)
+                continue
+            session = t.acquire()
+            healthy = False
+            try:
+                for p in planned:
+                    remote_stat = session.stat(p.rule['dest'])
+                    if remote_stat is None or remote_stat.st_size != p.stat.st_size:
+                        mismatched.append(t.name + ': ' + p.rule['filename'])
+                healthy = True
+            finally:
+                t.release(session, healthy)
+        return mismatched
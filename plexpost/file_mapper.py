@@ -1,38 +1,109 @@
+import functools
 import os
 import re
 
+from plexpost import archive
+
+
+VIDEO_EXTENSIONS = frozenset(['avi', 'mkv', 'mp4'])
+SUBTITLE_EXTENSIONS = frozenset(['sub', 'idx', 'srt', 'smi', 'ssa', 'ass', 'vtt'])
+
 
 def is_video(filename):
-    return parse_extension(filename) in ['avi', 'mkv', 'mp4']
+    return parse_extension(filename) in VIDEO_EXTENSIONS
 
 
 def is_subtitle(filename):
-    return parse_extension(filename) in ['sub', 'idx', 'srt', 'smi', 'ssa', 'ass', 'vtt']
+    return parse_extension(filename) in SUBTITLE_EXTENSIONS
 
 
 def parse_extension(filename):
     return os.path.splitext(filename)[1][1:]
 
 
+class Classification:
+    def __init__(self):
+        self.videos = []
+        self.subtitles = []
+        self.archives = []  # First volumes of the sets that finished downloading
+        self.incomplete_archives = False
+
+
+def classify(torrent):
+    # Sorts a torrent's files in one pass, however many episodes a season pack holds
+    c = Classification()
+    first_volumes = []
+    incomplete_sets = set()
+    for file in torrent.files().values():
+        if not file['selected']:
+            continue  # A deselected file never downloads, so it must not hold back the rest
+        name = file['name']
+        ext = parse_extension(name)
+        if ext in VIDEO_EXTENSIONS:
+            c.videos.append(file)
+        elif ext in SUBTITLE_EXTENSIONS:
+            c.subtitles.append(file)
+        else:
+            volume_set = archive.volume_set(name)
+            if volume_set is None:
+                continue
+            if file['completed'] < file['size']:
+                incomplete_sets.add(volume_set)  # The index may point into volumes we do not have yet
+            if archive.is_first_volume(name):
+                first_volumes.append(name)
+    c.archives = [name for name in first_volumes if archive.volume_set(name) not in incomplete_sets]
+    c.incomplete_archives = len(incomplete_sets) > 0
+    return c
+
+
 def forward_main_videos(torrent):
-    videos = [file for file in torrent.files().values() if is_video(file['name'])]
-    videos_by_size = sorted(videos, key=lambda v: v['size'], reverse=True)
-    if len(videos_by_size) > 0:
-        main_video = videos_by_size[0]
+    return main_videos(torrent.downloadDir, classify(torrent))
+
+
+def main_videos(download_dir, files):
+    if files.incomplete_archives:
+        return []  # Until every volume is there, the largest plain video may well be the sample
+    main_video = max(files.videos, key=lambda v: v['size']) if len(files.videos) > 0 else None
+    archived = largest_archived_video(download_dir, files.archives)
+    # A scene release packs the video and ships a small sample next to the archive
+    if archived is not None and (main_video is None or archived[1].size > main_video['size']):
+        name, entry = archived
+        dest = os.path.join(os.path.dirname(name), os.path.basename(entry.name))
+        return [{'download_dir': download_dir, 'filename': name, 'dest': dest, 'entry': entry.name}]
+    if main_video is not None:
         main_filename = main_video['name']
-        return [{'download_dir': torrent.downloadDir, 'filename': main_filename, 'dest': main_filename}]
+        return [{'download_dir': download_dir, 'filename': main_filename, 'dest': main_filename}]
     else:
         return []
 
 
+def archived_videos(download_dir, archives):
+    # (first volume, entry) of every video that can be streamed out of the archives
+    videos = []
+    for name in archives:
+        try:
+            entries = archive.index(download_dir + '/' + name)
+        except IOError as e:
+            print('Could not read archive ' + name + ': ' + str(e))
+            continue
+        videos.extend((name, entry) for entry in entries if is_video(entry.name) and entry.streamable)
+    return videos
+
+
+def largest_archived_video(download_dir, archives):
+    largest = None
+    for name, entry in archived_videos(download_dir, archives):
+        if largest is None or entry.size > largest[1].size:
+            largest = (name, entry)
+    return largest
+
+
 def forward_subtitles(torrent):
-    mappings = []
-    for file in torrent.files().values():
-        filename = file['name']
-        if is_subtitle(filename):
-            rule = {'download_dir': torrent.downloadDir, 'filename': filename, 'dest': filename}
-            mappings.append(rule)
-    return mappings
+    return subtitle_rules(torrent.downloadDir, classify(torrent))
+
+
+def subtitle_rules(download_dir, files):
+    return [{'download_dir': download_dir, 'filename': f['name'], 'dest': f['name']} for f in files.subtitles]
 
 
 def sidecar_subtitle(main_video, subtitles):
@@ -55,13 +126,9 @@ def has_sidecar(subtitles, video_dir):
 
 
 def sidecar_best_non_vobsub(subtitles, video_dir):
-    subs = list(subtitles)
-    for sub in subs:
-        sub['rank'] = rank_subtitle(sub)
-    ranked_subs = sorted(subs, key=lambda s: s['rank'], reverse=True)
-    if len(ranked_subs) <= 0:
+    if len(subtitles) <= 0:
         return []
-    best_sub = ranked_subs[0]
+    best_sub = max(subtitles, key=rank_subtitle)
     filename = best_sub['filename']
     basename = os.path.basename(filename)
     rule = {'download_dir': best_sub['download_dir'],
@@ -81,38 +148,41 @@ def rank_subtitle(subtitle):
         return 80
 
 
+@functools.lru_cache(maxsize=None)
+def word_pattern(words):
+    return re.compile(r'\b(' + '|'.join(words) + r')\b', re.IGNORECASE)
+
+
+ENGLISH = word_pattern(('english', 'eng', 'en'))
+SDH = word_pattern(('sdh',))
+VOBSUB_EXTENSIONS = frozenset(['idx', 'sub'])
+# S01E02, s1.e2 or 1x02, but not the 1920x1080 of a resolution
+EPISODE = re.compile(r'(?:^|[^a-z0-9])s(\d{1,2})[ ._-]?e(\d{1,3})|(?:^|[^0-9])(\d{1,2})x(\d{2,3})(?![0-9])',
+                     re.IGNORECASE)
+
+
 def is_english_subtitle(name):
-    return contains_any_word_ignoring_case(name, ['english', 'eng', 'en'])
+    return ENGLISH.match(name) is not None
 
 
 def is_sdh_subtitle(name):
-    return contains_any_word_ignoring_case(name, ['sdh'])
+    return SDH.match(name) is not None
 
 
 def contains_any_word_ignoring_case(line, words):
-    pattern = re.compile(r'\b(' + '|'.join(words) + r')\b', re.IGNORECASE)
-    return pattern.match(line) is not None
+    return word_pattern(tuple(words)).match(line) is not None
 
 
 def has_vobsub(subtitles):
-    has_idx = False
-    has_sub = False
-    for sub in subtitles:
-        ext = os.path.splitext(sub['filename'])[1][1:]
-        if ext == 'idx':
-            has_idx = True
-        if ext == 'sub':
-            has_sub = True
-    return has_idx and has_sub
+    return VOBSUB_EXTENSIONS <= set(parse_extension(sub['filename']) for sub in subtitles)
 
 
 def sidecar_vobsub(subtitles, video_dir):
     mappings = []
     for sub in subtitles:
         filename = sub['filename']
-        ext = os.path.splitext(filename)[1][1:]
         basename = os.path.basename(filename)
-        if ext in ['idx', 'sub']:
+        if parse_extension(filename) in VOBSUB_EXTENSIONS:
             rule = {'download_dir': sub['download_dir'],
                     'filename': filename,
                     'dest': video_dir + '/' + basename}
@@ -124,13 +194,62 @@ def move_to_dir(folder, files):
     mappings = []
     for f in files:
         rule = {'download_dir': f['download_dir'], 'filename': f['filename'], 'dest': folder + f['dest']}
+        if 'entry' in f:
+            rule['entry'] = f['entry']
         mappings.append(rule)
     return mappings
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_episode(path):
+    # (season, episode) of the file, named by the file itself or else by the folder holding it
+    for part in reversed(path.split('/')):
+        match = EPISODE.search(part)
+        if match is not None:
+            season, episode = (match.group(1), match.group(2)) if match.group(1) else (match.group(3), match.group(4))
+            return int(season), int(episode)
+    return None
+
+
+def map_season_pack(torrent, dest_dir):
+    files = classify(torrent)
+    download_dir = torrent.downloadDir
+    # (size, rule) of every candidate, scene packs ship an archive set per episode
+    candidates = [(v['size'], parse_episode(v['name']),
+                   {'download_dir': download_dir, 'filename': v['name'], 'dest': os.path.basename(v['name'])})
+                  for v in files.videos]
+    for name, entry in archived_videos(download_dir, files.archives):
+        basename = os.path.basename(entry.name)
+        candidates.append((entry.size, parse_episode(name + '/' + basename),
+                           {'download_dir': download_dir, 'filename': name, 'dest': basename, 'entry': entry.name}))
+    episodes = {}
+    for size, episode, rule in candidates:
+        # The largest file of an episode is the episode, anything else is a sample
+        if episode is not None and (episode not in episodes or size > episodes[episode][0]):
+            episodes[episode] = (size, rule)
+    if len(episodes) < 2:
+        return map_single_video(download_dir, files, dest_dir)
+    mappings = move_to_dir(dest_dir, [rule for _, (_, rule) in sorted(episodes.items())])
+    for sub in files.subtitles:
+        video = episodes.get(parse_episode(sub['name']))
+        if video is None:
+            continue
+        # Plex pairs a subtitle with the video whose name it starts with
+        stem = os.path.splitext(video[1]['dest'])[0]
+        basename = os.path.basename(sub['name'])
+        if not basename.startswith(stem):
+            basename = stem + '.' + basename
+        mappings.append({'download_dir': download_dir, 'filename': sub['name'], 'dest': dest_dir + basename})
+    return mappings
+
+
 def map_single_video_download_with_subs(torrent, dest_dir):
-    main_video = forward_main_videos(torrent)
-    subtitles = forward_subtitles(torrent)
+    return map_single_video(torrent.downloadDir, classify(torrent), dest_dir)
+
+
+def map_single_video(download_dir, files, dest_dir):
+    main_video = main_videos(download_dir, files)
+    subtitles = subtitle_rules(download_dir, files)
     sidecar_subs = sidecar_subtitle(main_video, subtitles)
     files = main_video + subtitles + sidecar_subs
     return move_to_dir(dest_dir, files)
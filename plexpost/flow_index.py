@@ -0,0 +1,49 @@
+EXACT = 'exact'
+PREFIX = 'prefix'
+
+
+class Node:
+    def __init__(self):
+        self.children = {}
+        self.exact = None  # Index of the first flow whose tag is exactly this path
+        self.prefix = None  # Index of the first flow accepting every path below this one
+
+
+class FlowIndex:
+    def __init__(self, flows):
+        # Built once from the flows' download_dir_tag, a lookup walks the download dir once whatever the flow count
+        self.flows = flows
+        self.root = Node()
+        self.opaque = []  # Flows that only offer a filter are asked one by one, in registration order
+        for idx, flow in enumerate(flows):
+            match = getattr(flow, 'match', None)
+            if match not in (EXACT, PREFIX):
+                self.opaque.append(idx)
+                continue
+            node = self.root
+            for c in flow.download_dir_tag:
+                node = node.children.setdefault(c, Node())
+            if match == EXACT and node.exact is None:
+                node.exact = idx
+            elif match == PREFIX and node.prefix is None:
+                node.prefix = idx
+
+    def lookup(self, torrent):
+        # Index of the first registered flow that accepts the torrent, None when none does
+        candidates = []
+        node = self.root
+        for c in torrent.downloadDir:
+            if node.prefix is not None:
+                candidates.append(node.prefix)
+            node = node.children.get(c)
+            if node is None:
+                break
+        if node is not None:
+            candidates.extend(i for i in (node.prefix, node.exact) if i is not None)
+        first = min(candidates) if len(candidates) > 0 else None
+        for idx in self.opaque:
+            if first is not None and idx > first:
+                break
+            if self.flows[idx].filter(torrent):
+                return idx
+        return first
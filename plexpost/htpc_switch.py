@@ -1,13 +1,44 @@
-import requests
+import threading
+import time
+
+from plexpost import lazy
+
+requests = lazy.Module('requests')
+exceptions = lazy.Module('requests.exceptions')
 
 
 class HTPCSwitch:
-    def __init__(self, url, token, switch_id):
+    def __init__(self, url, token, switch_id, timeout=5, state_ttl=60):
         self.url = url
         self.token = token
         self.switch_id = switch_id
+        self.timeout = timeout
+        self.state_ttl = state_ttl
+        self.http = None  # Created on the first call, so startup does not wait for requests to import
+        self.lock = threading.Lock()  # Flows waking the htpc at the same time share one call
+        self.turned_on = None
+
+    @property
+    def session(self):
+        if self.http is None:
+            self.http = requests.Session()
+            self.http.headers.update({'Authorization': 'Bearer ' + self.token})
+        return self.http
+
+    def api_url(self, path):
+        return 'http://' + self.url + ':8123/api/' + path
 
     def turn_on(self):
-        requests.post('http://' + self.url + ':8123/api/services/switch/turn_on',
-                      json={'entity_id': 'switch.' + self.switch_id},
-                      headers={'Authorization': 'Bearer ' + self.token})
+        # Called once the htpc did not answer, so whatever Home Assistant reports may be stale, e.g. it slept since.
+        # Only calls right after our own turn on share it while the htpc boots
+        with self.lock:
+            if self.turned_on is not None and time.monotonic() - self.turned_on < self.state_ttl:
+                return
+            try:
+                response = self.session.post(self.api_url('services/switch/turn_on'),
+                                             json={'entity_id': 'switch.' + self.switch_id},
+                                             timeout=self.timeout)
+                response.raise_for_status()
+                self.turned_on = time.monotonic()
+            except exceptions.RequestException as e:
+                print('Could not turn on htpc switch: ' + str(e))
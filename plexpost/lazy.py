@@ -0,0 +1,16 @@
+import importlib
+import threading
+
+
+class Module:
+    # Stands in for a module that is only imported when one of its attributes is first used
+    def __init__(self, name):
+        self._name = name
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        with self._lock:
+            module = importlib.import_module(self._name)
+        value = getattr(module, attr)
+        self.__dict__[attr] = value  # Later lookups skip the proxy
+        return value
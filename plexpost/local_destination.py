@@ -0,0 +1,154 @@
+import errno
+import fcntl
+import os
+import shutil
+
+from plexpost import destination, archive, transfer
+
+# ioctl that makes dest share the extents of src on btrfs, xfs and other copy on write filesystems
+FICLONE = 0x40049409
+COPY_CHUNK = 1024 * 1024 * 1024
+
+
+def hardlink(src, dest):
+    os.link(src, dest)
+
+
+def reflink(src, dest):
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            os.remove(dest)
+            raise
+
+
+def kernel_copy(src, dest):
+    # The data never passes through user space: copy_file_range (Python 3.8+) or sendfile do it in the kernel
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        size = os.fstat(s.fileno()).st_size
+        offset = 0
+        use_copy_file_range = hasattr(os, 'copy_file_range')
+        while offset < size:
+            count = min(COPY_CHUNK, size - offset)
+            if use_copy_file_range:
+                try:
+                    sent = os.copy_file_range(s.fileno(), d.fileno(), count, offset, offset)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    use_copy_file_range = False  # Older kernels cannot copy across filesystems
+                    continue
+            else:
+                os.lseek(d.fileno(), offset, os.SEEK_SET)
+                sent = os.sendfile(d.fileno(), s.fileno(), offset, count)
+            if sent == 0:
+                break
+            offset += sent
+        if offset != size:
+            raise IOError('size mismatch in copy!  ' + str(offset) + ' != ' + str(size))
+
+
+PLACEMENTS = {'link': hardlink, 'reflink': reflink, 'copy': kernel_copy}
+
+
+def place_file(src, dest, methods, before_copy=None):
+    # The file is placed next to its destination and renamed over it, so a failure never leaves a partial copy
+    part = dest + '.plexpost'
+    error = None
+    for method in methods:
+        if method == 'copy' and before_copy is not None:
+            before_copy()
+        if os.path.lexists(part):
+            os.remove(part)
+        try:
+            PLACEMENTS[method](src, part)
+        except OSError as e:
+            error = e
+            continue
+        os.replace(part, dest)
+        return method
+    raise error if error is not None else IOError('No placement method configured')
+
+
+def extract_file(src, entry, session, dest):
+    part = dest + '.plexpost'
+    with archive.open_entry(src, entry) as s, session.open(part, 'wb') as d:
+        shutil.copyfileobj(s, d, 4 * 1024 * 1024)
+    session.rename(part, dest)
+
+
+class LocalSession(destination.Session):
+    def __init__(self, local):
+        self.local = local
+
+    def path(self, path):
+        return os.path.join(self.local.path, path)
+
+    def stat(self, path):
+        try:
+            return os.stat(self.path(path))
+        except FileNotFoundError:
+            return None
+
+    def makedirs(self, path):
+        os.makedirs(self.path(path), exist_ok=True)
+
+    def open(self, path, mode='rb'):
+        return open(self.path(path), mode)
+
+    def rename(self, src, dest):
+        os.replace(self.path(src), self.path(dest))
+
+    def free_space(self):
+        stat = os.statvfs(self.local.path)
+        return stat.f_bavail * stat.f_frsize
+
+    def is_identical(self, planned, dest_stat):
+        # A hard link left by an earlier run is the source itself
+        return dest_stat is not None and planned.entry is None and \
+            (dest_stat.st_dev, dest_stat.st_ino) == (planned.stat.st_dev, planned.stat.st_ino)
+
+    def check_room(self, planned):
+        # A file admitted for a link may have to be copied after all
+        free = self.free_space() - self.local.free_space_reserve
+        if free < planned.stat.st_size:
+            raise transfer.InsufficientSpaceError('Not enough space for a copy of ' + planned.rule['filename'])
+
+    def send(self, planned, offset, throttle=None, checkpoint=None):
+        # Placing is all or nothing, there is never an offset to resume from
+        if planned.entry is not None:
+            extract_file(planned.src_file, planned.entry, self, planned.rule['dest'])
+            method = 'extract'
+        else:
+            method = place_file(planned.src_file, self.path(planned.rule['dest']), self.local.methods,
+                                lambda: self.check_room(planned))
+            if method == 'copy':
+                self.local.shares_blocks = False  # Later files are admitted with room for their copy
+        print('Placed ' + planned.rule['filename'] + ' (' + method + ')')
+        return planned.stat.st_size if method in ('copy', 'extract') else 0
+
+
+class LocalDestination(destination.Destination):
+    def __init__(self, conf):
+        self.path = conf['path']
+        self.name = self.path
+        self.location = self.path
+        self.methods = conf.get('methods', ['link', 'reflink', 'copy'])
+        self.transfer_workers = conf.get('transfer_workers', 1)
+        self.free_space_reserve = conf.get('free_space_reserve', 1024 * 1024 * 1024)
+        self.shares_blocks = 'link' in self.methods or 'reflink' in self.methods  # Until a placement falls back
+
+    def acquire(self):
+        return LocalSession(self)
+
+    def is_reachable(self, timeout=1):
+        return os.path.isdir(self.path)
+
+    def space_needed(self, planned, remaining):
+        # A link or a reflink shares the source's blocks, an archive entry always needs its own
+        if planned.entry is not None:
+            return remaining
+        if self.shares_blocks and os.stat(self.path).st_dev == planned.stat.st_dev:
+            return 0
+        return remaining
@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(k + '="' + v + '"' for k, v in escaped) + '}'
+
+
+def present(labels):
+    return dict((k, v) for k, v in labels.items() if v is not None)
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.trace = None
+
+    def count(self, name, value=1, **labels):
+        labels = present(labels)
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, phase, seconds, **labels):
+        labels = present(labels)
+        key = tuple(sorted(dict(labels, phase=phase).items()))
+        with self.lock:
+            count, total, longest = self.timings.get(key, (0, 0.0, 0.0))
+            self.timings[key] = (count + 1, total + seconds, max(longest, seconds))
+            if self.trace is not None:
+                event = dict(labels, phase=phase, seconds=round(seconds, 6), time=round(time.time(), 3))
+                self.trace.write(json.dumps(event, sort_keys=True) + '\n')
+                self.trace.flush()
+
+    @contextmanager
+    def timed(self, phase, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.monotonic() - start, **labels)
+
+    def open_trace(self, path):
+        with self.lock:
+            self.trace = open(path, 'a')
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+        lines = ['# TYPE plexpost_phase_seconds summary']
+        for labels, (count, total, _) in timings:
+            lines.append('plexpost_phase_seconds_sum' + format_labels(labels) + ' ' + repr(total))
+            lines.append('plexpost_phase_seconds_count' + format_labels(labels) + ' ' + str(count))
+        lines.append('# TYPE plexpost_phase_seconds_max gauge')
+        for labels, (_, _, longest) in timings:
+            lines.append('plexpost_phase_seconds_max' + format_labels(labels) + ' ' + repr(longest))
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE plexpost_' + name + ' counter')
+                typed.add(name)
+            lines.append('plexpost_' + name + format_labels(labels) + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+
+# Every component reports to the same registry, like the logs they print to
+registry = Registry()
+
+
+def count(name, value=1, **labels):
+    registry.count(name, value, **labels)
+
+
+def timed(phase, **labels):
+    return registry.timed(phase, **labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Every scrape would otherwise end up in the log
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, registry):
+        self.registry = registry
+        HTTPServer.__init__(self, address, MetricsHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
@@ -1,10 +1,11 @@
-from plexpost import file_mapper
+from plexpost import file_mapper, flow_index
 
 
 class MoviePostProcessor:
     def __init__(self, conf):
         self.download_dir_tag = conf['download_dir_tag']
         self.type = 'movie'
+        self.match = flow_index.EXACT
 
     def map_files(self, movie):
         return file_mapper.map_single_video_download_with_subs(movie, 'movies/')
@@ -0,0 +1,139 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from plexpost import post_processor, metrics
+
+
+class Pipeline:
+    def __init__(self, poller, poll_seconds, queue_size=16):
+        self.poller = poller
+        self.poll_seconds = poll_seconds
+        self.queue_size = queue_size
+        self.in_flight = set()
+        self.loop = None
+        self.signals = None
+        # The torrent source keeps state between calls, so every access to it goes through a single thread
+        self.source_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def run(self):
+        self.loop = asyncio.get_event_loop()
+        self.signals = asyncio.Queue()
+        self.signals.put_nowait(None)  # Start with a full poll
+        discovered, mapped, woken, transferred, verified = [asyncio.Queue(self.queue_size) for _ in range(5)]
+        stages = [self.discover(discovered),
+                  self.stage(self.map, discovered, mapped),
+                  self.stage(self.wake, mapped, woken),
+                  self.stage(self.verify, transferred, verified),
+                  self.finalize(verified)]
+        # Every woken batch goes straight to the transfer pool, whose shared queue decides what is sent first
+        stages.extend(self.stage(self.transfer, woken, transferred) for _ in range(self.queue_size))
+        await asyncio.gather(*stages)
+
+    def signal(self, ids):
+        # Called from the done listener thread; anything signalled before start up is caught by the first poll
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.signals.put_nowait, ids)
+
+    def blocking(self, fn, *args):
+        return self.loop.run_in_executor(None, fn, *args)
+
+    def on_source(self, fn, *args):
+        return self.loop.run_in_executor(self.source_executor, fn, *args)
+
+    async def discover(self, outbox):
+        # Signals must not push the full poll back, it also prunes torrents removed behind our back
+        next_poll = self.loop.time() + self.poll_seconds
+        while True:
+            try:
+                ids = await asyncio.wait_for(self.signals.get(), max(0, next_poll - self.loop.time()))
+            except asyncio.TimeoutError:
+                ids = None
+            if ids is None:
+                next_poll = self.loop.time() + self.poll_seconds
+            try:
+                with metrics.timed('poll'):
+                    if ids is None:
+                        torrents = await self.on_source(self.poller.source.current)
+                        self.poller.pending.intersection_update(t.id for t in torrents)
+                    else:
+                        torrents = await self.on_source(self.poller.source.fetch, ids)
+            except Exception as e:
+                print('Failed polling transmission: ' + str(e))
+                continue
+            for batch in self.batches(torrents):
+                await outbox.put(batch)
+
+    def batches(self, torrents):
+        # Every torrent travels on its own so it can be finalized as soon as its files are on the htpc
+        torrents = [t for t in torrents if t.id not in self.in_flight]
+        completed = [t for t in torrents if post_processor.is_completed(t)]
+        batches = []
+        for proc, claimed in zip(self.poller.processors, self.poller.claim(completed)):
+            batches.extend(post_processor.Batch(proc, [t]) for t in claimed)
+        if self.poller.stream_files:
+            downloading = [t for t in torrents if post_processor.is_partially_completed(t)]
+            for proc, claimed in zip(self.poller.processors, self.poller.claim(downloading)):
+                batches.extend(post_processor.Batch(proc, [t], partial=True) for t in claimed)
+        for b in batches:
+            self.in_flight.update(t.id for t in b.torrents)
+            if not b.partial:
+                self.poller.pending.update(t.id for t in b.torrents)
+        return batches
+
+    async def stage(self, step, inbox, outbox):
+        while True:
+            batch = await inbox.get()
+            try:
+                proceed = await step(batch)
+            except Exception as e:
+                print('Failed processing ' + ', '.join(t.name for t in batch.torrents) + ': ' + str(e))
+                proceed = False
+            if proceed and outbox is not None:
+                await outbox.put(batch)
+            else:
+                self.in_flight.difference_update(t.id for t in batch.torrents)  # Retried on a later poll
+
+    async def map(self, batch):
+        proc = batch.processor
+        if batch.partial:
+            batch.mappings = await self.blocking(proc.map_completed_files, batch.torrents)
+        else:
+            batch.mappings = await self.blocking(proc.map_files, batch.torrents)
+        batch.planned = await self.blocking(proc.transfer_pool.plan, batch.mappings, None, proc.media_processor.type)
+        return not batch.partial or len(batch.planned) > 0
+
+    async def wake(self, batch):
+        if len(batch.planned) > 0:
+            await self.blocking(batch.processor.wake_htpc)
+        return True
+
+    async def transfer(self, batch):
+        results = await self.blocking(batch.processor.transfer_to_htpc, batch.planned)
+        failures = [r.rule['filename'] for r in results if not r.succeeded and not r.deferred]
+        if len(failures) > 0:
+            print(str(len(failures)) + ' file(s) failed to transfer: ' + ', '.join(failures))
+        # Deferred files are retried on a later poll, once the remote has room
+        return all(r.succeeded for r in results)
+
+    async def verify(self, batch):
+        mismatched = await self.blocking(batch.processor.transfer_pool.verify, batch.planned)
+        if len(mismatched) > 0:
+            print('Remote copy does not match the source: ' + ', '.join(mismatched))
+            return False
+        return True
+
+    async def finalize(self, inbox):
+        while True:
+            batches = [await inbox.get()]
+            while not inbox.empty():
+                batches.append(inbox.get_nowait())  # Whatever verified meanwhile leaves Transmission in the same RPC
+            try:
+                await self.blocking(post_processor.finish_batches, [b for b in batches if not b.partial])
+                torrents = [t for b in batches if b.finalized for t in b.torrents]
+                if len(torrents) > 0:
+                    await self.on_source(self.poller.source.forget, torrents)
+                    self.poller.pending.difference_update(t.id for t in torrents)
+            except Exception as e:
+                print('Failed finalizing ' + ', '.join(t.name for b in batches for t in b.torrents) + ': ' + str(e))
+            for b in batches:
+                self.in_flight.difference_update(t.id for t in b.torrents)
@@ -1,4 +1,12 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from plexpost import transfer, metrics, lazy
+
+transmissionrpc = lazy.Module('transmissionrpc')
+
+# Only the fields read by the flows, Torrent.progress and Torrent.files()
+TORRENT_FIELDS = ['id', 'name', 'downloadDir', 'sizeWhenDone', 'leftUntilDone', 'files', 'priorities', 'wanted']
 
 
 def path_traversals(path):
@@ -42,55 +50,207 @@ def cleanup_torrent_data(torrents):
     cleanup_empty_dirs(torrents)
 
 
+def is_completed(torrent):
+    return torrent.progress >= 100.0
+
+
+def get_completed_torrents(transmission):
+    return [t for t in transmission.get_torrents(arguments=TORRENT_FIELDS) if is_completed(t)]
+
+
+def is_file_completed(file):
+    return file['selected'] and file['completed'] >= file['size']
+
+
+def completed_files(torrent):
+    return set(f['name'] for f in torrent.files().values() if is_file_completed(f))
+
+
+def is_partially_completed(torrent):
+    return not is_completed(torrent) and len(completed_files(torrent)) > 0
+
+
+class Batch:
+    def __init__(self, processor, torrents, partial=False):
+        self.processor = processor
+        self.torrents = torrents
+        self.partial = partial  # Only the finished files are uploaded, the torrent itself stays in the client
+        self.mappings = []
+        self.planned = []
+        self.finalized = False
+
+
+def describe(batch):
+    return str(batch.processor.media_processor.type) + ' ' + ', '.join(str(t.name) for t in batch.torrents)
+
+
+def isolated(batches, step):
+    # One broken download, e.g. an unreadable file or a corrupt archive, must not hold back the other flows
+    kept = []
+    for b in batches:
+        try:
+            step(b)
+            kept.append(b)
+        except Exception as e:
+            print('Failed processing ' + describe(b) + ': ' + str(e))
+    return kept
+
+
+def finish_batches(batches):
+    # Every finished torrent leaves Transmission in one RPC, whichever flow it came from
+    if len(batches) == 0:
+        return
+    lead = batches[0].processor
+    if not lead.delete_data or not lead.remove_with_data([t for b in batches for t in b.torrents]):
+        batches = isolated(batches, lambda b: b.processor.clean_up(b.torrents))
+        torrents = [t for b in batches for t in b.torrents]
+        if len(torrents) > 0:
+            lead.remove_torrents_from_client(torrents)
+    for b in batches:
+        b.processor.finished(b)
+        b.finalized = True
+
+
+def process_batches(batches):
+    batches = [b for b in batches if len(b.torrents) > 0]
+
+    def map_partial(b):
+        if b.partial:
+            b.mappings = b.processor.map_completed_files(b.torrents)
+    batches = isolated(batches, map_partial)
+    # Still downloading torrents are polled every tick, so only wake the htpc when they have something new
+    batches = [b for b in batches if not b.partial or len(b.mappings) > 0]
+    if len(batches) == 0:
+        return
+    # Flows processed together share one htpc switch and transfer pool, so the first flow drives them
+    lead = batches[0].processor
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The htpc boots while the batches are mapped and their sources are examined
+        wake = executor.submit(lead.wake_htpc)
+
+        def plan(b):
+            if not b.partial:
+                b.mappings = b.processor.map_files(b.torrents)
+            b.planned = lead.transfer_pool.plan(b.mappings, wake, b.processor.media_processor.type)
+        batches = isolated(batches, plan)
+        wake.result()
+    if len(batches) == 0:
+        return
+    results = batches[0].processor.transfer_to_htpc([p for b in batches for p in b.planned])
+    unfinished = dict((id(r.rule), r) for r in results if not r.succeeded)
+    failures = []
+    done = []
+    for b in batches:
+        missing = [unfinished[id(p.rule)] for p in b.planned if id(p.rule) in unfinished]
+        failed = [r.rule['filename'] for r in missing if not r.deferred]
+        if len(failed) > 0:
+            failures.extend(failed)
+            metrics.count('retries_total', operation='transfer', flow=b.processor.media_processor.type)
+        elif len(missing) > 0:
+            continue  # Stays queued until the remote has room for the rest of the flow
+        elif not b.partial:
+            done.append(b)
+    finish_batches(done)
+    if len(failures) > 0:
+        raise transfer.TransferError(str(len(failures)) + ' file(s) failed to transfer: ' + ', '.join(failures))
+
+
 class PostProcessor:
     def __init__(self,
                  transmission,
                  htpc_switch,
-                 sftp_factory,
-                 media_processor):
+                 destination,
+                 media_processor,
+                 transfer_pool=None,
+                 delete_data=False):
         self.transmission = transmission
         self.htpc = htpc_switch
-        self.sftp_factory = sftp_factory
+        self.destination = destination
         self.media_processor = media_processor
+        # Without a shared pool the connection only lives for the duration of a transfer
+        self.owns_connections = transfer_pool is None
+        if transfer_pool is None:
+            transfer_pool = transfer.TransferPool(destination, destination.transfer_workers)
+        self.transfer_pool = transfer_pool
+        self.delete_data = delete_data
 
     def run(self):
-        completed_torrents = self.get_completed_torrents()
-        torrents = [t for t in completed_torrents if self.media_processor.filter(t)]
+        self.process(self.get_completed_torrents())
+
+    def process(self, completed_torrents):
+        batch = self.select(completed_torrents)
+        process_batches([batch])
+        return batch.torrents
+
+    def select(self, completed_torrents):
+        with metrics.timed('filter', flow=self.media_processor.type):
+            torrents = [t for t in completed_torrents if self.media_processor.filter(t)]
         print('Found ' + str(len(torrents)) + ' ' + self.media_processor.type + '(s)')
+        return Batch(self, torrents)
+
+    def select_partial(self, downloading_torrents):
+        return Batch(self, [t for t in downloading_torrents if self.media_processor.filter(t)], partial=True)
+
+    def map_files(self, torrents):
         mappings = []
-        for t in torrents:
-            print('  ' + t.name)
-            mappings.extend(self.media_processor.map_files(t))
-        if len(torrents) > 0:
+        with metrics.timed('map', flow=self.media_processor.type):
+            for t in torrents:
+                print('  ' + t.name)
+                mappings.extend(self.media_processor.map_files(t))
+        return mappings
+
+    def map_completed_files(self, torrents):
+        mappings = []
+        with metrics.timed('map', flow=self.media_processor.type):
+            for t in torrents:
+                done = completed_files(t)
+                pending = [rule for rule in self.media_processor.map_files(t)
+                           if rule['filename'] in done and not self.transfer_pool.is_transferred(rule)]
+                if len(pending) > 0:
+                    print('  ' + t.name + ' (' + str(len(pending)) + ' finished file(s))')
+                mappings.extend(pending)
+        return mappings
+
+    def wake_htpc(self):
+        with metrics.timed('wake'):
+            if self.destination.is_reachable():
+                return
             print('Waking htpc')
             self.htpc.turn_on()
-        self.transfer_to_htpc(mappings)
-        cleanup_torrent_data(torrents)
-        self.remove_torrents_from_client(torrents)
 
-    def remove_torrents_from_client(self, torrents):
-        for t in torrents:
-            self.transmission.remove_torrent(t.id)
+    def finish(self, batch):
+        finish_batches([batch])
+
+    def finished(self, batch):
+        self.transfer_pool.forget([rule['dest'] for rule in batch.mappings])
+        metrics.count('torrents_total', len(batch.torrents), flow=self.media_processor.type)
+
+    def remove_with_data(self, torrents):
+        # False when the data is left for us to clean up
+        try:
+            self.remove_torrents_from_client(torrents, delete_data=True)
+            return True
+        except transmissionrpc.TransmissionError as e:
+            print('Transmission could not remove the downloaded data, cleaning up locally: ' + str(e))
+            return False
+
+    def clean_up(self, torrents):
+        with metrics.timed('cleanup', flow=self.media_processor.type):
+            cleanup_torrent_data(torrents)
+
+    def remove_torrents_from_client(self, torrents, delete_data=False):
+        with metrics.timed('removal', flow=self.media_processor.type):
+            self.transmission.remove_torrent([t.id for t in torrents], delete_data=delete_data)
 
     def get_completed_torrents(self):
-        torrents = [t for t in self.transmission.get_torrents() if t.progress >= 100.0]
-        return torrents
-
-    def transfer_to_htpc(self, mappings):
-        if len(mappings) == 0:
-            return
-        with self.sftp_factory.await_connection() as sftp:
-            for rule in mappings:
-                # Skip if file is missing
-                file = rule['filename']
-                src_file = rule['download_dir'] + '/' + file
-                if not os.path.isfile(src_file):
-                    continue
-
-                dest_file = rule['dest']
-                print('Transferring ' + file + ' to remote')
-                remote_dir = os.path.dirname(dest_file)
-                if len(remote_dir) > 0:
-                    sftp.makedirs(remote_dir)
-                sftp.put(src_file, dest_file)
-                print('Completed transferring ' + file)
+        with metrics.timed('poll'):
+            return get_completed_torrents(self.transmission)
+
+    def transfer_to_htpc(self, planned):
+        if len(planned) == 0:
+            return []
+        try:
+            return self.transfer_pool.transfer_planned(planned)
+        finally:
+            if self.owns_connections:
+                self.transfer_pool.destination.close()
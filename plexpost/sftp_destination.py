@@ -0,0 +1,284 @@
+import posixpath
+import shlex
+from collections import deque
+from contextlib import ExitStack
+
+from plexpost import destination, connection_pool, dedup, archive, delta, lazy
+
+paramiko = lazy.Module('paramiko')
+
+
+def remote_makedirs(sftp, path):
+    current = ''
+    for d in [d for d in path.split('/') if len(d) > 0]:
+        current = current + '/' + d if len(current) > 0 else d
+        try:
+            sftp.stat(current)
+        except IOError:
+            try:
+                sftp.mkdir(current)
+            except IOError:
+                sftp.stat(current)  # Another channel may have created it in the meantime
+
+
+def remote_file_stat(sftp, path):
+    try:
+        return sftp.stat(path)
+    except IOError:
+        return None
+
+
+def remote_free_space(sftp, path):
+    # Bytes we may still write to the remote filesystem holding path, None when the remote cannot tell
+    try:
+        t, msg = sftp._request(paramiko.sftp.CMD_EXTENDED, 'statvfs@openssh.com', path)
+        if t == paramiko.sftp.CMD_EXTENDED_REPLY:
+            msg.get_int64()  # f_bsize
+            fragment_size = msg.get_int64()
+            msg.get_int64()  # f_blocks
+            msg.get_int64()  # f_bfree
+            return msg.get_int64() * fragment_size  # f_bavail
+    except IOError:
+        pass  # Only OpenSSH servers offer the extension
+    return df_free_space(sftp.get_channel().get_transport(), path)
+
+
+def df_free_space(transport, path):
+    try:
+        channel = transport.open_session()
+    except paramiko.SSHException:
+        return None
+    try:
+        channel.exec_command('df -Pk -- ' + shlex.quote(path))
+        channel.shutdown_write()
+        output = channel.makefile('rb').read().decode()
+        if channel.recv_exit_status() != 0:
+            return None
+    except paramiko.SSHException:
+        return None
+    finally:
+        channel.close()
+    try:
+        return int(output.strip().splitlines()[-1].split()[3]) * 1024
+    except (IndexError, ValueError):
+        return None
+
+
+class PipelinedWriter:
+    # Drives paramiko's request layer directly: SFTPFile only bounds its pipeline loosely and sends small requests
+    def __init__(self, sftp, handle, depth, offset=0):
+        self.sftp = sftp
+        self.handle = handle
+        self.depth = depth
+        self.pending = deque()
+        self.early_responses = {}
+        self.confirmed = offset  # Every byte before this offset has been acknowledged by the server
+
+    def _async_response(self, t, msg, num):
+        # Called by paramiko for a response that arrived while we were waiting for an older request
+        self.early_responses[num] = (t, msg)
+
+    def write(self, offset, data):
+        num = self.sftp._async_request(self, paramiko.sftp.CMD_WRITE, self.handle, paramiko.sftp.int64(offset),
+                                       data)
+        self.pending.append((num, offset + len(data)))
+        if len(self.pending) >= self.depth:
+            self.wait_oldest()
+
+    def wait_oldest(self):
+        num, end = self.pending.popleft()
+        if num in self.early_responses:
+            t, msg = self.early_responses.pop(num)
+            if t == paramiko.sftp.CMD_STATUS:
+                self.sftp._convert_status(msg)
+        else:
+            self.sftp._read_response(num)
+        self.confirmed = end
+
+    def flush(self):
+        while len(self.pending) > 0:
+            self.wait_oldest()
+
+
+class RemoteCopy:
+    def __init__(self, sftp, dest_file, offset=0, checkpoint=None, throttle=None):
+        self.sftp = sftp
+        self.dest_file = dest_file
+        self.offset = offset
+        self.checkpoint = checkpoint
+        self.throttle = throttle
+        self.writer = None
+        self.error = None
+
+
+def close_copy(copy, dest):
+    try:
+        dest.close()
+    except Exception as e:
+        if copy.error is None:
+            copy.error = e
+
+
+def write_fanout(src_file, copies, block_size, request_size, depth, entry=None):
+    # Reads the source once and streams every block to all copies, each resuming from its own offset
+    start = min(c.offset for c in copies)
+    size = start
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with ExitStack() as stack:
+        src = stack.enter_context(archive.open_source(src_file, entry))
+        src.seek(start)
+        for c in copies:
+            try:
+                # Resuming keeps the bytes already on the remote instead of truncating them
+                dest = c.sftp.open(c.dest_file, 'r+b' if c.offset > 0 else 'wb')
+                stack.callback(close_copy, c, dest)
+                c.writer = PipelinedWriter(c.sftp, dest.handle, depth, c.offset)
+            except Exception as e:
+                c.error = e
+        while True:
+            read = src.readinto(buf)
+            if not read:
+                break
+            for c in copies:
+                if c.error is None:
+                    try:
+                        skip = max(0, c.offset - size)
+                        if c.throttle is not None and skip < read:
+                            c.throttle(read - skip)
+                        for begin in range(skip, read, request_size):
+                            end = min(begin + request_size, read)
+                            c.writer.write(size + begin, bytes(view[begin:end]))
+                        if c.checkpoint is not None:
+                            c.checkpoint(c.writer.confirmed)
+                    except Exception as e:
+                        c.error = e  # One failing remote must not hold back the others
+            size += read
+        for c in copies:
+            if c.error is None:
+                try:
+                    c.writer.flush()
+                except Exception as e:
+                    c.error = e
+    for c in copies:
+        if c.error is None:
+            try:
+                check_remote_size(c.sftp, c.dest_file, size, c.offset > 0)
+            except Exception as e:
+                c.error = e
+
+
+def check_remote_size(sftp, dest_file, size, resumed):
+    remote_size = sftp.stat(dest_file).st_size
+    if resumed and remote_size > size:
+        sftp.truncate(dest_file, size)  # Drop whatever an interrupted run wrote past the source's end
+        remote_size = size
+    if remote_size != size:
+        raise IOError('size mismatch in put!  ' + str(remote_size) + ' != ' + str(size))
+
+
+def write_pipelined(sftp, src_file, dest_file, block_size, request_size, depth, offset=0, checkpoint=None,
+                    throttle=None, entry=None):
+    copy = RemoteCopy(sftp, dest_file, offset, checkpoint, throttle)
+    write_fanout(src_file, [copy], block_size, request_size, depth, entry)
+    if copy.error is not None:
+        raise copy.error
+
+
+def put_throttled(sftp, src_file, dest_file, throttle):
+    # paramiko reports progress after every write, which is where the throttle holds it back
+    sent = [0]
+
+    def progress(transferred, total):
+        throttle(transferred - sent[0])
+        sent[0] = transferred
+    sftp.put(src_file, dest_file, callback=progress)
+
+
+class SFTPSession(destination.Session):
+    def __init__(self, sftp, sftp_destination):
+        self.sftp = sftp
+        self.destination = sftp_destination
+        self.factory = sftp_destination.factory
+
+    def stat(self, path):
+        return remote_file_stat(self.sftp, path)
+
+    def makedirs(self, path):
+        remote_makedirs(self.sftp, path)
+
+    def open(self, path, mode='rb'):
+        return self.sftp.open(path, mode)
+
+    def rename(self, src, dest):
+        self.sftp.posix_rename(src, dest)
+
+    def free_space(self):
+        return remote_free_space(self.sftp, self.sftp.normalize('.'))
+
+    def is_identical(self, planned, dest_stat):
+        return self.destination.deduplicator.is_identical(self.sftp, planned, dest_stat)
+
+    def completed(self, planned):
+        self.destination.deduplicator.uploaded(self.sftp, planned)
+
+    def send(self, planned, offset, throttle=None, checkpoint=None):
+        factory = self.factory
+        dest_file = planned.rule['dest']
+        if offset == 0 and factory.delta and planned.stat.st_size >= factory.large_file_threshold:
+            sent = self.send_delta(planned, throttle)
+            if sent is not None:
+                return sent
+        # put only takes plain files, archive entries are always streamed
+        if offset > 0 or planned.stat.st_size >= factory.large_file_threshold or planned.entry is not None:
+            write_pipelined(self.sftp, planned.src_file, dest_file, factory.block_size, factory.request_size,
+                            factory.pipeline_depth, offset, checkpoint, throttle, planned.entry)
+        elif throttle is not None:
+            put_throttled(self.sftp, planned.src_file, dest_file, throttle)
+        else:
+            self.sftp.put(planned.src_file, dest_file)
+        return planned.stat.st_size - offset
+
+    def send_delta(self, planned, throttle=None):
+        # Returns the bytes sent, or None when the file has to be sent whole
+        dest_file = planned.rule['dest']
+        remote_stat = remote_file_stat(self.sftp, dest_file)
+        if remote_stat is None or remote_stat.st_size == 0:
+            return None  # Nothing to build on
+        factory = self.factory
+        try:
+            sent = delta.transfer(self.sftp.get_channel().get_transport(),
+                                  posixpath.join(factory.remote_dir, dest_file), planned.src_file, planned.entry,
+                                  delta.block_size_for(planned.stat.st_size, factory.delta_block_size), throttle,
+                                  factory.delta_min_rate)
+        except delta.DeltaError as e:
+            print('Sending ' + planned.rule['filename'] + ' whole, no delta: ' + str(e))
+            return None
+        print('Sent ' + planned.rule['filename'] + ' as a delta of ' + str(sent) + ' bytes')
+        return sent
+
+
+class SFTPDestination(destination.Destination):
+    def __init__(self, factory, connections=None):
+        self.factory = factory
+        self.connections = connection_pool.ConnectionPool(factory) if connections is None else connections
+        self.deduplicator = dedup.Deduplicator(factory.dedup, factory.remote_dir, factory.block_size)
+        self.name = factory.name
+        self.location = factory.location
+        self.transfer_workers = factory.transfer_workers
+        self.free_space_reserve = factory.free_space_reserve
+
+    def acquire(self):
+        return SFTPSession(self.connections.acquire(), self)
+
+    def release(self, session, healthy=True):
+        self.connections.release(session.sftp, healthy)
+
+    def is_reachable(self, timeout=1):
+        return self.factory.is_reachable(timeout)
+
+    def prepare(self, planned, until=None):
+        self.deduplicator.prepare(planned, until)
+
+    def close(self):
+        self.connections.close()
@@ -1,29 +1,85 @@
+import socket
 import time
 
-import pysftp
-from paramiko import SSHException
+from plexpost import metrics, lazy
+
+paramiko = lazy.Module('paramiko')
+
+
+def load_private_key(path):
+    for key_class in [paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key]:
+        try:
+            return key_class.from_private_key_file(path)
+        except paramiko.SSHException:
+            pass
+    raise paramiko.SSHException('Unsupported private key ' + path)
 
 
 class SFTPFactory:
     def __init__(self, config):
         self.url = config['url']
+        self.name = config.get('name', config['url'])
         self.port = config['port']
         self.username = config['username']
         self.password = config.get('password')
         self.private_key_path = config.get('key_path')
         self.remote_dir = config['remote_dir']
+        self.location = self.url + ':' + str(self.port) + ':' + self.remote_dir  # Tells targets on one host apart
+        self.transfer_workers = config.get('transfer_workers', 1)
+        self.window_size = config.get('window_size', 2097152)
+        self.max_packet_size = config.get('max_packet_size', 32768)
+        self.large_file_threshold = config.get('large_file_threshold', 64 * 1024 * 1024)
+        self.block_size = config.get('block_size', 4 * 1024 * 1024)
+        self.request_size = config.get('request_size', 32 * 1024)
+        self.pipeline_depth = config.get('pipeline_depth', 64)
+        self.keepalive_seconds = config.get('keepalive_seconds', 30)
+        self.health_check_timeout = config.get('health_check_timeout', 5)
+        self.dedup = config.get('dedup', 'none')
+        self.wake_timeout = config.get('wake_timeout', 120)
+        self.free_space_reserve = config.get('free_space_reserve', 1024 * 1024 * 1024)
+        self.delta = config.get('delta', False)
+        self.delta_block_size = config.get('delta_block_size', 64 * 1024)
+        self.delta_min_rate = config.get('delta_min_rate', 8 * 1024 * 1024)
 
     def connect(self):
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        connection = pysftp.Connection(self.url, port=self.port, username=self.username, password=self.password,
-                                       private_key=self.private_key_path, cnopts=cnopts)
-        connection.chdir(self.remote_dir)
-        return connection
+        transport = paramiko.Transport((self.url, self.port), default_window_size=self.window_size,
+                                       default_max_packet_size=self.max_packet_size)
+        try:
+            pkey = load_private_key(self.private_key_path) if self.private_key_path else None
+            transport.connect(username=self.username, password=self.password, pkey=pkey)
+        except Exception:
+            transport.close()
+            raise
+        return transport
+
+    def is_reachable(self, timeout=1):
+        try:
+            socket.create_connection((self.url, self.port), timeout=timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def await_reachable(self):
+        deadline = time.monotonic() + self.wake_timeout
+        delay = 0.5
+        while not self.is_reachable():
+            if time.monotonic() >= deadline:
+                raise paramiko.SSHException(self.url + ' did not become reachable within ' + str(self.wake_timeout) +
+                                            's')
+            time.sleep(delay)  # Wait for remote to awaken
+            delay = min(delay * 2, 8)
 
     def await_connection(self):
-        for idx in range(0, 30):
+        self.await_reachable()
+        for idx in range(0, 5):
             try:
                 return self.connect()
-            except SSHException:
-                time.sleep(1)  # Wait for remote to awaken
+            except (paramiko.SSHException, OSError):
+                metrics.count('retries_total', operation='connect')
+                time.sleep(1)  # sshd can accept connections a little before it is ready to serve them
+        return self.connect()
+
+    def open_sftp(self, transport):
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        sftp.chdir(self.remote_dir)
+        return sftp
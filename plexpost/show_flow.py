@@ -1,4 +1,4 @@
-from plexpost import file_mapper
+from plexpost import file_mapper, flow_index
 
 
 def parse_show_name_from_download_dir(show):
@@ -13,11 +13,15 @@ class ShowPostProcessor:
     def __init__(self, conf):
         self.download_dir_tag = conf['download_dir_tag']
         self.type = 'show'
+        self.match = flow_index.PREFIX
+        self.season_packs = conf.get('season_packs', False)
 
     def map_files(self, show):
         show_name = parse_show_name_from_download_dir(show)
         season = parse_season_number_from_download_dir(show)
         dest_dir = 'tv/' + show_name + '/' + season + '/'
+        if self.season_packs:
+            return file_mapper.map_season_pack(show, dest_dir)
         return file_mapper.map_single_video_download_with_subs(show, dest_dir)
 
     def filter(self, torrent):
@@ -0,0 +1,35 @@
+import json
+import os
+
+VERSION = 1
+
+
+def load(path):
+    # A missing, unreadable or outdated snapshot only means a cold start
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print('Ignoring snapshot ' + path + ': ' + str(e))
+        return {}
+    if not isinstance(state, dict) or state.get('version') != VERSION:
+        print('Ignoring snapshot ' + path + ' written by another version')
+        return {}
+    return state
+
+
+def save(path, state):
+    if not path:
+        return
+    part = path + '.part'
+    try:
+        with open(part, 'w') as f:
+            json.dump(dict(state, version=VERSION), f)
+        os.replace(part, path)
+        print('Saved snapshot to ' + path)
+    except (OSError, TypeError, ValueError) as e:
+        print('Could not save snapshot ' + path + ': ' + str(e))
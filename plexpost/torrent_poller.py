@@ -0,0 +1,183 @@
+import json
+import threading
+import time
+
+from plexpost import post_processor, metrics, flow_index, lazy
+
+transmissionrpc = lazy.Module('transmissionrpc')
+
+# Transmission only reports torrents active within this many seconds as recently active
+RECENTLY_ACTIVE_SECONDS = 60
+# Delta polls run well inside that window, so scheduling jitter never turns one into a full sync
+DELTA_POLL_SECONDS = 30
+# Enough to tell whether a restored torrent changed while we were down, without the per-file lists
+LISTING_FIELDS = ['id', 'name', 'downloadDir', 'sizeWhenDone', 'leftUntilDone']
+
+
+def get_recently_active_torrents(transmission):
+    # transmissionrpc cannot express the 'recently-active' id set, nor does it return the removed ids
+    query = json.dumps({'method': 'torrent-get',
+                        'arguments': {'fields': post_processor.TORRENT_FIELDS, 'ids': 'recently-active'}})
+    data = json.loads(transmission._http_query(query))
+    if data.get('result') != 'success':
+        raise transmissionrpc.TransmissionError('Query failed with result "' + str(data.get('result')) + '".')
+    arguments = data['arguments']
+    torrents = [transmissionrpc.Torrent(transmission, item) for item in arguments['torrents']]
+    return torrents, arguments.get('removed', [])
+
+
+def poll_interval(source, poll_seconds):
+    # A source that polls deltas sets its own, shorter interval
+    return poll_seconds if source.poll_seconds is None else min(poll_seconds, source.poll_seconds)
+
+
+class FullTorrentSource:
+    def __init__(self, transmission):
+        self.transmission = transmission
+        self.poll_seconds = None
+
+    def current(self):
+        return self.transmission.get_torrents(arguments=post_processor.TORRENT_FIELDS)
+
+    def completed(self):
+        return [t for t in self.current() if post_processor.is_completed(t)]
+
+    def fetch(self, ids):
+        return self.transmission.get_torrents(ids, arguments=post_processor.TORRENT_FIELDS)
+
+    def forget(self, torrents):
+        pass
+
+    def snapshot(self):
+        return {}
+
+    def restore(self, state):
+        pass
+
+
+class IncrementalTorrentSource:
+    def __init__(self, transmission, full_sync_ticks, poll_seconds=DELTA_POLL_SECONDS):
+        if poll_seconds >= RECENTLY_ACTIVE_SECONDS:
+            raise ValueError('transmission.delta_poll_seconds must be below ' + str(RECENTLY_ACTIVE_SECONDS) +
+                             ', Transmission forgets older activity')
+        self.transmission = transmission
+        self.full_sync_ticks = full_sync_ticks
+        self.poll_seconds = poll_seconds
+        self.torrents = {}
+        self.ticks = 0
+        self.restored = False
+        self.last_sync = None  # When the last successful request was sent
+
+    def current(self):
+        self.refresh()
+        return list(self.torrents.values())
+
+    def completed(self):
+        return [t for t in self.current() if post_processor.is_completed(t)]
+
+    def refresh(self):
+        # A periodic full sync catches anything the delta misses, e.g. torrents removed while we were down. A poll
+        # that comes later than the recently active window, e.g. after a long transfer, syncs in full as well
+        started = time.monotonic()
+        stale = self.last_sync is None or started - self.last_sync > RECENTLY_ACTIVE_SECONDS
+        if self.restored:
+            self.reconcile()
+        elif stale or self.ticks % self.full_sync_ticks == 0:
+            torrents = self.transmission.get_torrents(arguments=post_processor.TORRENT_FIELDS)
+            self.torrents = {t.id: t for t in torrents}
+        else:
+            torrents, removed = get_recently_active_torrents(self.transmission)
+            for t in torrents:
+                self.torrents[t.id] = t
+            for torrent_id in removed:
+                self.torrents.pop(torrent_id, None)
+        self.last_sync = started
+        self.ticks += 1
+
+    def fetch(self, ids):
+        torrents = self.transmission.get_torrents(ids, arguments=post_processor.TORRENT_FIELDS)
+        for t in torrents:
+            self.torrents[t.id] = t
+        return torrents
+
+    def forget(self, torrents):
+        for t in torrents:
+            self.torrents.pop(t.id, None)
+
+    def reconcile(self):
+        # Torrents may have been added, finished or removed while we were down, only those are fetched in full
+        listed = self.transmission.get_torrents(arguments=LISTING_FIELDS)
+        known = self.torrents
+        self.torrents = {t.id: known[t.id] for t in listed if t.id in known}
+        changed = [t.id for t in listed
+                   if t.id not in known or any(getattr(t, f) != getattr(known[t.id], f) for f in LISTING_FIELDS)]
+        if len(changed) > 0:
+            self.fetch(changed)
+        self.restored = False
+
+    def snapshot(self):
+        return {'torrents': [dict((k, f.value) for k, f in t._fields.items()) for t in list(self.torrents.values())]}
+
+    def restore(self, state):
+        torrents = state.get('torrents', [])
+        if len(torrents) == 0:
+            return
+        self.torrents = {t.id: t for t in (transmissionrpc.Torrent(self.transmission, f) for f in torrents)}
+        self.ticks = 1  # The first poll reconciles the restored table instead of listing every torrent in full
+        self.restored = True
+
+
+class TorrentPoller:
+    def __init__(self, source, processors, stream_files=False):
+        self.source = source
+        self.processors = processors
+        self.index = flow_index.FlowIndex([p.media_processor for p in processors])
+        self.stream_files = stream_files
+        self.lock = threading.Lock()  # The interval job and the done listener may fire at the same time
+        self.pending = set()  # Torrents claimed by a flow whose transfers have not finished yet
+
+    def run(self):
+        with self.lock:
+            with metrics.timed('poll'):
+                torrents = self.source.current()
+            self.pending.intersection_update(t.id for t in torrents)
+            self.dispatch(torrents)
+
+    def run_torrents(self, ids):
+        with self.lock:
+            with metrics.timed('poll'):
+                torrents = self.source.fetch(ids)
+            self.dispatch(torrents)
+
+    def dispatch(self, torrents):
+        claims = self.claim([t for t in torrents if post_processor.is_completed(t)])
+        # Every flow's files go through one transfer queue so small and urgent files are never stuck behind another flow
+        batches = [proc.select(claimed) for proc, claimed in zip(self.processors, claims)]
+        if self.stream_files:
+            downloading = self.claim([t for t in torrents if post_processor.is_partially_completed(t)])
+            batches.extend(proc.select_partial(claimed) for proc, claimed in zip(self.processors, downloading))
+        self.pending.update(t.id for b in batches if not b.partial for t in b.torrents)
+        try:
+            post_processor.process_batches(batches)
+        finally:
+            for b in batches:
+                if b.finalized:
+                    self.source.forget(b.torrents)
+                    self.pending.difference_update(t.id for t in b.torrents)
+
+    def snapshot(self):
+        # Taken at shutdown without the lock, a transfer still running must not hold it up
+        return {'source': self.source.snapshot(), 'pending': sorted(self.pending.copy())}
+
+    def restore(self, state):
+        self.source.restore(state.get('source', {}))
+        self.pending = set(state.get('pending', []))
+
+    def claim(self, torrents):
+        # Each torrent goes to the first registered flow that accepts it so flows never share a download
+        claims = [[] for _ in self.processors]
+        for t in torrents:
+            idx = self.index.lookup(t)
+            if idx is not None:
+                claims[idx].append(t)
+        return claims
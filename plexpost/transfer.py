@@ -0,0 +1,337 @@
+import os
+import stat
+import threading
+
+from plexpost import transfer_journal, transfer_queue, metrics, archive
+
+# How much confirmed data may be lost, and so re-sent, when an upload is interrupted
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+class InsufficientSpaceError(TransferError):
+    pass
+
+
+def source_path(rule):
+    return rule['download_dir'] + '/' + rule['filename']
+
+
+class PlannedFile:
+    def __init__(self, rule, src_stat, flow=None):
+        self.rule = rule
+        self.flow = flow
+        self.src_file = source_path(rule)
+        self.entry = rule.get('entry')  # Set when the file is streamed out of an archive
+        self.stat = src_stat
+        self.sha256 = None
+
+
+class TransferResult:
+    def __init__(self, rule, error=None):
+        self.rule = rule
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    @property
+    def deferred(self):
+        return isinstance(self.error, InsufficientSpaceError)
+
+
+class PooledChannel:
+    def __init__(self, session, throttle=None):
+        self.session = session
+        self.throttle = throttle
+        self.healthy = True
+
+
+class TransferPool:
+    def __init__(self, destination, workers, journal=None, queue=None, shaper=None):
+        self.destination = destination
+        self.shaper = shaper
+        self.queue = transfer_queue.TransferQueue({}) if queue is None else queue
+        self.workers = workers
+        self.journal = transfer_journal.TransferJournal() if journal is None else journal
+        # Bytes admitted for files still being sent, which the free space read by the next admit does not show yet
+        self.reservations = {}
+        self.reservations_lock = threading.Lock()
+        # Concurrent transfers, e.g. the pipeline's, share one queue so priorities and flow limits hold across them
+        self.queued = []
+        self.active = {}  # Uploads running per flow
+        self.running = 0
+        self.owners = {}  # The results of the transfer each queued or running file belongs to
+        self.ready = threading.Condition()
+        self.remote_dirs = set()  # (location, dir) pairs known to exist, so each upload skips a stat per path level
+
+    def plan(self, mappings, until=None, flow=None):
+        planned = []
+        for rule in mappings:
+            try:
+                src_stat = archive.source_stat(source_path(rule), rule.get('entry'))
+            except FileNotFoundError:
+                continue  # Skip if file is missing
+            if stat.S_ISREG(src_stat.st_mode):
+                planned.append(PlannedFile(rule, src_stat, flow))
+        self.destination.prepare(planned, until)
+        return planned
+
+    def forget(self, dests):
+        self.journal.forget(dests)
+
+    def is_transferred(self, rule):
+        return self.is_recorded(rule['dest'], rule)
+
+    def is_recorded(self, key, rule):
+        entry = self.journal.get(key)
+        if entry is None or entry.state != transfer_journal.COMPLETED:
+            return False
+        src_file = source_path(rule)
+        try:
+            src_stat = archive.source_stat(src_file, rule.get('entry'))
+        except FileNotFoundError:
+            return False
+        return entry.matches(src_file, src_stat.st_size, src_stat.st_mtime)
+
+    def verify(self, planned):
+        # Lists the files whose remote copy is missing or has a different size than the source
+        if len(planned) == 0:
+            return []
+        session = self.destination.acquire()
+        healthy = False
+        try:
+            mismatched = []
+            for p in planned:
+                dest_stat = session.stat(p.rule['dest'])
+                if dest_stat is None or dest_stat.st_size != p.stat.st_size:
+                    mismatched.append(p.rule['filename'])
+            healthy = True
+            return mismatched
+        finally:
+            self.destination.release(session, healthy)
+
+    def transfer(self, mappings):
+        return self.transfer_planned(self.plan(mappings))
+
+    def transfer_planned(self, planned):
+        if len(planned) == 0:
+            return []
+        self.warm_up()
+        pending, deferred = self.admit(planned)
+        try:
+            return self.transfer_admitted(planned, list(pending), deferred)
+        finally:
+            for p in pending:
+                self.release_space(p)
+
+    def transfer_admitted(self, planned, pending, deferred):
+        results = dict((id(p), TransferResult(p.rule, InsufficientSpaceError('Not enough space on remote')))
+                       for p in deferred)
+        own = set(id(p) for p in pending)
+        with self.ready:
+            self.queued.extend(pending)
+            for p in pending:
+                self.owners[id(p)] = results
+
+        def take():
+            # Workers send whichever queued file is most urgent, also those of other transfers, until their own
+            # transfer has nothing left in the queue
+            with self.ready:
+                while True:
+                    if not any(id(q) in own for q in self.queued):
+                        return None
+                    p = self.queue.next(self.queued, self.active) if self.running < self.workers else None
+                    if p is not None:
+                        self.queued.remove(p)
+                        self.active[p.flow] = self.active.get(p.flow, 0) + 1
+                        self.running += 1
+                        return p
+                    self.ready.wait()  # Every upload slot is busy, or every queued file's flow is at its limit
+
+        def done(p, result):
+            self.release_space(p)
+            with self.ready:
+                self.owners.pop(id(p))[id(p)] = result
+                self.active[p.flow] -= 1
+                self.running -= 1
+                self.ready.notify_all()
+
+        def work():
+            # Every worker gets its own session, for SFTP a channel on the shared transport
+            channel = None
+            try:
+                while True:
+                    p = take()
+                    if p is None:
+                        return
+                    if channel is not None and not channel.healthy:
+                        self.release_channel(channel)
+                        channel = None
+                    try:
+                        if channel is None:
+                            channel = self.acquire_channel()
+                    except Exception as e:
+                        print('Failed transferring ' + p.rule['filename'] + ': ' + str(e))
+                        done(p, TransferResult(p.rule, e))
+                        continue
+                    done(p, self.transfer_file(channel, p))
+            finally:
+                if channel is not None:
+                    self.release_channel(channel)
+
+        workers = [threading.Thread(target=work, daemon=True)
+                   for _ in range(max(1, min(self.workers, len(pending))))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        with self.ready:
+            while not all(id(p) in results for p in pending):
+                self.ready.wait()  # Workers of another transfer are still sending some of our files
+        return [results[id(p)] for p in planned]
+
+    def admit(self, planned):
+        # Uploads that cannot fit would only fail once the disk is full, so they wait for a later run instead
+        # Pipeline slots admit concurrently, so whatever the others admitted and are still sending is set aside
+        with self.reservations_lock:
+            free = self.free_space()
+            if free is None:
+                return list(planned), []
+            available = free - self.destination.free_space_reserve - sum(self.reservations.values())
+            admitted = []
+            deferred = []
+            for p in sorted(planned, key=self.queue.priority):
+                needed = self.remaining_bytes(p)
+                if needed <= available:
+                    admitted.append(p)
+                    available -= needed
+                    self.reservations[id(p)] = needed
+                else:
+                    deferred.append(p)
+        if len(deferred) > 0:
+            print('Deferring ' + str(len(deferred)) + ' file(s), the remote only has ' + str(free) + ' bytes free')
+        return admitted, deferred
+
+    def release_space(self, planned):
+        with self.reservations_lock:
+            self.reservations.pop(id(planned), None)
+
+    def free_space(self):
+        session = self.destination.acquire()
+        healthy = False
+        try:
+            free = session.free_space()
+            healthy = True
+            return free
+        finally:
+            self.destination.release(session, healthy)
+
+    def remaining_bytes(self, planned):
+        return self.destination.space_needed(planned, self.remaining_bytes_for(planned.rule['dest'], planned))
+
+    def remaining_bytes_for(self, key, planned):
+        # Whatever the journal confirmed is already on the remote and takes no extra space
+        entry = self.journal.get(key)
+        size = planned.stat.st_size
+        if entry is not None and entry.matches(planned.src_file, size, planned.stat.st_mtime):
+            return size - entry.offset
+        return size
+
+    def warm_up(self):
+        # Fail fast while the remote is unreachable rather than once per file
+        self.destination.release(self.destination.acquire())
+
+    def throttle(self):
+        # Every channel gets its own per connection bucket, all of them share the global one
+        return self.shaper.connection_throttle() if self.shaper is not None else None
+
+    def acquire_channel(self):
+        return PooledChannel(self.destination.acquire(), self.throttle())
+
+    def release_channel(self, channel):
+        self.destination.release(channel.session, channel.healthy)
+
+    def send(self, channel, planned):
+        return self.upload(channel.session, planned, channel.throttle)
+
+    def upload(self, session, planned, throttle=None):
+        dest_file = planned.rule['dest']
+        offset = self.prepare_upload(session, planned, dest_file)
+        if offset is None:
+            return 0
+        sent = session.send(planned, offset, throttle, self.checkpointer(dest_file, offset))
+        self.complete_upload(session, planned, dest_file)
+        return sent
+
+    def prepare_upload(self, session, planned, key, destination=None):
+        # Returns the offset to upload from, or None when the destination already holds the file
+        destination = self.destination if destination is None else destination
+        file = planned.rule['filename']
+        dest_file = planned.rule['dest']
+        src_stat = planned.stat
+        entry = self.journal.plan(key, planned.src_file, src_stat.st_size, src_stat.st_mtime)
+        dest_stat = session.stat(dest_file)
+        dest_size = dest_stat.st_size if dest_stat is not None else None
+        if entry.state == transfer_journal.COMPLETED and dest_size == src_stat.st_size:
+            print('Skipping ' + file + ', already transferred')
+            return None
+        if session.is_identical(planned, dest_stat):
+            print('Skipping ' + file + ', identical copy already on ' + destination.name)
+            self.journal.complete(key)
+            return None
+        offset = 0
+        if entry.state == transfer_journal.IN_PROGRESS and dest_size is not None:
+            offset = min(entry.offset, dest_size)
+        if offset > 0:
+            print('Resuming ' + file + ' from byte ' + str(offset))
+        else:
+            print('Transferring ' + file + ' to ' + destination.name)
+        dest_dir = os.path.dirname(dest_file)
+        if len(dest_dir) > 0 and (destination.location, dest_dir) not in self.remote_dirs:
+            session.makedirs(dest_dir)
+            self.remote_dirs.add((destination.location, dest_dir))
+        self.journal.start(key)
+        return offset
+
+    def complete_upload(self, session, planned, key):
+        session.completed(planned)
+        self.journal.complete(key)
+        print('Completed transferring ' + planned.rule['filename'])
+
+    def forget_remote_dir(self, remote_dir):
+        self.remote_dirs.difference_update([d for d in list(self.remote_dirs) if d[1] == remote_dir])
+
+    def snapshot(self):
+        return {'remote_dirs': sorted(list(d) for d in self.remote_dirs.copy())}
+
+    def restore(self, state):
+        self.remote_dirs.update(tuple(d) for d in state.get('remote_dirs', []))
+
+    def checkpointer(self, dest_file, offset):
+        last = [offset]
+
+        def checkpoint(confirmed):
+            if confirmed - last[0] >= CHECKPOINT_BYTES:
+                self.journal.checkpoint(dest_file, confirmed)
+                last[0] = confirmed
+        return checkpoint
+
+    def transfer_file(self, channel, planned):
+        rule = planned.rule
+        try:
+            with metrics.timed('transfer', flow=planned.flow):
+                sent = self.send(channel, planned)
+            metrics.count('files_total', flow=planned.flow)
+            metrics.count('bytes_total', sent, flow=planned.flow)
+            return TransferResult(rule)
+        except Exception as e:
+            channel.healthy = False  # The channel may be left mid-request, so do not hand it back to the pool
+            self.forget_remote_dir(os.path.dirname(rule['dest']))  # It may have been removed behind our back
+            metrics.count('failed_files_total', flow=planned.flow)
+            print('Failed transferring ' + rule['filename'] + ': ' + str(e))
+            return TransferResult(rule, e)
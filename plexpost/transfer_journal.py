@@ -0,0 +1,73 @@
+import sqlite3
+import threading
+
+PLANNED = 'planned'
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+
+class JournalEntry:
+    def __init__(self, dest, src, size, mtime, state, offset):
+        self.dest = dest
+        self.src = src
+        self.size = size
+        self.mtime = mtime
+        self.state = state
+        self.offset = offset
+
+    def matches(self, src, size, mtime):
+        return self.src == src and self.size == size and self.mtime == mtime
+
+
+class TransferJournal:
+    def __init__(self, path=':memory:'):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS transfers ('
+                            'dest TEXT PRIMARY KEY, src TEXT, size INTEGER, mtime REAL, state TEXT, offset INTEGER)')
+
+    def get(self, dest):
+        with self.lock:
+            row = self.db.execute('SELECT dest, src, size, mtime, state, offset FROM transfers WHERE dest = ?',
+                                  (dest,)).fetchone()
+        return JournalEntry(*row) if row is not None else None
+
+    def plan(self, dest, src, size, mtime):
+        # A changed source invalidates whatever was recorded for the destination
+        entry = self.get(dest)
+        if entry is not None and entry.matches(src, size, mtime):
+            return entry
+        self.write(dest, src, size, mtime, PLANNED, 0)
+        return self.get(dest)
+
+    def start(self, dest):
+        self.update(dest, IN_PROGRESS)
+
+    def checkpoint(self, dest, offset):
+        with self.lock, self.db:
+            self.db.execute('UPDATE transfers SET offset = ? WHERE dest = ?', (offset, dest))
+
+    def complete(self, dest):
+        entry = self.get(dest)
+        if entry is not None:
+            with self.lock, self.db:
+                self.db.execute('UPDATE transfers SET state = ?, offset = ? WHERE dest = ?',
+                                (COMPLETED, entry.size, dest))
+
+    def forget(self, dests):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM transfers WHERE dest = ?', [(d,) for d in dests])
+
+    def update(self, dest, state):
+        with self.lock, self.db:
+            self.db.execute('UPDATE transfers SET state = ? WHERE dest = ?', (state, dest))
+
+    def write(self, dest, src, size, mtime, state, offset):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?)',
+                            (dest, src, size, mtime, state, offset))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
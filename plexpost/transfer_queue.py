@@ -0,0 +1,34 @@
+from plexpost import file_mapper
+
+
+class TransferQueue:
+    def __init__(self, conf):
+        self.small_file_size = conf.get('small_file_size', 10 * 1024 * 1024)
+        self.flow_order = conf.get('flow_order', ['show', 'movie'])
+        self.flow_limits = conf.get('flow_limits') or {}
+        for flow, limit in self.flow_limits.items():
+            # A flow without a slot would never be sent and block the queue waiting for it
+            if limit is not None and (not isinstance(limit, int) or limit < 1):
+                raise ValueError('transfer_queue.flow_limits.' + flow +
+                                 ' must be at least 1, leave it out for no limit')
+
+    def is_quick(self, planned):
+        return file_mapper.is_subtitle(planned.rule['filename']) or planned.stat.st_size < self.small_file_size
+
+    def flow_rank(self, flow):
+        # Flows missing from the configured order go after the listed ones
+        return self.flow_order.index(flow) if flow in self.flow_order else len(self.flow_order)
+
+    def priority(self, planned):
+        return 0 if self.is_quick(planned) else 1, self.flow_rank(planned.flow), planned.stat.st_size
+
+    def limit(self, flow):
+        return self.flow_limits.get(flow)
+
+    def next(self, pending, active):
+        # Picks the most urgent file whose flow still has a free transfer slot
+        for p in sorted(pending, key=self.priority):
+            limit = self.limit(p.flow)
+            if limit is None or active.get(p.flow, 0) < limit:
+                return p
+        return None
@@ -0,0 +1,116 @@
+import json
+import resource
+import time
+
+import paramiko
+import pytest
+
+RESULTS = []
+COLUMNS = ['benchmark', 'phase', 'seconds', 'transmission_rpcs', 'sftp_requests', 'read_syscalls', 'write_syscalls',
+           'bytes_per_second', 'peak_rss_kb']
+
+
+def io_counters():
+    # syscr and syscw count the read and write system calls of the whole process, only Linux has them
+    try:
+        with open('/proc/self/io') as f:
+            return dict((k, int(v)) for k, v in (line.split(':') for line in f))
+    except OSError:
+        return {}
+
+
+class Phase:
+    def __init__(self, bench, name):
+        self.bench = bench
+        self.name = name
+        self.bytes = 0
+
+    def __enter__(self):
+        self.rpcs = self.bench.transmission_rpcs()
+        self.sftp_requests = self.bench.sftp_requests
+        self.io = io_counters()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        io = io_counters()
+        RESULTS.append({'benchmark': self.bench.name,
+                        'phase': self.name,
+                        'seconds': round(seconds, 4),
+                        'transmission_rpcs': self.bench.transmission_rpcs() - self.rpcs,
+                        'sftp_requests': self.bench.sftp_requests - self.sftp_requests,
+                        'read_syscalls': io.get('syscr', 0) - self.io.get('syscr', 0),
+                        'write_syscalls': io.get('syscw', 0) - self.io.get('syscw', 0),
+                        'bytes': self.bytes,
+                        'bytes_per_second': int(self.bytes / seconds) if seconds > 0 else 0,
+                        # ru_maxrss only grows, so this is the peak up to the end of the phase
+                        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+class Benchmark:
+    def __init__(self, name, transmission):
+        self.name = name
+        self.transmission = transmission
+        self.sftp_requests = 0
+
+    def transmission_rpcs(self):
+        return len(self.transmission.method_calls)
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def timed(self, monkeypatch, obj, method, phase):
+        # Every call of the method is recorded as its own phase
+        original = getattr(obj, method)
+
+        def run(*args, **kwargs):
+            with self.phase(phase):
+                return original(*args, **kwargs)
+        monkeypatch.setattr(obj, method, run)
+
+
+@pytest.fixture
+def bench(request, monkeypatch, transmission):
+    b = Benchmark(request.node.name, transmission)
+    send = paramiko.SFTPClient._async_request
+
+    def counting_send(client, *args):
+        b.sftp_requests += 1  # Every SFTP request, blocking or pipelined, goes through here
+        return send(client, *args)
+    monkeypatch.setattr(paramiko.SFTPClient, '_async_request', counting_send)
+    return b
+
+
+@pytest.fixture
+def library_size(request):
+    return request.config.getoption('--bench-torrents')
+
+
+@pytest.fixture
+def season_size(request):
+    return request.config.getoption('--bench-episodes')
+
+
+@pytest.fixture
+def file_size(request):
+    return request.config.getoption('--bench-file-size')
+
+
+def row(result):
+    return str(result['benchmark']).ljust(40) + str(result['phase']).ljust(24) + \
+        ' '.join(str(result[c]).rjust(17) for c in COLUMNS[2:])
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if len(RESULTS) == 0:
+        return
+    terminalreporter.section('plexpost benchmarks')
+    terminalreporter.write_line(row(dict((c, c) for c in COLUMNS)))
+    for r in RESULTS:
+        terminalreporter.write_line(row(r))
+    path = config.getoption('--bench-json')
+    if path is not None:
+        with open(path, 'a') as f:
+            for r in RESULTS:
+                f.write(json.dumps(r) + '\n')
@@ -0,0 +1,48 @@
+import os
+
+from transmissionrpc import Torrent
+
+
+def synthetic_torrent(id, download_dir, files):
+    fields = {'id': id,
+              'name': 'Torrent ' + str(id),
+              'downloadDir': download_dir,
+              'sizeWhenDone': sum(size for _, size in files),
+              'leftUntilDone': 0,
+              'files': [{'name': name, 'length': size, 'bytesCompleted': size} for name, size in files],
+              'priorities': [0] * len(files),
+              'wanted': [1] * len(files)}
+    return Torrent(None, fields)
+
+
+def season_pack(id, download_dir, episodes, episode_size=1024 ** 3):
+    files = []
+    for e in range(1, episodes + 1):
+        files.append(('Show.S01/Show.S01E%03d.mkv' % e, episode_size))
+        files.append(('Show.S01/Subs/Show.S01E%03d.English.srt' % e, 40 * 1024))
+    return synthetic_torrent(id, download_dir, files)
+
+
+def library(count, movies_dir, shows_dir, downloads_dir):
+    torrents = []
+    for id in range(count):
+        kind = id % 3
+        if kind == 0:
+            files = [('Movie %d/Movie %d.mkv' % (id, id), 8 * 1024 ** 3),
+                     ('Movie %d/Subs/English.srt' % id, 60 * 1024),
+                     ('Movie %d/sample.mkv' % id, 30 * 1024 ** 2)]
+            torrents.append(synthetic_torrent(id, movies_dir, files))
+        elif kind == 1:
+            torrents.append(season_pack(id, shows_dir + '/Show %d/1' % id, 10))
+        else:
+            torrents.append(synthetic_torrent(id, downloads_dir, [('Download %d/file.iso' % id, 700 * 1024 ** 2)]))
+    return torrents
+
+
+def write_files(torrent, size=None):
+    # Sparse files give realistic sizes without the disk space
+    for f in torrent.files().values():
+        path = os.path.join(torrent.downloadDir, f['name'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out:
+            out.truncate(f['size'] if size is None else size)
@@ -0,0 +1,29 @@
+from unittest.mock import Mock
+
+from plexpost import file_mapper, post_processor, torrent_poller, movies_flow, show_flow, default_flow
+from synthetic import season_pack, library
+
+
+def test_map_season_pack(bench, season_size):
+    pack = season_pack(1, 'tmp/tv/Show/1', season_size)
+    with bench.phase('map'):
+        file_mapper.map_single_video_download_with_subs(pack, 'tv/Show/1/')
+
+
+def test_classify_and_map_library(bench, transmission, library_size):
+    flows = [post_processor.PostProcessor(transmission, Mock(), Mock(), movies_flow.MoviePostProcessor(
+                 {'download_dir_tag': 'tmp/movies'})),
+             post_processor.PostProcessor(transmission, Mock(), Mock(), show_flow.ShowPostProcessor(
+                 {'download_dir_tag': 'tmp/tv'})),
+             post_processor.PostProcessor(transmission, Mock(), Mock(), default_flow.DefaultPostProcessor(
+                 {'download_dir_tag': 'tmp/downloads'}))]
+    transmission.get_torrents.return_value = library(library_size, 'tmp/movies', 'tmp/tv', 'tmp/downloads')
+    poller = torrent_poller.TorrentPoller(torrent_poller.FullTorrentSource(transmission), flows)
+    with bench.phase('poll'):
+        completed = poller.source.completed()
+    with bench.phase('filter'):
+        claims = poller.claim(completed)
+    with bench.phase('map'):
+        for proc, torrents in zip(flows, claims):
+            for t in torrents:
+                proc.media_processor.map_files(t)
@@ -0,0 +1,36 @@
+from unittest.mock import Mock
+
+import pytest
+
+from plexpost import post_processor, sftp_destination, transfer, show_flow
+from plexpost.sftp_factory import SFTPFactory
+from synthetic import season_pack, write_files
+
+
+@pytest.fixture
+def sftp(fs_sftpserver):
+    return sftp_destination.SFTPDestination(SFTPFactory({'url': fs_sftpserver.host,
+                        'port': fs_sftpserver.port,
+                        'username': 'user',
+                        'password': '',
+                        'remote_dir': '/',
+                        'transfer_workers': 4}))
+
+
+def test_process_season_packs(bench, monkeypatch, transmission, sftp, tmp_path, library_size):
+    shows_dir = str(tmp_path / 'tv')
+    # Every pack is written to disk and uploaded, so a fraction of the library keeps the run short
+    torrents = [season_pack(id, shows_dir + '/Show %d/1' % id, 10) for id in range(max(1, library_size // 100))]
+    for t in torrents:
+        write_files(t, 64 * 1024)
+    transmission.get_torrents.return_value = torrents
+    processor = post_processor.PostProcessor(transmission, Mock(), sftp, show_flow.ShowPostProcessor(
+        {'download_dir_tag': shows_dir}), transfer.TransferPool(sftp, sftp.transfer_workers))
+    for method, phase in [('get_completed_torrents', 'poll'), ('select', 'filter'), ('map_files', 'map'),
+                          ('wake_htpc', 'wake'), ('transfer_to_htpc', 'transfer'), ('clean_up', 'cleanup')]:
+        bench.timed(monkeypatch, processor, method, phase)
+    try:
+        with bench.phase('run'):
+            processor.run()
+    finally:
+        sftp.close()
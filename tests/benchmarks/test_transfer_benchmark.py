@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from plexpost import sftp_destination, transfer
+from plexpost.sftp_factory import SFTPFactory
+
+
+def create_pool(fs_sftpserver, workers, large_file_threshold):
+    factory = SFTPFactory({'url': fs_sftpserver.host,
+                           'port': fs_sftpserver.port,
+                           'username': 'user',
+                           'password': '',
+                           'remote_dir': '/',
+                           'transfer_workers': workers,
+                           'large_file_threshold': large_file_threshold})
+    return transfer.TransferPool(sftp_destination.SFTPDestination(factory), workers)
+
+
+def sparse_file(download_dir, filename, size):
+    with open(os.path.join(download_dir, filename), 'wb') as f:
+        f.truncate(size)
+    return {'download_dir': download_dir, 'filename': filename, 'dest': filename}
+
+
+@pytest.mark.parametrize('engine', ['put', 'pipelined'])
+def test_upload_large_file(bench, fs_sftpserver, tmp_path, file_size, engine):
+    pool = create_pool(fs_sftpserver, 1, file_size + 1 if engine == 'put' else 0)
+    rule = sparse_file(str(tmp_path), 'remux.mkv', file_size)
+    try:
+        with bench.phase('transfer ' + engine) as phase:
+            results = pool.transfer([rule])
+            phase.bytes = file_size
+    finally:
+        pool.destination.close()
+    assert results[0].succeeded
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_upload_many_small_files(bench, fs_sftpserver, tmp_path, season_size, workers):
+    pool = create_pool(fs_sftpserver, workers, 64 * 1024 * 1024)
+    size = 256 * 1024
+    rules = [sparse_file(str(tmp_path), 'episode%d.srt' % i, size) for i in range(season_size)]
+    try:
+        with bench.phase('transfer ' + str(workers) + ' worker(s)') as phase:
+            results = pool.transfer(rules)
+            phase.bytes = size * len(rules)
+    finally:
+        pool.destination.close()
+    assert all(r.succeeded for r in results)
@@ -1,14 +1,41 @@
+import os
+import socket
+import subprocess
+import threading
 from unittest.mock import Mock
 
+import paramiko
 import pysftp
 import pytest
+from pytest_sftpserver.consts import SERVER_KEY_PRIVATE
 
-from plexpost import htpc_switch
+from plexpost import htpc_switch, sftp_destination
+from plexpost.sftp_factory import SFTPFactory
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('plexpost benchmarks')
+    group.addoption('--bench', action='store_true', help='run the benchmarks in tests/benchmarks')
+    group.addoption('--bench-json', help='append every benchmark phase to this file as JSON lines')
+    group.addoption('--bench-torrents', type=int, default=2000, help='torrents in the synthetic library')
+    group.addoption('--bench-episodes', type=int, default=300, help='episodes in the synthetic season pack')
+    group.addoption('--bench-file-size', type=int, default=256 * 1024 * 1024, help='size of the sparse upload')
+
+
+def pytest_collection_modifyitems(config, items):
+    # Benchmarks take minutes, so they only run when asked for
+    if config.getoption('--bench'):
+        return
+    benchmarks = [i for i in items if 'benchmarks' in i.nodeid.split('::')[0].split('/')]
+    if len(benchmarks) > 0:
+        config.hook.pytest_deselected(items=benchmarks)
+        items[:] = [i for i in items if i not in benchmarks]
 
 
 @pytest.fixture(autouse=True)
 def requests(monkeypatch):
     req = Mock()
+    req.Session.return_value.get.return_value.json.return_value = {'state': 'off'}
     monkeypatch.setattr(htpc_switch, 'requests', req)
     return req
 
@@ -23,6 +50,28 @@ def download_dir():
     return 'tmp'
 
 
+@pytest.fixture
+def downloads(tmp_path):
+    path = tmp_path / 'downloads'
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture
+def sftp_destination_for():
+    # Builds SFTP destinations on a test server and closes them once the test is done
+    created = []
+
+    def create(server, **overrides):
+        conf = {'url': server.host, 'port': server.port, 'username': 'user', 'password': '', 'remote_dir': '/'}
+        conf.update(overrides)
+        created.append(sftp_destination.SFTPDestination(SFTPFactory(conf)))
+        return created[-1]
+    yield create
+    for destination in created:
+        destination.close()
+
+
 @pytest.fixture
 def completed_torrents(transmission):
     return transmission.get_torrents
@@ -43,3 +92,190 @@ def sftpclient(sftpserver):
     with pysftp.Connection(sftpserver.host, port=sftpserver.port, username='user', password='',
                            cnopts=cnopts) as sftpclient:
         yield sftpclient
+
+
+class FilesystemSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class FilesystemSFTPServer(paramiko.SFTPServerInterface):
+    # Serves a real directory so tests can exercise offset writes, renames and sizes
+    def __init__(self, server, root, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def local(self, path):
+        return self.root + self.canonicalize(path)
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+    def list_folder(self, path):
+        try:
+            local = self.local(path)
+            return [paramiko.SFTPAttributes.from_stat(os.stat(local + '/' + f), f) for f in os.listdir(local)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        local = self.local(path)
+        try:
+            fd = os.open(local, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = FilesystemSFTPHandle(flags)
+        handle.filename = local
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_size is not None:
+                os.truncate(self.local(path), attr.st_size)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(self.local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.local(oldpath), self.local(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class FilesystemSSHServer(paramiko.ServerInterface):
+    def __init__(self, root, allow_exec=True):
+        self.root = root
+        self.allow_exec = allow_exec
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,none'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        if not self.allow_exec:
+            return False  # Like an internal-sftp or chrooted account
+        threading.Thread(target=self.execute, args=(channel, command), daemon=True).start()
+        return True
+
+    def execute(self, channel, command):
+        proc = subprocess.Popen(command.decode(), shell=True, cwd=self.root, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdin = channel.makefile('rb')
+        out, err = proc.communicate(stdin.read())
+        channel.sendall(out)
+        channel.sendall_stderr(err)
+        channel.send_exit_status(proc.returncode)
+        channel.close()
+
+
+class FilesystemSFTPServerThread:
+    def __init__(self, root, allow_exec=True):
+        self.root = root
+        self.allow_exec = allow_exec
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.host, self.port = self.sock.getsockname()
+        self.transports = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(paramiko.RSAKey.from_private_key_file(SERVER_KEY_PRIVATE))
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, FilesystemSFTPServer, self.root)
+        self.transports.append(transport)
+        try:
+            transport.start_server(server=FilesystemSSHServer(self.root, self.allow_exec))
+        except (EOFError, paramiko.SSHException):
+            pass  # Reachability probes connect and hang up without negotiating
+
+    def close(self):
+        self.sock.close()
+        for t in self.transports:
+            t.close()
+
+
+@pytest.fixture
+def fs_sftpserver(tmp_path):
+    root = tmp_path / 'remote'
+    root.mkdir()
+    server = FilesystemSFTPServerThread(str(root))
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def fs_sftp_only(tmp_path):
+    root = tmp_path / 'sftp_only'
+    root.mkdir()
+    server = FilesystemSFTPServerThread(str(root), allow_exec=False)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def fs_mirror(tmp_path):
+    root = tmp_path / 'mirror'
+    root.mkdir()
+    server = FilesystemSFTPServerThread(str(root))
+    yield server
+    server.close()
@@ -0,0 +1,176 @@
+import os
+import struct
+import zipfile
+from unittest.mock import Mock
+
+import pytest
+
+from plexpost import archive, file_mapper, local_destination, transfer
+
+
+@pytest.fixture
+def fs_pool(sftp_destination_for, fs_sftpserver):
+    return transfer.TransferPool(sftp_destination_for(fs_sftpserver, block_size=10, request_size=4), 1)
+
+
+def test_should_recognise_the_volumes_of_a_set():
+    assert archive.is_first_volume('rel/rel.rar')
+    assert archive.is_first_volume('rel/rel.part01.rar')
+    assert not archive.is_first_volume('rel/rel.part02.rar')
+    assert not archive.is_first_volume('rel/rel.r00')
+    assert archive.is_volume_of('rel/rel.rar', 'rel/rel.r07')
+    assert archive.is_volume_of('rel/rel.part01.rar', 'rel/rel.part12.rar')
+    assert not archive.is_volume_of('rel/rel.rar', 'other/other.r00')
+
+
+def test_should_index_stored_entry_split_over_old_style_rar4_volumes(downloads):
+    video = bytes(range(256)) * 3
+    write_rar4_set(downloads + '/rel.rar', 'rel/movie.mkv', video, ['rel.rar', 'rel.r00', 'rel.r01'])
+    entries = archive.index(downloads + '/rel.rar')
+    assert [(e.name, e.size, e.streamable, len(e.segments)) for e in entries] == [('rel/movie.mkv', 768, True, 3)]
+    with archive.open_entry(downloads + '/rel.rar', 'rel/movie.mkv') as f:
+        assert f.read() == video
+
+
+def test_should_index_stored_entry_split_over_rar5_volumes(downloads):
+    video = b'rar5' * 100
+    write_rar5_volume(downloads + '/rel.part1.rar', 'movie.mkv', video[:150], len(video), split_after=True)
+    write_rar5_volume(downloads + '/rel.part2.rar', 'movie.mkv', video[150:], len(video), split_before=True)
+    with archive.open_entry(downloads + '/rel.part1.rar', 'movie.mkv') as f:
+        f.seek(100)
+        assert f.read() == video[100:]
+
+
+def test_should_not_stream_compressed_rar_entries(downloads):
+    write_rar4_set(downloads + '/rel.rar', 'movie.mkv', b'packed', ['rel.rar'], method=0x33)
+    assert not archive.index(downloads + '/rel.rar')[0].streamable
+    with pytest.raises(archive.ArchiveError):
+        archive.open_entry(downloads + '/rel.rar', 'movie.mkv')
+
+
+def test_should_inflate_deflated_zip_entry_from_an_offset(downloads):
+    video = os.urandom(1000)
+    with zipfile.ZipFile(downloads + '/rel.zip', 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('movie.mkv', video)
+    with archive.open_entry(downloads + '/rel.zip', 'movie.mkv') as f:
+        f.seek(400)
+        assert f.read() == video[400:]
+
+
+def test_should_stream_entry_to_remote_without_extracting(fs_pool, fs_sftpserver, downloads):
+    video = bytes(range(256)) * 3
+    write_rar4_set(downloads + '/rel.rar', 'movie.mkv', video, ['rel.rar', 'rel.r00'])
+    rule = {'download_dir': downloads, 'filename': 'rel.rar', 'dest': 'movies/movie.mkv', 'entry': 'movie.mkv'}
+    results = fs_pool.transfer([rule])
+    assert results[0].succeeded
+    assert read(fs_sftpserver.root + '/movies/movie.mkv') == video
+    assert sorted(os.listdir(downloads)) == ['rel.r00', 'rel.rar']
+    assert fs_pool.verify(fs_pool.plan([rule])) == []
+
+
+def test_should_extract_entry_into_local_library(tmp_path, downloads):
+    library = str(tmp_path / 'library')
+    os.mkdir(library)
+    with zipfile.ZipFile(downloads + '/rel.zip', 'w', zipfile.ZIP_STORED) as z:
+        z.writestr('movie.mkv', b'stored' * 100)
+    pool = transfer.TransferPool(local_destination.LocalDestination({'path': library}), 1)
+    rule = {'download_dir': downloads, 'filename': 'rel.zip', 'dest': 'movie.mkv', 'entry': 'movie.mkv'}
+    assert pool.transfer([rule])[0].succeeded
+    assert read(library + '/movie.mkv') == b'stored' * 100
+
+
+def test_should_map_largest_archived_video_over_sample(downloads):
+    write_rar4_set(downloads + '/rel/rel.rar', 'Movie.2019.mkv', b'm' * 500, ['rel.rar', 'rel.r00'])
+    os.makedirs(downloads + '/rel/Sample')
+    with open(downloads + '/rel/Sample/sample.mkv', 'wb') as f:
+        f.write(b's' * 10)
+    torrent = torrent_with_files(downloads, {'rel/rel.rar': 300, 'rel/rel.r00': 300, 'rel/Sample/sample.mkv': 10})
+    assert file_mapper.map_single_video_download_with_subs(torrent, 'movies/') == [
+        {'download_dir': downloads, 'filename': 'rel/rel.rar', 'dest': 'movies/rel/Movie.2019.mkv',
+         'entry': 'Movie.2019.mkv'}]
+
+
+def test_should_not_read_archive_while_volumes_are_downloading(downloads, monkeypatch):
+    monkeypatch.setattr(archive, 'index', Mock(side_effect=AssertionError('index read')))
+    torrent = torrent_with_files(downloads, {'rel/rel.rar': 300, 'rel/rel.r00': 300})
+    torrent.files.return_value[1]['completed'] = 100
+    assert file_mapper.forward_main_videos(torrent) == []
+
+
+def test_should_not_map_sample_while_archive_set_is_downloading(downloads):
+    torrent = torrent_with_files(downloads, {'rel/rel.rar': 300, 'rel/rel.r00': 300, 'rel/Sample/sample.mkv': 10})
+    torrent.files.return_value[1]['completed'] = 100
+    assert file_mapper.map_single_video_download_with_subs(torrent, 'movies/') == []
+
+
+def test_should_map_main_video_next_to_deselected_archive(downloads):
+    torrent = torrent_with_files(downloads, {'movie.mkv': 500, 'movie.srt': 1, 'Extras/extras.rar': 300})
+    extras = torrent.files.return_value[0]
+    extras.update(selected=False, completed=0)
+    assert file_mapper.map_single_video_download_with_subs(torrent, 'movies/') == [
+        {'download_dir': downloads, 'filename': 'movie.mkv', 'dest': 'movies/movie.mkv'},
+        {'download_dir': downloads, 'filename': 'movie.srt', 'dest': 'movies/movie.srt'}]
+
+
+def test_should_map_every_archived_episode_of_a_season_pack(downloads):
+    sizes = {'Show.S02/Show.S02E02.Sample.mkv': 10}
+    for episode in ['Show.S02E01', 'Show.S02E02']:
+        write_rar4_set(downloads + '/Show.S02/' + episode + '/show.rar', episode + '.mkv', b'e' * 200,
+                       ['show.rar', 'show.r00'])
+        sizes.update({'Show.S02/' + episode + '/show.rar': 100, 'Show.S02/' + episode + '/show.r00': 100})
+    torrent = torrent_with_files(downloads, sizes)
+    assert file_mapper.map_season_pack(torrent, 'tv/Show/2/') == [
+        {'download_dir': downloads, 'filename': 'Show.S02/Show.S02E01/show.rar', 'dest': 'tv/Show/2/Show.S02E01.mkv',
+         'entry': 'Show.S02E01.mkv'},
+        {'download_dir': downloads, 'filename': 'Show.S02/Show.S02E02/show.rar', 'dest': 'tv/Show/2/Show.S02E02.mkv',
+         'entry': 'Show.S02E02.mkv'}]
+
+
+def torrent_with_files(downloads, sizes):
+    torrent = Mock()
+    torrent.downloadDir = downloads
+    torrent.files.return_value = dict((i, {'name': name, 'size': size, 'completed': size, 'selected': True})
+                                      for i, (name, size) in enumerate(sorted(sizes.items())))
+    return torrent
+
+
+def write_rar4_set(first, name, data, volume_names, method=0x30):
+    os.makedirs(os.path.dirname(first), exist_ok=True)
+    chunk = -(-len(data) // len(volume_names))
+    for i, volume in enumerate(volume_names):
+        flags = (0x01 if i > 0 else 0) | (0x02 if i < len(volume_names) - 1 else 0)
+        part = data[i * chunk:(i + 1) * chunk]
+        encoded = name.encode()
+        header = struct.pack('<HBHHIIBIIBBHI', 0, 0x74, flags | 0x8000, 32 + len(encoded), len(part), len(data), 2,
+                             0, 0, 20, method, len(encoded), 0x20) + encoded
+        with open(os.path.join(os.path.dirname(first), volume), 'wb') as f:
+            f.write(archive.RAR4_SIGNATURE + struct.pack('<HBHH', 0, 0x73, 0x0001, 13) + bytes(6))
+            f.write(header + part + struct.pack('<HBHH', 0, 0x7b, 0, 7))
+
+
+def vint(value):
+    encoded = b''
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value == 0:
+            return encoded + bytes([byte])
+        encoded += bytes([byte | 0x80])
+
+
+def rar5_header(kind, flags, fields, data=b''):
+    body = vint(kind) + vint(flags) + (vint(len(data)) if flags & 0x02 else b'') + fields
+    return bytes(4) + vint(len(body)) + body + data
+
+
+def write_rar5_volume(path, name, part, size, split_before=False, split_after=False):
+    flags = 0x02 | (0x08 if split_before else 0) | (0x10 if split_after else 0)
+    fields = vint(0) + vint(size) + vint(0x20) + vint(0) + vint(0) + vint(len(name)) + name.encode()
+    with open(path, 'wb') as f:
+        f.write(archive.RAR5_SIGNATURE + rar5_header(1, 0, vint(0x01)) + rar5_header(2, flags, fields, part) +
+                rar5_header(5, 0, vint(0)))
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,70 @@
+import datetime
+import os
+
+from plexpost import bandwidth
+
+
+def test_should_match_windows_that_span_midnight():
+    window = bandwidth.Window({'start': '22:00', 'end': '06:30'})
+    assert window.contains(datetime.time(23, 0))
+    assert window.contains(datetime.time(6, 29))
+    assert not window.contains(datetime.time(6, 30))
+    assert not window.contains(datetime.time(12, 0))
+
+
+def test_should_read_unquoted_times_as_minutes_since_midnight():
+    assert bandwidth.parse_time(20 * 60 + 30) == datetime.time(20, 30)
+    assert bandwidth.parse_time('01:00') == datetime.time(1, 0)
+
+
+def test_should_use_the_window_limits_inside_a_window():
+    shaper = bandwidth.Shaper({'global_limit': 20000000,
+                               'per_connection_limit': 5000000,
+                               'windows': [{'start': '01:00', 'end': '07:00', 'global_limit': None}]})
+    assert shaper.limits(datetime.time(3, 0)) == (None, None)
+    assert shaper.limits(datetime.time(12, 0)) == (20000000, 5000000)
+
+
+def test_should_wait_until_enough_tokens_are_available(monkeypatch):
+    now = [100.0]
+    slept = []
+    monkeypatch.setattr(bandwidth.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(bandwidth.time, 'sleep', slept.append)
+    bucket = bandwidth.TokenBucket(1000)
+    now[0] += 1
+    bucket.consume(1000)  # A second's worth of tokens piled up
+    bucket.consume(500)
+    bucket.consume(500)
+    assert slept == [0.5, 1.0]
+
+
+def test_should_not_wait_without_a_limit(monkeypatch):
+    slept = []
+    monkeypatch.setattr(bandwidth.time, 'sleep', slept.append)
+    bandwidth.TokenBucket().consume(10 ** 12)
+    assert slept == []
+
+
+def test_should_reload_schedule_file_when_it_changes(tmp_path):
+    path = str(tmp_path / 'bandwidth.yml')
+    with open(path, 'w') as f:
+        f.write('global_limit: 1000\n')
+    shaper = bandwidth.Shaper({'global_limit': 5000, 'schedule_file': path})
+    shaper.refresh()
+    assert shaper.global_bucket.rate == 1000
+    with open(path, 'w') as f:
+        f.write('global_limit: 2000\nper_connection_limit: 500\n')
+    os.utime(path, (0, 0))
+    shaper.checked = None
+    shaper.refresh()
+    assert (shaper.global_bucket.rate, shaper.per_connection_limit) == (2000, 500)
+
+
+def test_should_keep_the_schedule_when_the_file_is_invalid(tmp_path, capsys):
+    path = str(tmp_path / 'bandwidth.yml')
+    with open(path, 'w') as f:
+        f.write('windows: [{start: 01:00}]\n')
+    shaper = bandwidth.Shaper({'global_limit': 5000, 'schedule_file': path})
+    shaper.refresh()
+    assert shaper.global_bucket.rate == 5000
+    assert 'Could not load bandwidth schedule' in capsys.readouterr().out
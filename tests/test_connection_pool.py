@@ -0,0 +1,55 @@
+import pytest
+
+from plexpost import connection_pool
+from plexpost.sftp_factory import SFTPFactory
+
+
+@pytest.fixture
+def pool(sftpserver, remote_base_dir):
+    pool = connection_pool.ConnectionPool(SFTPFactory({'url': sftpserver.host,
+                                                       'port': sftpserver.port,
+                                                       'username': 'user',
+                                                       'password': '',
+                                                       'remote_dir': remote_base_dir}))
+    yield pool
+    pool.close()
+
+
+def test_should_reuse_released_channel(pool):
+    sftp = pool.acquire()
+    pool.release(sftp)
+    assert pool.acquire() is sftp
+
+
+def test_should_share_one_transport_between_channels(pool):
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+    assert first.get_channel().get_transport() is second.get_channel().get_transport()
+
+
+def test_should_not_reuse_channel_released_as_unhealthy(pool):
+    sftp = pool.acquire()
+    pool.release(sftp, healthy=False)
+    assert pool.acquire() is not sftp
+
+
+def test_should_reconnect_when_transport_has_dropped(pool):
+    sftp = pool.acquire()
+    pool.release(sftp)
+    dropped = sftp.get_channel().get_transport()
+    dropped.close()
+    reconnected = pool.acquire()
+    assert reconnected.get_channel().get_transport() is not dropped
+    assert reconnected.get_channel().get_transport().is_active()
+
+
+def test_should_keep_transport_of_busy_channels_when_an_idle_channel_dies(pool):
+    busy = pool.acquire()
+    broken = pool.acquire()
+    pool.release(broken)
+    broken.get_channel().close()
+    replacement = pool.acquire()
+    assert replacement is not broken
+    assert replacement.get_channel().get_transport() is busy.get_channel().get_transport()
+    busy.stat('.')
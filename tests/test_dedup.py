@@ -0,0 +1,87 @@
+import os
+from unittest.mock import Mock
+
+import pytest
+
+from plexpost import transfer, dedup
+
+
+@pytest.fixture
+def pool_for(sftp_destination_for, fs_sftpserver):
+    def create(mode, server=fs_sftpserver):
+        # Exec commands run from the served root, so keep the remote dir relative to it
+        return transfer.TransferPool(sftp_destination_for(server, remote_dir='.', dedup=mode), 1)
+    return create
+
+
+def test_should_skip_upload_when_size_and_mtime_match(pool_for, fs_sftpserver, downloads):
+    rule = mapping(downloads, 'movie.mkv', b'content')
+    pool_for(dedup.STAT).transfer([rule])
+    write_remote(fs_sftpserver, 'movie.mkv', b'CONTENT', os.stat(downloads + '/movie.mkv').st_mtime)
+    pool_for(dedup.STAT).transfer([rule])
+    assert read_remote(fs_sftpserver, 'movie.mkv') == b'CONTENT'
+
+
+def test_should_upload_when_mtime_differs(pool_for, fs_sftpserver, downloads):
+    rule = mapping(downloads, 'movie.mkv', b'content')
+    write_remote(fs_sftpserver, 'movie.mkv', b'CONTENT', 0)
+    pool_for(dedup.STAT).transfer([rule])
+    assert read_remote(fs_sftpserver, 'movie.mkv') == b'content'
+
+
+def test_should_skip_upload_when_checksums_match(pool_for, fs_sftpserver, downloads, capsys):
+    rule = mapping(downloads, 'movie.mkv', b'content')
+    write_remote(fs_sftpserver, 'movie.mkv', b'content', 0)
+    pool_for(dedup.CHECKSUM).transfer([rule])
+    assert 'identical copy already on 127.0.0.1' in capsys.readouterr().out
+
+
+def test_should_upload_when_checksums_differ(pool_for, fs_sftpserver, downloads):
+    rule = mapping(downloads, 'movie.mkv', b'content')
+    write_remote(fs_sftpserver, 'movie.mkv', b'CONTENT', 0)
+    pool_for(dedup.CHECKSUM).transfer([rule])
+    assert read_remote(fs_sftpserver, 'movie.mkv') == b'content'
+
+
+def test_should_upload_when_remote_only_serves_sftp(pool_for, fs_sftp_only, downloads):
+    rule = mapping(downloads, 'movie.mkv', b'content')
+    write_remote(fs_sftp_only, 'movie.mkv', b'content', 0)
+    results = pool_for(dedup.CHECKSUM, fs_sftp_only).transfer([rule])
+    assert results[0].succeeded
+    assert read_remote(fs_sftp_only, 'movie.mkv') == b'content'
+
+
+def test_should_always_upload_when_dedup_is_off(pool_for, fs_sftpserver, downloads):
+    rule = mapping(downloads, 'movie.mkv', b'content')
+    write_remote(fs_sftpserver, 'movie.mkv', b'CONTENT', os.stat(downloads + '/movie.mkv').st_mtime)
+    pool_for(dedup.NONE).transfer([rule])
+    assert read_remote(fs_sftpserver, 'movie.mkv') == b'content'
+
+
+def test_should_stop_hashing_ahead_once_the_remote_is_awake(downloads):
+    mapping(downloads, 'movie.mkv', b'm' * 100)
+    movie = Mock(src_file=downloads + '/movie.mkv', entry=None, sha256=None)
+    episode = Mock(src_file=downloads + '/movie.mkv', entry=None, sha256=None)
+    wake = Mock()
+    wake.done.side_effect = [False, False, True]  # The remote comes up after two of the 10 blocks
+    dedup.Deduplicator(dedup.CHECKSUM, '.', 10).prepare([movie, episode], wake)
+    assert movie.sha256 is None and episode.sha256 is None
+    assert wake.done.call_count == 3
+
+
+def mapping(downloads, filename, content):
+    with open(downloads + '/' + filename, 'wb') as f:
+        f.write(content)
+    return {'download_dir': downloads, 'filename': filename, 'dest': filename}
+
+
+def write_remote(server, filename, content, mtime):
+    path = server.root + '/' + filename
+    with open(path, 'wb') as f:
+        f.write(content)
+    os.utime(path, (mtime, mtime))
+
+
+def read_remote(server, filename):
+    with open(server.root + '/' + filename, 'rb') as f:
+        return f.read()
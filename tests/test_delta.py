@@ -0,0 +1,143 @@
+import io
+import os
+import random
+import subprocess
+
+import pytest
+
+from plexpost import delta, transfer
+
+BLOCK = 1024
+
+
+@pytest.fixture
+def delta_destination(sftp_destination_for):
+    # Exec commands run from the served root, so keep the remote dir relative to it
+    def create(server):
+        return sftp_destination_for(server, remote_dir='.', large_file_threshold=0, delta=True,
+                                    delta_block_size=BLOCK)
+    return create
+
+
+@pytest.fixture
+def pool(delta_destination, fs_sftpserver):
+    return transfer.TransferPool(delta_destination(fs_sftpserver), 1)
+
+
+def content(size, seed):
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, 'little')
+
+
+class Recorder:
+    def __init__(self):
+        self.ops = []
+
+    def copy_block(self, offset, length):
+        self.ops.append(('copy', offset, length))
+
+    def literal(self, data):
+        self.ops.append(('literal', data))
+
+
+def local_index(basis, tmp_path):
+    path = str(tmp_path / 'basis')
+    with open(path, 'wb') as f:
+        f.write(basis)
+    output = subprocess.check_output(['python3', '-c', delta.HELPER, 'sig', str(BLOCK), path])
+    index = {}
+    for n, (weak, length, strong) in enumerate(delta.SIGNATURE.iter_unpack(output)):
+        if length == BLOCK:
+            index.setdefault(weak, []).append((strong, n * BLOCK))
+    return index
+
+
+def test_should_find_blocks_shifted_by_an_insertion(tmp_path):
+    basis = content(8 * BLOCK, 1)
+    source = basis[:3 * BLOCK] + b'inserted' + basis[3 * BLOCK:]
+    recorder = Recorder()
+    delta.Encoder(io.BytesIO(source), local_index(basis, tmp_path), BLOCK, recorder).run()
+    assert [op for op in recorder.ops if op[0] == 'copy'] == [('copy', n * BLOCK, BLOCK) for n in range(8)]
+    assert [op[1] for op in recorder.ops if op[0] == 'literal'] == [b'inserted']
+
+
+def test_should_send_only_what_changed_in_an_upgraded_file(pool, fs_sftpserver, downloads):
+    basis = content(128 * BLOCK, 2)
+    write(fs_sftpserver.root + '/movie.mkv', basis)
+    source = basis[:40 * BLOCK] + b'PROPER' + basis[40 * BLOCK:100 * BLOCK] + content(3 * BLOCK, 3)
+    write(downloads + '/movie.mkv', source)
+    rule = {'download_dir': downloads, 'filename': 'movie.mkv', 'dest': 'movie.mkv'}
+    session = pool.destination.acquire()
+    sent = pool.upload(session, pool.plan([rule])[0])
+    pool.destination.release(session)
+    assert read(fs_sftpserver.root + '/movie.mkv') == source
+    assert sent < len(source) // 10
+    assert not os.path.exists(fs_sftpserver.root + '/movie.mkv.plexpost')
+
+
+def test_should_give_up_on_a_changed_region_after_a_window(tmp_path, monkeypatch):
+    # Over the whole file most blocks match, but once a window is mostly new data the delta is not worth finishing
+    monkeypatch.setattr(delta, 'LITERAL_CHUNK', 4 * BLOCK)
+    basis = content(64 * BLOCK, 6)
+    source = basis + content(40 * BLOCK, 7)
+    recorder = Recorder()
+    encoder = delta.Encoder(io.BytesIO(source), local_index(basis, tmp_path), BLOCK, recorder)
+    encoder.window = 16 * BLOCK
+    with pytest.raises(delta.DeltaError, match='most of the file changed'):
+        encoder.run()
+    assert encoder.literal_bytes + encoder.matched_bytes < 96 * BLOCK
+
+
+def test_should_give_up_when_scanning_is_slower_than_min_rate(tmp_path):
+    basis = content(8 * BLOCK, 8)
+    encoder = delta.Encoder(io.BytesIO(content(8 * BLOCK, 9)), local_index(basis, tmp_path), BLOCK, Recorder(),
+                            min_rate=10 ** 15)
+    with pytest.raises(delta.DeltaError, match='slower than'):
+        encoder.run()
+
+
+def test_should_scale_block_size_with_file_size():
+    assert delta.block_size_for(1024 * 1024, 64 * 1024) == 64 * 1024
+    block = delta.block_size_for(50 * 1024 ** 3, 64 * 1024)
+    assert block == 4 * 1024 * 1024
+    assert 50 * 1024 ** 3 // block <= delta.MAX_BLOCKS
+
+
+def test_should_send_whole_file_when_most_of_it_changed(pool, fs_sftpserver, downloads, monkeypatch, capsys):
+    monkeypatch.setattr(delta, 'WINDOW_BYTES', 16 * BLOCK)
+    write(fs_sftpserver.root + '/movie.mkv', content(100 * BLOCK, 4))
+    source = content(100 * BLOCK, 5)
+    write(downloads + '/movie.mkv', source)
+    results = pool.transfer([{'download_dir': downloads, 'filename': 'movie.mkv', 'dest': 'movie.mkv'}])
+    assert results[0].succeeded
+    assert read(fs_sftpserver.root + '/movie.mkv') == source
+    assert 'whole, no delta: most of the file changed' in capsys.readouterr().out
+
+
+def test_should_send_whole_file_when_remote_cannot_run_the_helper(pool, fs_sftpserver, downloads, monkeypatch,
+                                                                  capsys):
+    monkeypatch.setattr(delta, 'helper_command', lambda *args: 'exit 127')
+    write(fs_sftpserver.root + '/movie.mkv', b'old' * 1000)
+    write(downloads + '/movie.mkv', b'new' * 1000)
+    results = pool.transfer([{'download_dir': downloads, 'filename': 'movie.mkv', 'dest': 'movie.mkv'}])
+    assert results[0].succeeded
+    assert read(fs_sftpserver.root + '/movie.mkv') == b'new' * 1000
+    assert 'could not read remote block checksums' in capsys.readouterr().out
+
+
+def test_should_send_whole_file_when_remote_only_serves_sftp(delta_destination, fs_sftp_only, downloads, capsys):
+    write(fs_sftp_only.root + '/movie.mkv', b'old' * 1000)
+    write(downloads + '/movie.mkv', b'new' * 1000)
+    rule = {'download_dir': downloads, 'filename': 'movie.mkv', 'dest': 'movie.mkv'}
+    assert transfer.TransferPool(delta_destination(fs_sftp_only), 1).transfer([rule])[0].succeeded
+    assert read(fs_sftp_only.root + '/movie.mkv') == b'new' * 1000
+    assert 'remote refused to run the helper' in capsys.readouterr().out
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,47 @@
+import os
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from plexpost import done_listener
+
+
+@pytest.fixture
+def fifo_path(tmp_path):
+    return str(tmp_path / 'plexpost.fifo')
+
+
+def test_should_create_fifo_when_missing(fifo_path):
+    done_listener.ensure_fifo(fifo_path)
+    assert os.path.exists(fifo_path)
+
+
+def test_should_refuse_to_replace_a_regular_file(fifo_path):
+    open(fifo_path, 'w').close()
+    with pytest.raises(ValueError):
+        done_listener.ensure_fifo(fifo_path)
+
+
+def test_should_notify_finished_torrents_written_to_fifo(fifo_path):
+    notified = threading.Event()
+    on_done = Mock(side_effect=lambda ids: notified.set())
+    done_listener.DoneListener(fifo_path, on_done).start()
+    with open(fifo_path, 'w') as fifo:
+        fifo.write('abc123\n')
+    assert notified.wait(5)
+    on_done.assert_called_once_with(['abc123'])
+
+
+def test_should_ignore_blank_signals():
+    on_done = Mock()
+    done_listener.DoneListener('unused', on_done).handle('\n')
+    on_done.assert_not_called()
+
+
+def test_should_keep_listening_when_processing_fails():
+    on_done = Mock(side_effect=Exception('boom'))
+    listener = done_listener.DoneListener('unused', on_done)
+    listener.handle('1\n')
+    listener.handle('2\n')
+    assert on_done.call_count == 2
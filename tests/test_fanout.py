@@ -0,0 +1,108 @@
+import builtins
+import os
+import socket
+
+import pytest
+
+from plexpost import fanout, transfer_journal, archive
+
+
+@pytest.fixture
+def journal():
+    return transfer_journal.TransferJournal()
+
+
+@pytest.fixture
+def target(sftp_destination_for, fs_sftpserver):
+    def create(name, port, remote_dir='/'):
+        return sftp_destination_for(fs_sftpserver, name=name, port=port, remote_dir=remote_dir, block_size=1000,
+                                    request_size=100, wake_timeout=0)
+    return create
+
+
+@pytest.fixture
+def pools(target):
+    def create(servers, journal):
+        return fanout.FanoutTransferPool([target(name, port) for name, port in servers], 2, journal)
+    return create
+
+
+def test_should_read_each_file_once_for_all_targets(pools, journal, fs_sftpserver, fs_mirror, downloads,
+                                                    monkeypatch):
+    pool = pools([('htpc', fs_sftpserver.port), ('mirror', fs_mirror.port)], journal)
+    content = bytes(range(256)) * 64
+    rule = mapping(downloads, 'movies/movie.mkv', content)
+    opened = []
+
+    def counting_open(path, *args, **kwargs):
+        opened.append(path)
+        return open(path, *args, **kwargs)
+    monkeypatch.setattr(archive, 'open', counting_open, raising=False)
+    results = pool.transfer([rule])
+    assert results[0].succeeded
+    assert opened == [downloads + '/movies/movie.mkv']
+    assert read(fs_sftpserver.root + '/movies/movie.mkv') == content
+    assert read(fs_mirror.root + '/movies/movie.mkv') == content
+    assert pool.verify(pool.plan([rule])) == []
+
+
+def test_should_create_directories_for_each_target_on_the_same_host(target, journal, fs_sftpserver, downloads):
+    os.mkdir(fs_sftpserver.root + '/a')
+    os.mkdir(fs_sftpserver.root + '/b')
+    pool = fanout.FanoutTransferPool([target(name, fs_sftpserver.port, '/' + name) for name in ['a', 'b']], 1, journal)
+    assert pool.transfer([mapping(downloads, 'movies/movie.mkv', b'remux')])[0].succeeded
+    assert read(fs_sftpserver.root + '/a/movies/movie.mkv') == b'remux'
+    assert read(fs_sftpserver.root + '/b/movies/movie.mkv') == b'remux'
+
+
+def test_should_reject_targets_sharing_a_name(target, fs_sftpserver):
+    targets = [target('127.0.0.1', fs_sftpserver.port, d) for d in ['/a', '/b']]
+    with pytest.raises(ValueError, match='unique name'):
+        fanout.FanoutTransferPool(targets, 1)
+
+
+def test_should_keep_the_torrent_until_every_target_has_its_copy(pools, journal, fs_sftpserver, downloads):
+    pool = pools([('htpc', fs_sftpserver.port), ('mirror', closed_port())], journal)
+    rule = mapping(downloads, 'movie.mkv', b'remux')
+    results = pool.transfer([rule])
+    assert not results[0].succeeded
+    assert read(fs_sftpserver.root + '/movie.mkv') == b'remux'
+    assert not pool.is_transferred(rule)
+
+
+def test_should_only_send_to_targets_that_missed_the_file(pools, journal, fs_sftpserver, fs_mirror, downloads,
+                                                         capsys):
+    rule = mapping(downloads, 'movie.mkv', b'remux')
+    pools([('htpc', fs_sftpserver.port), ('mirror', closed_port())], journal).transfer([rule])
+    capsys.readouterr()
+    pool = pools([('htpc', fs_sftpserver.port), ('mirror', fs_mirror.port)], journal)
+    results = pool.transfer([rule])
+    assert results[0].succeeded
+    out = capsys.readouterr().out
+    assert 'Skipping movie.mkv, already transferred' in out
+    assert 'Transferring movie.mkv to mirror' in out
+    assert read(fs_mirror.root + '/movie.mkv') == b'remux'
+    assert pool.is_transferred(rule)
+    pool.forget([rule['dest']])
+    assert journal.get('movie.mkv') is None and journal.get('mirror:movie.mkv') is None
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def mapping(downloads, filename, content):
+    path = downloads + '/' + filename
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return {'download_dir': downloads, 'filename': filename, 'dest': filename}
+
+
+def read(path):
+    with builtins.open(path, 'rb') as f:
+        return f.read()
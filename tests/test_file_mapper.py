@@ -4,7 +4,8 @@ from unittest.mock import Mock
 
 import pytest
 
-from plexpost import post_processor, movies_flow
+from plexpost import post_processor, movies_flow, file_mapper
+from plexpost.sftp_destination import SFTPDestination
 from plexpost.sftp_factory import SFTPFactory
 
 
@@ -12,11 +13,11 @@ from plexpost.sftp_factory import SFTPFactory
 def automator(transmission, sftpserver, remote_base_dir, download_dir):
     return post_processor.PostProcessor(transmission,
                                         Mock(),
-                                        SFTPFactory({'url': sftpserver.host,
-                                                     'port': sftpserver.port,
-                                                     'username': 'user',
-                                                     'password': '',
-                                                     'remote_dir': remote_base_dir}),
+                                        SFTPDestination(SFTPFactory({'url': sftpserver.host,
+                                                                     'port': sftpserver.port,
+                                                                     'username': 'user',
+                                                                     'password': '',
+                                                                     'remote_dir': remote_base_dir})),
                                         movies_flow.MoviePostProcessor({'download_dir_tag': download_dir}))
 
 
@@ -183,3 +184,14 @@ def touch(prefix, file):
     with open(path, 'a'):
         os.utime(path)
     return file
+
+
+def test_should_classify_every_file_in_one_pass(download_dir):
+    files = ['dir/video.mkv', 'dir/video.srt', 'dir/rel.rar', 'dir/rel.r00', 'dir/release.nfo']
+    tor = completed_torrent_with_data_files(download_dir, files)
+    tor.files.return_value[3]['completed'] = 0
+    classified = file_mapper.classify(tor)
+    assert [f['name'] for f in classified.videos] == ['dir/video.mkv']
+    assert [f['name'] for f in classified.subtitles] == ['dir/video.srt']
+    assert classified.archives == []
+    assert tor.files.call_count == 1
@@ -0,0 +1,45 @@
+from unittest.mock import Mock
+
+from plexpost import flow_index, movies_flow, show_flow, default_flow
+
+
+def torrent(download_dir):
+    t = Mock()
+    t.downloadDir = download_dir
+    return t
+
+
+def test_should_send_each_torrent_to_its_flow():
+    index = flow_index.FlowIndex([movies_flow.MoviePostProcessor({'download_dir_tag': '/downloads/movies'}),
+                                  show_flow.ShowPostProcessor({'download_dir_tag': '/downloads/tv'}),
+                                  default_flow.DefaultPostProcessor({'download_dir_tag': '/downloads'})])
+    assert index.lookup(torrent('/downloads/movies')) == 0
+    assert index.lookup(torrent('/downloads/tv/Show/1')) == 1
+    assert index.lookup(torrent('/downloads')) == 2
+    assert index.lookup(torrent('/downloads/movies/extra')) is None
+    assert index.lookup(torrent('/elsewhere')) is None
+
+
+def test_should_match_like_the_flow_filters():
+    flows = [show_flow.ShowPostProcessor({'download_dir_tag': '/downloads/tv'}),
+             movies_flow.MoviePostProcessor({'download_dir_tag': '/downloads/tv2'})]
+    index = flow_index.FlowIndex(flows)
+    for path in ['/downloads/tv', '/downloads/tv2', '/downloads/tv/Show/1', '/downloads/t', '']:
+        expected = next((i for i, f in enumerate(flows) if f.filter(torrent(path))), None)
+        assert index.lookup(torrent(path)) == expected
+
+
+def test_should_prefer_the_first_registered_flow():
+    index = flow_index.FlowIndex([default_flow.DefaultPostProcessor({'download_dir_tag': '/downloads/tv/Show/1'}),
+                                  show_flow.ShowPostProcessor({'download_dir_tag': '/downloads/tv'})])
+    assert index.lookup(torrent('/downloads/tv/Show/1')) == 0
+    assert index.lookup(torrent('/downloads/tv/Show/2')) == 1
+
+
+def test_should_ask_flows_without_a_tag_match_in_registration_order():
+    custom = Mock(spec=['filter'])
+    custom.filter.return_value = True
+    index = flow_index.FlowIndex([movies_flow.MoviePostProcessor({'download_dir_tag': '/downloads/movies'}), custom])
+    assert index.lookup(torrent('/downloads/movies')) == 0
+    assert index.lookup(torrent('/somewhere')) == 1
+    custom.filter.assert_called_once()
@@ -0,0 +1,26 @@
+from requests import ConnectionError
+
+from plexpost import htpc_switch
+
+
+def test_should_collapse_repeated_wakes_into_one_call(requests):
+    switch = htpc_switch.HTPCSwitch('127.0.0.1', '123123', 'htpc')
+    for _ in range(3):
+        switch.turn_on()
+    requests.Session.return_value.post.assert_called_once()
+
+
+def test_should_turn_on_switch_again_once_our_last_turn_on_is_old(requests):
+    switch = htpc_switch.HTPCSwitch('127.0.0.1', '123123', 'htpc', state_ttl=0)
+    switch.turn_on()
+    switch.turn_on()
+    assert requests.Session.return_value.post.call_count == 2
+
+
+def test_should_not_fail_when_home_assistant_is_unavailable(requests):
+    session = requests.Session.return_value
+    session.get.side_effect = ConnectionError('down')
+    session.post.side_effect = ConnectionError('down')
+    switch = htpc_switch.HTPCSwitch('127.0.0.1', '123123', 'htpc')
+    switch.turn_on()
+    assert switch.turned_on is None
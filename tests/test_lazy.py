@@ -0,0 +1,11 @@
+import sys
+
+from plexpost import lazy
+
+
+def test_should_import_module_on_first_attribute_access(monkeypatch):
+    monkeypatch.delitem(sys.modules, 'colorsys', raising=False)
+    module = lazy.Module('colorsys')
+    assert 'colorsys' not in sys.modules
+    assert module.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+    assert 'colorsys' in sys.modules
@@ -0,0 +1,95 @@
+import errno
+import os
+from unittest.mock import Mock
+
+import pytest
+
+from plexpost import local_destination, post_processor, default_flow, transfer
+
+
+@pytest.fixture
+def library(tmp_path):
+    path = tmp_path / 'library'
+    path.mkdir()
+    return str(path)
+
+
+def test_should_hardlink_when_on_the_same_filesystem(downloads, library):
+    src = write(downloads, 'movie.mkv', b'remux')
+    assert local_destination.place_file(src, library + '/movie.mkv', ['link', 'copy']) == 'link'
+    assert os.path.samefile(src, library + '/movie.mkv')
+
+
+def test_should_fall_back_to_a_copy_when_linking_fails(downloads, library, monkeypatch):
+    def cross_device(src, dest):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(local_destination, 'PLACEMENTS', dict(local_destination.PLACEMENTS, link=cross_device))
+    src = write(downloads, 'movie.mkv', b'remux' * 1000)
+    assert local_destination.place_file(src, library + '/movie.mkv', ['link', 'copy']) == 'copy'
+    assert read(library + '/movie.mkv') == b'remux' * 1000
+    assert not os.path.lexists(library + '/movie.mkv.plexpost')
+
+
+def test_should_defer_a_copy_that_was_admitted_for_a_link(downloads, library, monkeypatch):
+    def protected(src, dest):
+        raise OSError(errno.EPERM, 'Operation not permitted')
+    monkeypatch.setattr(local_destination, 'PLACEMENTS', dict(local_destination.PLACEMENTS, link=protected))
+    monkeypatch.setattr(local_destination.LocalSession, 'free_space', lambda session: 100)
+    destination = local_destination.LocalDestination({'path': library, 'methods': ['link', 'copy'],
+                                                      'free_space_reserve': 0})
+    pool = transfer.TransferPool(destination, 1)
+    write(downloads, 'small.mkv', b's' * 10)
+    write(downloads, 'large.mkv', b'l' * 1000)
+    small, large = pool.plan([{'download_dir': downloads, 'filename': f, 'dest': f}
+                              for f in ['small.mkv', 'large.mkv']])
+    assert pool.remaining_bytes(large) == 0
+    assert pool.transfer_planned([small])[0].succeeded
+    assert pool.remaining_bytes(large) == 1000
+    destination.shares_blocks = True  # As if admitted before the first fallback
+    assert pool.transfer_planned([large])[0].deferred
+    assert not os.path.lexists(library + '/large.mkv')
+
+
+def test_should_copy_with_sendfile_without_copy_file_range(downloads, library, monkeypatch):
+    monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    src = write(downloads, 'movie.mkv', bytes(range(256)) * 100)
+    local_destination.kernel_copy(src, library + '/movie.mkv')
+    assert read(library + '/movie.mkv') == bytes(range(256)) * 100
+
+
+def test_should_replace_an_outdated_copy(downloads, library):
+    src = write(downloads, 'movie.mkv', b'new')
+    write(library, 'movie.mkv', b'old copy')
+    local_destination.place_file(src, library + '/movie.mkv', ['link'])
+    assert read(library + '/movie.mkv') == b'new'
+
+
+def test_should_place_mapped_files_and_remove_torrent(downloads, library, transmission):
+    destination = local_destination.LocalDestination({'path': library})
+    pool = transfer.TransferPool(destination, 2)
+    processor = post_processor.PostProcessor(transmission, Mock(), destination,
+                                             default_flow.DefaultPostProcessor({'download_dir_tag': downloads}),
+                                             pool)
+    write(downloads, 'Show/episode.mkv', b'episode')
+    torrent = Mock(id=1, progress=100, downloadDir=downloads)
+    torrent.name = 'Show'
+    torrent.files.return_value = {0: {'name': 'Show/episode.mkv', 'size': 7, 'completed': 7, 'selected': True}}
+    transmission.get_torrents.return_value = [torrent]
+    processor.run()
+    assert read(library + '/downloads/Show/episode.mkv') == b'episode'
+    assert pool.verify(pool.plan([{'download_dir': library, 'filename': 'downloads/Show/episode.mkv',
+                                   'dest': 'downloads/Show/episode.mkv'}])) == []
+    transmission.remove_torrent.assert_called_once_with([1], delete_data=False)
+
+
+def write(directory, filename, content):
+    path = os.path.join(directory, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,70 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from plexpost import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+def test_should_render_counters_per_label(registry):
+    registry.count('bytes_total', 100, flow='movie')
+    registry.count('bytes_total', 50, flow='movie')
+    registry.count('bytes_total', 10, flow='show')
+    rendered = registry.render()
+    assert '# TYPE plexpost_bytes_total counter' in rendered
+    assert 'plexpost_bytes_total{flow="movie"} 150' in rendered
+    assert 'plexpost_bytes_total{flow="show"} 10' in rendered
+
+
+def test_should_summarize_phase_timings(registry):
+    registry.observe('map', 0.5, flow='show')
+    registry.observe('map', 1.5, flow='show')
+    with registry.timed('poll'):
+        pass
+    rendered = registry.render()
+    assert 'plexpost_phase_seconds_sum{flow="show",phase="map"} 2.0' in rendered
+    assert 'plexpost_phase_seconds_count{flow="show",phase="map"} 2' in rendered
+    assert 'plexpost_phase_seconds_max{flow="show",phase="map"} 1.5' in rendered
+    assert 'plexpost_phase_seconds_count{phase="poll"} 1' in rendered
+
+
+def test_should_leave_out_missing_labels(registry):
+    registry.count('files_total', flow=None)
+    assert 'plexpost_files_total 1' in registry.render()
+
+
+def test_should_escape_label_values(registry):
+    registry.count('torrents_total', flow='a "quoted" \\ name')
+    assert 'plexpost_torrents_total{flow="a \\"quoted\\" \\\\ name"} 1' in registry.render()
+
+
+def test_should_append_phases_to_trace(registry, tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    registry.open_trace(path)
+    registry.observe('transfer', 2.0, flow='movie')
+    registry.observe('cleanup', 0.1, flow='movie')
+    with open(path) as f:
+        events = [json.loads(line) for line in f]
+    assert [(e['phase'], e['flow'], e['seconds']) for e in events] == [('transfer', 'movie', 2.0),
+                                                                       ('cleanup', 'movie', 0.1)]
+
+
+def test_should_serve_metrics_over_http(registry):
+    registry.count('torrents_total', flow='movie')
+    server = metrics.MetricsServer(('127.0.0.1', 0), registry)
+    server.start()
+    try:
+        url = 'http://127.0.0.1:' + str(server.server_address[1])
+        with urllib.request.urlopen(url + '/metrics') as response:
+            assert 'plexpost_torrents_total{flow="movie"} 1' in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other')
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -4,6 +4,7 @@ import pytest
 from transmissionrpc import Torrent
 
 from plexpost import post_processor, movies_flow
+from plexpost.sftp_destination import SFTPDestination
 from plexpost.sftp_factory import SFTPFactory
 
 
@@ -11,11 +12,11 @@ from plexpost.sftp_factory import SFTPFactory
 def automator(transmission, sftpserver, remote_base_dir, download_dir):
     return post_processor.PostProcessor(transmission,
                                         Mock(),
-                                        SFTPFactory({'url': sftpserver.host,
-                                                     'port': sftpserver.port,
-                                                     'username': 'user',
-                                                     'password': '',
-                                                     'remote_dir': remote_base_dir}),
+                                        SFTPDestination(SFTPFactory({'url': sftpserver.host,
+                                                                     'port': sftpserver.port,
+                                                                     'username': 'user',
+                                                                     'password': '',
+                                                                     'remote_dir': remote_base_dir})),
                                         movies_flow.MoviePostProcessor({'download_dir_tag': download_dir}))
 
 
@@ -26,7 +27,7 @@ def test_should_only_process_downloads_when_they_are_in_the_movies_folder(automa
                 create_torrent(2, 0, 'tmp')]
     transmission.get_torrents.return_value = torrents
     automator.run()
-    transmission.remove_torrent.assert_called_once_with(1)
+    transmission.remove_torrent.assert_called_once_with([1], delete_data=False)
 
 
 def create_torrent(id, size_left, download_dir):
@@ -0,0 +1,120 @@
+import asyncio
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from transmissionrpc import Torrent
+
+from plexpost import pipeline, torrent_poller, transfer
+
+
+def test_should_finalize_completed_torrents(source):
+    movies = flow('tmp/movies')
+    movie = create_torrent(1, 0, 'tmp/movies')
+    source.current.return_value = [movie, create_torrent(2, 1, 'tmp/movies')]
+    engine = create_pipeline(source, [movies])
+    run_for(engine, 0.3)
+    movies.wake_htpc.assert_called_once()
+    movies.finished.assert_called_once()
+    assert movies.finished.call_args[0][0].torrents == [movie]
+    source.forget.assert_called_once_with([movie])
+
+
+def test_should_not_hold_back_other_flows_behind_a_slow_upload(source):
+    movies = flow('tmp/movies')
+    shows = flow('tmp/shows')
+    movies.transfer_to_htpc.side_effect = lambda planned: time.sleep(1) or []
+    source.current.return_value = [create_torrent(1, 0, 'tmp/movies'), create_torrent(2, 0, 'tmp/shows')]
+    engine = create_pipeline(source, [movies, shows])
+    run_for(engine, 0.3)
+    shows.finished.assert_called_once()
+    movies.finished.assert_not_called()
+
+
+def test_should_hand_every_woken_torrent_to_the_transfer_pool(source):
+    movies = flow('tmp/movies')
+    shows = flow('tmp/shows')
+    movies.transfer_to_htpc.side_effect = lambda planned: time.sleep(1) or []
+    source.current.return_value = [create_torrent(1, 0, 'tmp/movies'), create_torrent(2, 0, 'tmp/movies'),
+                                   create_torrent(3, 0, 'tmp/shows')]
+    engine = create_pipeline(source, [movies, shows])
+    run_for(engine, 0.3)
+    assert movies.transfer_to_htpc.call_count == 2
+    shows.finished.assert_called_once()
+
+
+def test_should_retry_torrents_whose_upload_does_not_verify(source):
+    movies = flow('tmp/movies')
+    movies.transfer_pool.verify.return_value = ['Torrent 1']
+    source.current.return_value = [create_torrent(1, 0, 'tmp/movies')]
+    engine = create_pipeline(source, [movies], 0.1)
+    run_for(engine, 0.3)
+    movies.finished.assert_not_called()
+    assert engine.in_flight == set()
+    assert movies.transfer_to_htpc.call_count > 1
+
+
+def test_should_fetch_signalled_torrents(source):
+    movies = flow('tmp/movies')
+    movie = create_torrent(1, 0, 'tmp/movies')
+    source.current.return_value = []
+    source.fetch.return_value = [movie]
+    engine = create_pipeline(source, [movies])
+
+    async def signal_after_start():
+        await asyncio.sleep(0.05)
+        engine.signal(['abc'])
+    run_for(engine, 0.3, signal_after_start())
+    source.fetch.assert_called_once_with(['abc'])
+    source.forget.assert_called_once_with([movie])
+
+
+def test_should_poll_in_full_while_signals_keep_arriving(source):
+    source.current.return_value = []
+    source.fetch.return_value = []
+    engine = create_pipeline(source, [flow('tmp/movies')], 0.2)
+
+    async def keep_signalling():
+        while True:
+            await asyncio.sleep(0.05)
+            engine.signal(['abc'])
+    run_for(engine, 0.5, keep_signalling())
+    assert source.current.call_count >= 2
+
+
+@pytest.fixture
+def source():
+    return Mock()
+
+
+def create_pipeline(source, flows, poll_seconds=10):
+    return pipeline.Pipeline(torrent_poller.TorrentPoller(source, flows), poll_seconds)
+
+
+def run_for(engine, seconds, *tasks):
+    async def bounded():
+        try:
+            await asyncio.wait_for(asyncio.gather(engine.run(), *tasks), seconds)
+        except asyncio.TimeoutError:
+            pass
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(bounded())
+    finally:
+        loop.close()
+
+
+def flow(download_dir):
+    proc = Mock()
+    proc.media_processor.filter.side_effect = lambda t: t.downloadDir == download_dir
+    proc.map_files.side_effect = lambda torrents: [{'filename': t.name} for t in torrents]
+    proc.transfer_pool.plan.side_effect = lambda mappings, until, flow: [Mock(rule=r) for r in mappings]
+    proc.transfer_to_htpc.side_effect = lambda planned: [transfer.TransferResult(p.rule) for p in planned]
+    proc.transfer_pool.verify.return_value = []
+    return proc
+
+
+def create_torrent(id, size_left, download_dir):
+    return Torrent(None, {'id': id, 'name': 'Torrent ' + str(id), 'sizeWhenDone': 1, 'leftUntilDone': size_left,
+                          'downloadDir': download_dir})
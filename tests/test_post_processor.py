@@ -1,11 +1,13 @@
 import errno
 import os
-from unittest.mock import Mock, call
+import socket
+from unittest.mock import Mock
 
 import pytest
-from transmissionrpc import Torrent
+from transmissionrpc import Torrent, TransmissionError
 
-from plexpost import post_processor, htpc_switch, default_flow
+from plexpost import post_processor, htpc_switch, default_flow, transfer, metrics
+from plexpost.sftp_destination import SFTPDestination
 from plexpost.sftp_factory import SFTPFactory
 
 
@@ -13,11 +15,11 @@ from plexpost.sftp_factory import SFTPFactory
 def automator(transmission, sftpserver, remote_base_dir, download_dir):
     return post_processor.PostProcessor(transmission,
                                         Mock(),
-                                        SFTPFactory({'url': sftpserver.host,
-                                                     'port': sftpserver.port,
-                                                     'username': 'user',
-                                                     'password': '',
-                                                     'remote_dir': remote_base_dir}),
+                                        SFTPDestination(SFTPFactory({'url': sftpserver.host,
+                                                                     'port': sftpserver.port,
+                                                                     'username': 'user',
+                                                                     'password': '',
+                                                                     'remote_dir': remote_base_dir})),
                                         default_flow.DefaultPostProcessor({'download_dir_tag': download_dir}))
 
 
@@ -27,23 +29,34 @@ def test_should_only_remove_torrents_when_they_are_completed(automator, transmis
                 create_torrent(3, 0, download_dir)]
     transmission.get_torrents.return_value = torrents
     automator.run()
-    transmission.remove_torrent.assert_has_calls([call(1), call(3)], any_order=True)
+    transmission.remove_torrent.assert_called_once_with([1, 3], delete_data=False)
 
 
 def test_should_wake_htpc_when_torrent_is_complete(completed_torrents, automator, requests, download_dir):
     torrents = [create_torrent(1, 0, download_dir)]
     completed_torrents.return_value = torrents
     automator.htpc = htpc_switch.HTPCSwitch('127.0.0.1', '123123', 'htpc')
+    automator.destination = SFTPDestination(SFTPFactory({'url': '127.0.0.1', 'port': closed_port(),
+                                                         'username': 'user', 'remote_dir': '/'}))
     automator.run()
-    requests.post.assert_called_with('http://127.0.0.1:8123/api/services/switch/turn_on',
-                                     json={'entity_id': 'switch.htpc'},
-                                     headers={'Authorization': 'Bearer 123123'})
+    session = requests.Session.return_value
+    session.headers.update.assert_called_with({'Authorization': 'Bearer 123123'})
+    session.post.assert_called_with('http://127.0.0.1:8123/api/services/switch/turn_on',
+                                    json={'entity_id': 'switch.htpc'},
+                                    timeout=5)
+
+
+def test_should_not_wake_htpc_when_it_is_already_reachable(completed_torrents, automator, requests, download_dir):
+    completed_torrents.return_value = [create_torrent(1, 0, download_dir)]
+    automator.htpc = htpc_switch.HTPCSwitch('127.0.0.1', '123123', 'htpc')
+    automator.run()
+    requests.Session.return_value.post.assert_not_called()
 
 
 def test_should_not_wake_htpc_when_no_torrents_complete(completed_torrents, automator, requests):
     completed_torrents.return_value = []
     automator.run()
-    requests.post.assert_not_called()
+    requests.Session.return_value.post.assert_not_called()
 
 
 @pytest.mark.parametrize('download_dir', ['tmp/cleanup_top_level_files_when_download_is_complete'])
@@ -113,6 +126,122 @@ def test_should_ignore_missing_files_in_torrent(completed_torrents, automator, d
     assert not os.path.lexists(download_dir + '/dir')
 
 
+@pytest.mark.parametrize('download_dir', ['tmp/leave_data_to_transmission_when_deleting_data'])
+def test_should_leave_data_removal_to_transmission_when_deleting_data(completed_torrents, automator, transmission,
+                                                                      download_dir):
+    automator.delete_data = True
+    completed_torrents.return_value = [completed_torrent_with_data_files(download_dir, ['file'])]
+    automator.run()
+    transmission.remove_torrent.assert_called_once_with([1], delete_data=True)
+    assert os.path.isfile(download_dir + '/file')
+
+
+@pytest.mark.parametrize('download_dir', ['tmp/cleanup_locally_when_transmission_cannot_delete_data'])
+def test_should_cleanup_locally_when_transmission_cannot_delete_data(completed_torrents, automator, transmission,
+                                                                     download_dir):
+    automator.delete_data = True
+    transmission.remove_torrent.side_effect = [TransmissionError('failed'), None]
+    completed_torrents.return_value = [completed_torrent_with_data_files(download_dir, ['file'])]
+    automator.run()
+    transmission.remove_torrent.assert_called_with([1], delete_data=False)
+    assert not os.path.isfile(download_dir + '/file')
+
+
+def test_should_not_call_transmission_when_nothing_to_remove(completed_torrents, automator, transmission):
+    completed_torrents.return_value = []
+    automator.run()
+    transmission.remove_torrent.assert_not_called()
+
+
+@pytest.mark.parametrize('download_dir', ['tmp/upload_finished_files_of_downloading_torrent'])
+def test_should_upload_finished_files_of_downloading_torrent(automator, transmission, sftpclient, remote_base_dir,
+                                                             download_dir):
+    tor = completed_torrent_with_data_files(download_dir, ['done.mkv', 'downloading.mkv'])
+    tor.progress = 50
+    tor.files.return_value[1]['completed'] = 0
+    post_processor.process_batches([automator.select_partial([tor])])
+    assert sftpclient.isfile(remote_base_dir + '/downloads/done.mkv')
+    assert not sftpclient.exists(remote_base_dir + '/downloads/downloading.mkv')
+    assert os.path.isfile(download_dir + '/done.mkv')
+    transmission.remove_torrent.assert_not_called()
+    assert automator.map_completed_files([tor]) == []
+
+
+def test_should_finalize_flows_whose_files_all_transferred():
+    movie = {'filename': 'movie.mkv'}
+    episode = {'filename': 'episode.mkv'}
+    movies = Mock()
+    shows = Mock()
+    movies.map_files.return_value = [movie]
+    shows.map_files.return_value = [episode]
+    movies.transfer_pool.plan.side_effect = lambda mappings, until, flow: [Mock(rule=r) for r in mappings]
+    movies.transfer_to_htpc.side_effect = lambda planned: [
+        transfer.TransferResult(p.rule, IOError('failed') if p.rule is episode else None) for p in planned]
+    batches = [post_processor.Batch(movies, [Mock()]), post_processor.Batch(shows, [Mock()])]
+    with pytest.raises(transfer.TransferError):
+        post_processor.process_batches(batches)
+    movies.wake_htpc.assert_called_once()
+    movies.transfer_to_htpc.assert_called_once()
+    movies.finished.assert_called_once_with(batches[0])
+    shows.finished.assert_not_called()
+
+
+def test_should_remove_torrents_of_every_flow_in_one_call():
+    movies = Mock(delete_data=False)
+    shows = Mock(delete_data=False)
+    movies.map_files.return_value = [{'filename': 'movie.mkv'}]
+    shows.map_files.return_value = [{'filename': 'episode.mkv'}]
+    movies.transfer_pool.plan.side_effect = lambda mappings, until, flow: [Mock(rule=r) for r in mappings]
+    shows.transfer_pool = movies.transfer_pool
+    movies.transfer_to_htpc.side_effect = lambda planned: [transfer.TransferResult(p.rule) for p in planned]
+    movie, episode = Mock(), Mock()
+    post_processor.process_batches([post_processor.Batch(movies, [movie]), post_processor.Batch(shows, [episode])])
+    movies.clean_up.assert_called_once_with([movie])
+    shows.clean_up.assert_called_once_with([episode])
+    movies.remove_torrents_from_client.assert_called_once_with([movie, episode])
+    shows.remove_torrents_from_client.assert_not_called()
+
+
+def test_should_keep_flows_with_deferred_files_queued():
+    movie = {'filename': 'movie.mkv'}
+    movies = Mock()
+    movies.map_files.return_value = [movie]
+    movies.transfer_pool.plan.side_effect = lambda mappings, until, flow: [Mock(rule=r) for r in mappings]
+    movies.transfer_to_htpc.side_effect = lambda planned: [
+        transfer.TransferResult(p.rule, transfer.InsufficientSpaceError('full')) for p in planned]
+    batch = post_processor.Batch(movies, [Mock()])
+    post_processor.process_batches([batch])
+    movies.finished.assert_not_called()
+    assert not batch.finalized
+
+
+def test_should_keep_processing_other_flows_when_one_cannot_be_planned(monkeypatch):
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    movie = {'filename': 'movie.mkv'}
+    movies = Mock()
+    shows = Mock()
+    movies.map_files.return_value = [movie]
+    shows.map_files.side_effect = PermissionError('denied')
+    movies.transfer_pool.plan.side_effect = lambda mappings, until, flow: [Mock(rule=r) for r in mappings]
+    shows.transfer_pool = movies.transfer_pool  # Flows share one transfer pool
+    movies.transfer_to_htpc.side_effect = lambda planned: [transfer.TransferResult(p.rule) for p in planned]
+    batches = [post_processor.Batch(shows, [Mock()]), post_processor.Batch(movies, [Mock()])]
+    post_processor.process_batches(batches)
+    assert [p.rule for p in movies.transfer_to_htpc.call_args[0][0]] == [movie]
+    movies.finished.assert_called_once_with(batches[1])
+    shows.finished.assert_not_called()
+    assert 'retries_total' not in registry.render()
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
 def create_torrent(id, size_left, download_dir):
     name = 'Torrent ' + str(id)
     fields = {'id': id, 'name': name, 'sizeWhenDone': 1, 'leftUntilDone': size_left, 'downloadDir': download_dir}
@@ -0,0 +1,43 @@
+import socket
+
+import pytest
+from paramiko import SSHException
+
+from plexpost.sftp_factory import SFTPFactory
+
+
+def test_should_report_listening_remote_as_reachable(sftpserver):
+    assert create_factory(sftpserver.host, sftpserver.port).is_reachable()
+
+
+def test_should_report_closed_port_as_unreachable():
+    assert not create_factory('127.0.0.1', closed_port()).is_reachable()
+
+
+def test_should_give_up_waiting_for_remote_after_wake_timeout():
+    factory = create_factory('127.0.0.1', closed_port(), wake_timeout=0)
+    with pytest.raises(SSHException):
+        factory.await_connection()
+
+
+def test_should_connect_once_remote_is_reachable(sftpserver):
+    transport = create_factory(sftpserver.host, sftpserver.port).await_connection()
+    assert transport.is_authenticated()
+    transport.close()
+
+
+def create_factory(host, port, wake_timeout=120):
+    return SFTPFactory({'url': host,
+                        'port': port,
+                        'username': 'user',
+                        'password': '',
+                        'remote_dir': '/',
+                        'wake_timeout': wake_timeout})
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
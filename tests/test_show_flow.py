@@ -1,11 +1,12 @@
 import errno
 import os
-from unittest.mock import Mock, call
+from unittest.mock import Mock
 
 import pytest
 from transmissionrpc import Torrent
 
-from plexpost import post_processor, show_flow
+from plexpost import post_processor, show_flow, file_mapper
+from plexpost.sftp_destination import SFTPDestination
 from plexpost.sftp_factory import SFTPFactory
 
 
@@ -13,11 +14,11 @@ from plexpost.sftp_factory import SFTPFactory
 def automator(transmission, sftpserver, remote_base_dir, download_dir):
     return post_processor.PostProcessor(transmission,
                                         Mock(),
-                                        SFTPFactory({'url': sftpserver.host,
-                                                     'port': sftpserver.port,
-                                                     'username': 'user',
-                                                     'password': '',
-                                                     'remote_dir': remote_base_dir}),
+                                        SFTPDestination(SFTPFactory({'url': sftpserver.host,
+                                                                     'port': sftpserver.port,
+                                                                     'username': 'user',
+                                                                     'password': '',
+                                                                     'remote_dir': remote_base_dir})),
                                         show_flow.ShowPostProcessor({'download_dir_tag': download_dir}))
 
 
@@ -29,7 +30,7 @@ def test_should_process_any_download_when_they_are_under_the_shows_folder(automa
                 create_torrent(3, 0, 'tmp/tv/Another Show')]
     transmission.get_torrents.return_value = torrents
     automator.run()
-    transmission.remove_torrent.assert_has_calls([call(1), call(3)], any_order=True)
+    transmission.remove_torrent.assert_called_once_with([1, 3], delete_data=False)
 
 
 @pytest.mark.parametrize('download_dir', ['tmp/Show Name/2'])
@@ -44,6 +45,39 @@ def test_should_put_in_show_name_season_subdirectory(completed_torrents,
     assert sftpclient.isfile(remote_base_dir + '/tv/Show Name/2/' + video)
 
 
+def test_should_map_every_episode_of_a_season_pack():
+    flow = show_flow.ShowPostProcessor({'download_dir_tag': 'tmp/tv', 'season_packs': True})
+    files = ['Show.S02.1080p/Show.S02E01.1080p.mkv',
+             'Show.S02.1080p/Show.S02E02.1080p.mkv',
+             'Show.S02.1080p/Sample/show.s02e02.sample.mkv',
+             'Show.S02.1080p/Subs/Show.S02E01.1080p/2_English.srt',
+             'Show.S02.1080p/Show.S02E02.1080p.en.srt',
+             'Show.S02.1080p/Subs/extras.srt']
+    tor = completed_torrent_with_data_files('tmp/tv/Show/2', files)
+    tor.files.return_value[0]['size'] = tor.files.return_value[1]['size'] = 100
+    assert [(r['filename'], r['dest']) for r in flow.map_files(tor)] == [
+        (files[0], 'tv/Show/2/Show.S02E01.1080p.mkv'),
+        (files[1], 'tv/Show/2/Show.S02E02.1080p.mkv'),
+        (files[3], 'tv/Show/2/Show.S02E01.1080p.2_English.srt'),
+        (files[4], 'tv/Show/2/Show.S02E02.1080p.en.srt')]
+
+
+def test_should_map_single_episode_download_with_season_packs_enabled():
+    flow = show_flow.ShowPostProcessor({'download_dir_tag': 'tmp/tv', 'season_packs': True})
+    tor = completed_torrent_with_data_files('tmp/tv/Show/2', ['Show.S02E01/Show.S02E01.mkv'])
+    assert [r['dest'] for r in flow.map_files(tor)] == ['tv/Show/2/Show.S02E01/Show.S02E01.mkv']
+
+
+@pytest.mark.parametrize('path, episode', [('Show.S01E02.mkv', (1, 2)),
+                                           ('show.s1.e12.mkv', (1, 12)),
+                                           ('Show 3x07 Title.mkv', (3, 7)),
+                                           ('S04E05/video.mkv', (4, 5)),
+                                           ('Show.1920x1080.mkv', None),
+                                           ('Show.mkv', None)])
+def test_should_parse_episode_tokens(path, episode):
+    assert file_mapper.parse_episode(path) == episode
+
+
 def create_torrent(id, size_left, download_dir):
     name = 'Torrent ' + str(id)
     fields = {'id': id, 'name': name, 'sizeWhenDone': 1, 'leftUntilDone': size_left, 'downloadDir': download_dir}
@@ -0,0 +1,17 @@
+from plexpost import snapshot
+
+
+def test_should_restore_saved_state(tmp_path):
+    path = str(tmp_path / 'snapshot.json')
+    snapshot.save(path, {'transfers': {'remote_dirs': [['remote', 'movies']]}})
+    assert snapshot.load(path)['transfers'] == {'remote_dirs': [['remote', 'movies']]}
+    assert not (tmp_path / 'snapshot.json.part').exists()
+
+
+def test_should_start_cold_without_usable_snapshot(tmp_path):
+    assert snapshot.load(str(tmp_path / 'missing.json')) == {}
+    assert snapshot.load('') == {}
+    (tmp_path / 'broken.json').write_text('{"poller": ')
+    assert snapshot.load(str(tmp_path / 'broken.json')) == {}
+    (tmp_path / 'old.json').write_text('{"version": 0}')
+    assert snapshot.load(str(tmp_path / 'old.json')) == {}
@@ -0,0 +1,208 @@
+from unittest.mock import Mock
+
+import json
+
+import pytest
+from transmissionrpc import Torrent
+
+from plexpost import post_processor, torrent_poller, default_flow, movies_flow, show_flow
+
+
+@pytest.fixture
+def flows():
+    return [post_processor.PostProcessor(Mock(), Mock(), Mock(), movies_flow.MoviePostProcessor(
+                {'download_dir_tag': 'tmp/movies'})),
+            post_processor.PostProcessor(Mock(), Mock(), Mock(), show_flow.ShowPostProcessor(
+                {'download_dir_tag': 'tmp'})),
+            post_processor.PostProcessor(Mock(), Mock(), Mock(), default_flow.DefaultPostProcessor(
+                {'download_dir_tag': 'tmp'}))]
+
+
+@pytest.fixture
+def poller(transmission, flows, monkeypatch):
+    monkeypatch.setattr(post_processor, 'process_batches', Mock())
+    for f in flows:
+        f.select = Mock(wraps=f.select)
+    return torrent_poller.TorrentPoller(torrent_poller.FullTorrentSource(transmission), flows)
+
+
+def test_should_fetch_torrents_once_per_tick_for_all_flows(poller, transmission):
+    transmission.get_torrents.return_value = [create_torrent(1, 0, 'tmp/movies')]
+    poller.run()
+    transmission.get_torrents.assert_called_once()
+
+
+def test_should_give_each_flow_only_the_completed_torrents_it_accepts(poller, transmission, flows):
+    movie = create_torrent(1, 0, 'tmp/movies')
+    show = create_torrent(2, 0, 'tmp/Show/1')
+    incomplete = create_torrent(3, 1, 'tmp/movies')
+    transmission.get_torrents.return_value = [movie, show, incomplete]
+    poller.run()
+    flows[0].select.assert_called_once_with([movie])
+    flows[1].select.assert_called_once_with([show])
+
+
+def test_should_let_only_the_first_matching_flow_claim_a_torrent(poller, transmission, flows):
+    download = create_torrent(1, 0, 'tmp')
+    transmission.get_torrents.return_value = [download]
+    poller.run()
+    flows[1].select.assert_called_once_with([download])
+    flows[2].select.assert_called_once_with([])
+
+
+def test_should_process_only_the_signalled_torrents(poller, transmission, flows):
+    movie = create_torrent(1, 0, 'tmp/movies')
+    transmission.get_torrents.return_value = [movie]
+    poller.run_torrents(['abc'])
+    assert transmission.get_torrents.call_args[0][0] == ['abc']
+    flows[0].select.assert_called_once_with([movie])
+
+
+def test_should_hand_every_flow_to_one_transfer_queue(poller, transmission):
+    transmission.get_torrents.return_value = [create_torrent(1, 0, 'tmp/movies'), create_torrent(2, 0, 'tmp/Show/1')]
+    poller.run()
+    post_processor.process_batches.assert_called_once()
+    batches = post_processor.process_batches.call_args[0][0]
+    assert [[t.id for t in b.torrents] for b in batches] == [[1], [2], []]
+
+
+def test_should_stream_downloading_torrents_only_when_enabled(poller, transmission, flows):
+    downloading = Mock(id=1, progress=50.0, downloadDir='tmp/movies')
+    downloading.files.return_value = {0: {'name': 'movie.mkv', 'size': 1, 'completed': 1, 'selected': True}}
+    transmission.get_torrents.return_value = [downloading]
+    poller.run()
+    assert all(not b.partial for b in post_processor.process_batches.call_args[0][0])
+    poller.stream_files = True
+    poller.run()
+    partial = [b for b in post_processor.process_batches.call_args[0][0] if b.partial]
+    assert [b.torrents for b in partial] == [[downloading], [], []]
+
+
+def test_should_only_forget_torrents_of_finalized_flows(transmission, flows, monkeypatch):
+    source = Mock()
+    source.current.return_value = [create_torrent(1, 0, 'tmp/movies'), create_torrent(2, 0, 'tmp/Show/1')]
+
+    def finalize_movies(batches):
+        batches[0].finalized = True
+    monkeypatch.setattr(post_processor, 'process_batches', finalize_movies)
+    torrent_poller.TorrentPoller(source, flows).run()
+    assert [[t.id for t in c[0][0]] for c in source.forget.call_args_list] == [[1]]
+
+
+def test_should_keep_unfinalized_torrents_pending_over_a_restart(transmission, flows, monkeypatch):
+    source = Mock()
+    source.current.return_value = [create_torrent(1, 0, 'tmp/movies'), create_torrent(2, 0, 'tmp/Show/1')]
+
+    def finalize_movies(batches):
+        batches[0].finalized = True
+    monkeypatch.setattr(post_processor, 'process_batches', finalize_movies)
+    poller = torrent_poller.TorrentPoller(source, flows)
+    poller.run()
+    restarted = torrent_poller.TorrentPoller(source, flows)
+    restarted.restore(poller.snapshot())
+    assert restarted.pending == {2}
+
+
+def test_should_fetch_only_torrents_changed_while_down(transmission):
+    source = torrent_poller.IncrementalTorrentSource(transmission, 60)
+    transmission.get_torrents.return_value = [create_torrent(1, 0, 'tmp'), create_torrent(2, 1, 'tmp'),
+                                              create_torrent(3, 0, 'tmp')]
+    source.completed()
+    restored = torrent_poller.IncrementalTorrentSource(transmission, 60)
+    restored.restore(json.loads(json.dumps(source.snapshot())))
+    # While down torrent 2 finished, 3 was removed and 4 was added
+    listing = [create_torrent(1, 0, 'tmp'), create_torrent(2, 0, 'tmp'), create_torrent(4, 0, 'tmp')]
+    transmission.get_torrents.reset_mock()
+    transmission.get_torrents.side_effect = [listing, listing[1:]]
+    assert [t.id for t in restored.completed()] == [1, 2, 4]
+    assert transmission.get_torrents.call_args_list[0][1]['arguments'] == torrent_poller.LISTING_FIELDS
+    assert transmission.get_torrents.call_args_list[1][0][0] == [2, 4]
+    transmission._http_query.return_value = delta_response([], [])
+    restored.completed()
+    assert transmission.get_torrents.call_count == 2
+
+
+def test_should_only_request_recently_active_torrents_after_initial_sync(transmission):
+    source = torrent_poller.IncrementalTorrentSource(transmission, 60)
+    transmission.get_torrents.return_value = [create_torrent(1, 1, 'tmp')]
+    transmission._http_query.return_value = delta_response([torrent_fields(1, 0, 'tmp')], [])
+    assert source.completed() == []
+    completed = source.completed()
+    transmission.get_torrents.assert_called_once()
+    assert json.loads(transmission._http_query.call_args[0][0])['arguments']['ids'] == 'recently-active'
+    assert [t.id for t in completed] == [1]
+
+
+def test_should_drop_torrents_reported_as_removed(transmission):
+    source = torrent_poller.IncrementalTorrentSource(transmission, 60)
+    transmission.get_torrents.return_value = [create_torrent(1, 0, 'tmp'), create_torrent(2, 0, 'tmp')]
+    transmission._http_query.return_value = delta_response([], [1])
+    source.completed()
+    assert [t.id for t in source.completed()] == [2]
+
+
+def test_should_not_report_forgotten_torrents_again(transmission):
+    source = torrent_poller.IncrementalTorrentSource(transmission, 60)
+    torrent = create_torrent(1, 0, 'tmp')
+    transmission.get_torrents.return_value = [torrent]
+    transmission._http_query.return_value = delta_response([], [])
+    source.completed()
+    source.forget([torrent])
+    assert source.completed() == []
+
+
+def test_should_resync_full_torrent_list_periodically(transmission):
+    source = torrent_poller.IncrementalTorrentSource(transmission, 2)
+    transmission.get_torrents.return_value = []
+    transmission._http_query.return_value = delta_response([], [])
+    for _ in range(3):
+        source.completed()
+    assert transmission.get_torrents.call_count == 2
+
+
+def test_should_sync_in_full_when_last_poll_is_older_than_recently_active_window(transmission, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(torrent_poller.time, 'monotonic', lambda: now[0])
+    source = torrent_poller.IncrementalTorrentSource(transmission, 60)
+    transmission.get_torrents.return_value = []
+    transmission._http_query.return_value = delta_response([], [])
+    source.completed()
+    now[0] += 30
+    source.completed()
+    assert transmission.get_torrents.call_count == 1
+    now[0] += 61
+    transmission.get_torrents.return_value = [create_torrent(1, 0, 'tmp')]
+    assert [t.id for t in source.completed()] == [1]
+    assert transmission.get_torrents.call_count == 2
+
+
+def test_should_keep_polling_deltas_with_the_default_trigger(transmission, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(torrent_poller.time, 'monotonic', lambda: now[0])
+    source = torrent_poller.IncrementalTorrentSource(transmission, 60)
+    interval = torrent_poller.poll_interval(source, 60)  # trigger.poll_minutes defaults to 1
+    transmission.get_torrents.return_value = []
+    transmission._http_query.return_value = delta_response([], [])
+    for jitter in [0, 0.9, -0.4, 1.5, 0.2, 2.0, -1.0, 0.7]:
+        source.completed()
+        now[0] += interval + jitter
+    assert transmission.get_torrents.call_count == 1
+    assert transmission._http_query.call_count == 7
+
+
+def test_should_reject_delta_polls_outside_the_recently_active_window(transmission):
+    with pytest.raises(ValueError, match='delta_poll_seconds'):
+        torrent_poller.IncrementalTorrentSource(transmission, 60, 60)
+
+
+def delta_response(torrents, removed):
+    return json.dumps({'result': 'success', 'arguments': {'torrents': torrents, 'removed': removed}})
+
+
+def torrent_fields(id, size_left, download_dir):
+    return {'id': id, 'name': 'Torrent ' + str(id), 'sizeWhenDone': 1, 'leftUntilDone': size_left,
+            'downloadDir': download_dir}
+
+
+def create_torrent(id, size_left, download_dir):
+    return Torrent(None, torrent_fields(id, size_left, download_dir))
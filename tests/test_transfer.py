@@ -0,0 +1,218 @@
+import os
+from unittest.mock import Mock
+
+import pytest
+from paramiko.message import Message
+from paramiko.sftp import CMD_EXTENDED_REPLY
+
+from plexpost import transfer, sftp_destination, transfer_journal, metrics
+
+
+@pytest.fixture
+def workers():
+    return 4
+
+
+@pytest.fixture
+def pool(sftp_destination_for, sftpserver, remote_base_dir, workers):
+    return transfer.TransferPool(sftp_destination_for(sftpserver, remote_dir=remote_base_dir), workers)
+
+
+def test_should_upload_all_files_over_parallel_channels(pool, sftpserver, remote_base_dir, downloads):
+    mappings = [mapping(downloads, 'season/episode' + str(i) + '.mkv') for i in range(10)]
+    results = pool.transfer(mappings)
+    assert all(r.succeeded for r in results)
+    for rule in mappings:
+        assert remote_content(sftpserver, remote_base_dir + '/' + rule['dest']) == rule['filename'].encode()
+
+
+def test_should_report_failures_per_file(pool, sftpserver, remote_base_dir, downloads):
+    good = mapping(downloads, 'good.mkv')
+    bad = mapping(downloads, 'bad.mkv')
+    bad['dest'] = '.keep/bad.mkv'  # Parent is a file on the remote
+    results = pool.transfer([good, bad])
+    assert [r.succeeded for r in results] == [True, False]
+    assert remote_content(sftpserver, remote_base_dir + '/good.mkv') == b'good.mkv'
+
+
+def test_should_count_uploaded_files_and_bytes_per_flow(pool, downloads, monkeypatch):
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    pool.transfer_planned(pool.plan([mapping(downloads, 'movie.mkv')], flow='movie'))
+    rendered = registry.render()
+    assert 'plexpost_files_total{flow="movie"} 1' in rendered
+    assert 'plexpost_bytes_total{flow="movie"} 9' in rendered
+    assert 'plexpost_phase_seconds_count{flow="movie",phase="transfer"} 1' in rendered
+
+
+def test_should_report_remote_copies_that_differ_from_source(pool, downloads):
+    uploaded = mapping(downloads, 'uploaded.mkv')
+    missing = mapping(downloads, 'missing.mkv')
+    pool.transfer([uploaded])
+    assert pool.verify(pool.plan([uploaded, missing])) == ['missing.mkv']
+
+
+@pytest.fixture
+def fs_pool(sftp_destination_for, fs_sftpserver):
+    destination = sftp_destination_for(fs_sftpserver, large_file_threshold=0, block_size=10, request_size=4,
+                                       pipeline_depth=3)
+    return transfer.TransferPool(destination, 1)
+
+
+def test_should_defer_files_that_do_not_fit_on_remote(fs_pool, fs_sftpserver, downloads, capsys):
+    fs_pool.destination.free_space_reserve = 10
+    fs_pool.free_space = lambda: 110
+    movie = mapping(downloads, 'movie.mkv', b'm' * 80)
+    subtitle = mapping(downloads, 'movie.srt', b's' * 30)
+    sample = mapping(downloads, 'sample.mkv', b's' * 60)
+    results = fs_pool.transfer([movie, subtitle, sample])
+    assert [(r.succeeded, r.deferred) for r in results] == [(False, True), (True, False), (True, False)]
+    assert not os.path.exists(fs_sftpserver.root + '/movie.mkv')
+    assert 'Deferring 1 file(s), the remote only has 110 bytes free' in capsys.readouterr().out
+
+
+def test_should_count_bytes_admitted_by_running_transfers_against_free_space(fs_pool, downloads):
+    fs_pool.destination.free_space_reserve = 10
+    fs_pool.free_space = lambda: 110
+    movie = fs_pool.plan([mapping(downloads, 'movie.mkv', b'm' * 80)])
+    episode = fs_pool.plan([mapping(downloads, 'episode.mkv', b'e' * 80)])
+    assert fs_pool.admit(movie) == (movie, [])
+    assert fs_pool.admit(episode) == ([], episode)
+    fs_pool.release_space(movie[0])
+    assert fs_pool.admit(episode) == (episode, [])
+
+
+def test_should_release_admitted_bytes_once_transferred(fs_pool, downloads):
+    fs_pool.free_space = lambda: 100 + fs_pool.destination.free_space_reserve
+    assert fs_pool.transfer([mapping(downloads, 'movie.mkv', b'm' * 80)])[0].succeeded
+    assert fs_pool.reservations == {}
+
+
+def test_should_not_count_confirmed_bytes_against_free_space(fs_pool, downloads):
+    rule = mapping(downloads, 'movie.mkv', b'm' * 100)
+    planned = fs_pool.plan([rule])[0]
+    fs_pool.journal.plan('movie.mkv', planned.src_file, 100, planned.stat.st_mtime)
+    fs_pool.journal.checkpoint('movie.mkv', 60)
+    assert fs_pool.remaining_bytes(planned) == 40
+
+
+def test_should_read_free_space_with_df_when_statvfs_is_unsupported(fs_pool):
+    assert fs_pool.free_space() > 0
+
+
+def test_should_read_free_space_from_statvfs_extension():
+    reply = Message()
+    for value in [4096, 1024, 1000, 500, 300, 0, 0, 0, 0, 0, 255]:
+        reply.add_int64(value)
+    sftp = Mock()
+    sftp._request.return_value = (CMD_EXTENDED_REPLY, Message(reply.asbytes()))
+    assert sftp_destination.remote_free_space(sftp, '/media') == 300 * 1024
+
+
+def test_should_stream_large_files_with_pipelined_writes(fs_pool, fs_sftpserver, downloads):
+    content = bytes(range(256)) * 4
+    rule = mapping(downloads, 'movies/movie.mkv', content)
+    results = fs_pool.transfer([rule])
+    assert results[0].succeeded
+    assert local_content(fs_sftpserver.root + '/movies/movie.mkv') == content
+
+
+def test_should_throttle_every_streamed_byte(fs_pool, downloads):
+    throttled = []
+    fs_pool.shaper = Mock(connection_throttle=lambda: throttled.append)
+    assert fs_pool.transfer([mapping(downloads, 'movie.mkv', b'm' * 95)])[0].succeeded
+    assert sum(throttled) == 95
+
+
+def test_should_throttle_small_files_sent_with_put(pool, downloads):
+    throttled = []
+    pool.shaper = Mock(connection_throttle=lambda: throttled.append)
+    assert pool.transfer([mapping(downloads, 'movie.srt', b's' * 100)])[0].succeeded
+    assert sum(throttled) == 100
+
+
+def test_should_resume_interrupted_upload_from_checkpoint(fs_pool, fs_sftpserver, downloads, capsys):
+    content = bytes(range(256)) * 4
+    rule = mapping(downloads, 'movie.mkv', content)
+    src_stat = os.stat(downloads + '/movie.mkv')
+    fs_pool.journal.plan('movie.mkv', downloads + '/movie.mkv', src_stat.st_size, src_stat.st_mtime)
+    fs_pool.journal.start('movie.mkv')
+    fs_pool.journal.checkpoint('movie.mkv', 600)
+    with open(fs_sftpserver.root + '/movie.mkv', 'wb') as f:
+        f.write(content[:700])
+    results = fs_pool.transfer([rule])
+    assert results[0].succeeded
+    assert 'Resuming movie.mkv from byte 600' in capsys.readouterr().out
+    assert local_content(fs_sftpserver.root + '/movie.mkv') == content
+    assert fs_pool.journal.get('movie.mkv').state == transfer_journal.COMPLETED
+
+
+def test_should_drop_remote_bytes_past_the_end_when_resuming(fs_pool, fs_sftpserver, downloads):
+    content = bytes(range(256))
+    rule = mapping(downloads, 'movie.mkv', content)
+    src_stat = os.stat(downloads + '/movie.mkv')
+    fs_pool.journal.plan('movie.mkv', downloads + '/movie.mkv', src_stat.st_size, src_stat.st_mtime)
+    fs_pool.journal.start('movie.mkv')
+    fs_pool.journal.checkpoint('movie.mkv', 100)
+    with open(fs_sftpserver.root + '/movie.mkv', 'wb') as f:
+        f.write(content[:100] + bytes(300))
+    assert fs_pool.transfer([rule])[0].succeeded
+    assert local_content(fs_sftpserver.root + '/movie.mkv') == content
+
+
+def test_should_skip_files_already_transferred(fs_pool, fs_sftpserver, downloads):
+    rule = mapping(downloads, 'movie.mkv', b'new content')
+    fs_pool.transfer([rule])
+    with open(fs_sftpserver.root + '/movie.mkv', 'wb') as f:
+        f.write(b'old content')  # Same size, so only the journal can tell us it is done
+    fs_pool.transfer([rule])
+    assert local_content(fs_sftpserver.root + '/movie.mkv') == b'old content'
+
+
+def test_should_upload_again_when_remote_copy_is_gone(fs_pool, fs_sftpserver, downloads):
+    rule = mapping(downloads, 'movie.mkv', b'content')
+    fs_pool.transfer([rule])
+    os.remove(fs_sftpserver.root + '/movie.mkv')
+    fs_pool.transfer([rule])
+    assert local_content(fs_sftpserver.root + '/movie.mkv') == b'content'
+
+
+def test_should_skip_missing_source_files(pool, downloads):
+    rule = {'download_dir': downloads, 'filename': 'missing.mkv', 'dest': 'missing.mkv'}
+    assert pool.transfer([rule]) == []
+
+
+def test_should_create_each_remote_dir_once(pool, downloads, monkeypatch):
+    makedirs = Mock(wraps=sftp_destination.remote_makedirs)
+    monkeypatch.setattr(sftp_destination, 'remote_makedirs', makedirs)
+    pool.transfer([mapping(downloads, 'season/episode1.mkv')])
+    pool.transfer([mapping(downloads, 'season/episode2.mkv')])
+    makedirs.assert_called_once()
+
+
+def test_should_create_restored_remote_dir_again_when_upload_fails(pool, downloads):
+    location = pool.destination.location
+    pool.restore({'remote_dirs': [[location, 'season']]})
+    rule = mapping(downloads, 'season/episode.mkv')
+    assert not pool.transfer([rule])[0].succeeded
+    assert pool.transfer([rule])[0].succeeded
+    assert pool.snapshot() == {'remote_dirs': [[location, 'season']]}
+
+
+def mapping(downloads, filename, content=None):
+    path = downloads + '/' + filename
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(filename.encode() if content is None else content)
+    return {'download_dir': downloads, 'filename': filename, 'dest': filename}
+
+
+def local_content(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def remote_content(sftpserver, path):
+    # The fake server keeps uploaded file contents as bytes
+    return sftpserver.content_provider.get(path)
+
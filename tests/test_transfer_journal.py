@@ -0,0 +1,49 @@
+import pytest
+
+from plexpost import transfer_journal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = transfer_journal.TransferJournal(str(tmp_path / 'journal.db'))
+    yield journal
+    journal.close()
+
+
+def test_should_record_planned_transfer(journal):
+    entry = journal.plan('movies/a.mkv', 'tmp/a.mkv', 10, 1.0)
+    assert entry.state == transfer_journal.PLANNED
+    assert entry.offset == 0
+
+
+def test_should_keep_progress_when_planning_the_same_source_again(journal):
+    journal.plan('movies/a.mkv', 'tmp/a.mkv', 10, 1.0)
+    journal.start('movies/a.mkv')
+    journal.checkpoint('movies/a.mkv', 5)
+    entry = journal.plan('movies/a.mkv', 'tmp/a.mkv', 10, 1.0)
+    assert entry.state == transfer_journal.IN_PROGRESS
+    assert entry.offset == 5
+
+
+def test_should_restart_when_source_has_changed(journal):
+    journal.plan('movies/a.mkv', 'tmp/a.mkv', 10, 1.0)
+    journal.complete('movies/a.mkv')
+    entry = journal.plan('movies/a.mkv', 'tmp/a.mkv', 12, 2.0)
+    assert entry.state == transfer_journal.PLANNED
+
+
+def test_should_survive_reopening(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    journal = transfer_journal.TransferJournal(path)
+    journal.plan('movies/a.mkv', 'tmp/a.mkv', 10, 1.0)
+    journal.complete('movies/a.mkv')
+    journal.close()
+    reopened = transfer_journal.TransferJournal(path)
+    assert reopened.get('movies/a.mkv').state == transfer_journal.COMPLETED
+    reopened.close()
+
+
+def test_should_forget_finalised_transfers(journal):
+    journal.plan('movies/a.mkv', 'tmp/a.mkv', 10, 1.0)
+    journal.forget(['movies/a.mkv'])
+    assert journal.get('movies/a.mkv') is None
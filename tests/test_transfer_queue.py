@@ -0,0 +1,90 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from plexpost import transfer, transfer_queue
+
+
+@pytest.fixture
+def queue():
+    return transfer_queue.TransferQueue({'small_file_size': 100,
+                                         'flow_order': ['show', 'movie'],
+                                         'flow_limits': {'movie': 1}})
+
+
+def test_should_send_subtitles_and_small_files_before_large_ones(queue):
+    remux = planned('movie.mkv', 50000, 'show')
+    subtitle = planned('movie.srt', 30000, 'movie')
+    nfo = planned('movie.nfo', 10, 'movie')
+    assert sorted([remux, subtitle, nfo], key=queue.priority) == [nfo, subtitle, remux]
+
+
+def test_should_order_large_files_by_flow(queue):
+    movie = planned('movie.mkv', 1000, 'movie')
+    episode = planned('episode.mkv', 5000, 'show')
+    other = planned('download.iso', 500, 'uncategorised download')
+    assert sorted([other, movie, episode], key=queue.priority) == [episode, movie, other]
+
+
+def test_should_reject_flow_limits_below_one():
+    with pytest.raises(ValueError, match='movie'):
+        transfer_queue.TransferQueue({'flow_limits': {'movie': 0}})
+
+
+def test_should_skip_flows_at_their_limit(queue):
+    movie = planned('movie.mkv', 1000, 'movie')
+    episode = planned('episode.mkv', 5000, 'show')
+    assert queue.next([movie, episode], {'movie': 1}) == episode
+    assert queue.next([movie], {'movie': 1}) is None
+    assert queue.next([movie], {'movie': 0}) == movie
+
+
+def test_should_transfer_in_priority_order():
+    queue = transfer_queue.TransferQueue({'small_file_size': 100})
+    pool = transfer.TransferPool(Mock(), 1, queue=queue)
+    sent = []
+    pool.upload = lambda session, p, throttle=None: sent.append(p.rule['filename']) or 0
+    pool.free_space = lambda: None
+    files = [planned('movie.mkv', 50000, 'movie'), planned('episode.mkv', 50000, 'show'),
+             planned('movie.srt', 30, 'movie')]
+    results = pool.transfer_planned(files)
+    assert sent == ['movie.srt', 'episode.mkv', 'movie.mkv']
+    assert [r.rule['filename'] for r in results] == ['movie.mkv', 'episode.mkv', 'movie.srt']
+
+
+def test_should_share_one_queue_between_concurrent_transfers(queue):
+    pool = transfer.TransferPool(Mock(), 2, queue=queue)
+    pool.free_space = lambda: None
+    sent = []
+    first_started = threading.Event()
+    proceed = threading.Event()
+
+    def upload(session, p, throttle=None):
+        sent.append(p.rule['filename'])
+        if len(sent) == 1:
+            first_started.set()
+            proceed.wait(5)
+        return 0
+    pool.upload = upload
+    remuxes = [planned('movie1.mkv', 50000, 'movie'), planned('movie2.mkv', 50000, 'movie')]
+    transfers = [threading.Thread(target=pool.transfer_planned, args=(remuxes,))]
+    transfers[0].start()
+    first_started.wait(5)
+    transfers.append(threading.Thread(target=pool.transfer_planned, args=([planned('other.mkv', 50000, 'movie'),
+                                                                           planned('episode.srt', 30, 'show')],)))
+    transfers[1].start()
+    while len(sent) < 2 or len(pool.queued) < 2:
+        time.sleep(0.01)
+    assert sent == ['movie1.mkv', 'episode.srt']  # The movie flow is at its limit across both transfers
+    proceed.set()
+    for t in transfers:
+        t.join(5)
+    assert sent[2:] == ['movie2.mkv', 'other.mkv']
+    assert pool.running == 0 and pool.queued == [] and pool.owners == {}
+
+
+def planned(filename, size, flow):
+    return transfer.PlannedFile({'filename': filename, 'download_dir': 'tmp', 'dest': filename}, Mock(st_size=size),
+                                flow)